@@ -0,0 +1,292 @@
+"""Benchmarks for the S3Sync transfer paths against a local S3 stand-in.
+
+Each workload is generated into a temporary directory and run in a fresh
+child process, so peak RSS is measured per workload. The startup workload
+times cheap CLI invocations (--version, --help) and fails the run if they
+import boto3. By default S3 is moto's in-process mock (whose stored
+objects count towards RSS); pass --endpoint-url to run against a moto
+server, MinIO or another S3 endpoint. The memory guarantees are checked by
+tests/test_memory.py instead.
+
+Usage:
+    python -m benchmarks.bench [--workloads startup tiny huge deep resync] [--scale 1.0] [--workers 8]
+                               [--endpoint-url URL] [--output results.json]
+    python -m benchmarks.bench --compare old.json new.json
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import builtins
+import platform
+import resource
+import tempfile
+import contextlib
+import subprocess
+
+from collections import Counter
+from typing import Callable, Dict, List, Optional
+
+WORKLOADS = ('startup', 'tiny', 'huge', 'deep', 'resync')
+BUCKET = 's3sync-bench'
+MB = 1024 * 1024
+# Cheap invocations that must start without importing boto3.
+STARTUP_COMMANDS = {'version': ['--version'], 'help': ['--help'], 'upload-help': ['upload', '--help'],
+                    'config-help': ['config', '--help']}
+STARTUP_RUNS = 10
+
+
+def peak_rss_mb(who:int=resource.RUSAGE_SELF) -> float:
+    """Return the peak resident set size of this process (or of its largest child) in MB."""
+    peak = resource.getrusage(who).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS.
+    return peak / MB if sys.platform == 'darwin' else peak / 1024
+
+
+def write_files(root:str, paths:List[str], size:int, seed:int=0) -> int:
+    """Create files of `size` random bytes and return the total number of bytes written."""
+    rng = random.Random(seed)
+    for path in paths:
+        full_path = os.path.join(root, path)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        with open(full_path, 'wb') as f:
+            remaining = size
+            while remaining:
+                chunk = min(remaining, 4 * MB)
+                f.write(rng.randbytes(chunk))
+                remaining -= chunk
+    return size * len(paths)
+
+
+def generate(workload:str, root:str, scale:float) -> Dict[str, int]:
+    """Generate the files of a workload and return their count and total size."""
+    if workload in ('tiny', 'resync'):
+        count = max(1, int(5000 * scale))
+        paths = [f"d{i % 50:02d}/f{i:06d}.bin" for i in range(count)]
+        return {'files': count, 'bytes': write_files(root, paths, 1024)}
+    if workload == 'huge':
+        count = 2
+        size = max(MB, int(128 * MB * scale))
+        return {'files': count, 'bytes': write_files(root, [f"huge{i}.bin" for i in range(count)], size)}
+    if workload == 'deep':
+        count = max(1, int(2000 * scale))
+        # Twelve levels with a fan-out of three, files spread over all the leaves.
+        paths = []
+        for i in range(count):
+            levels, n = [], i
+            for _ in range(12):
+                levels.append(f"l{n % 3}")
+                n //= 3
+            paths.append("/".join(levels + [f"f{i:06d}.bin"]))
+        return {'files': count, 'bytes': write_files(root, paths, 4096)}
+    raise ValueError(f"Unknown workload '{workload}'")
+
+
+class ApiCallCounter:
+    """Counts S3 API calls per operation with a botocore event hook on the default session."""
+
+    def __init__(self):
+        import boto3
+        boto3.setup_default_session()
+        self.calls = Counter()
+        boto3.DEFAULT_SESSION.events.register('before-call.s3', self._count)
+
+    def _count(self, event_name, **kwargs):
+        self.calls[event_name.rsplit('.', 1)[-1]] += 1
+
+    def take(self) -> Dict[str, int]:
+        calls, self.calls = dict(self.calls), Counter()
+        return calls
+
+
+def measure(name:str, workload:str, counter:ApiCallCounter, files:int, size:int, run:Callable[[], None]) -> dict:
+    """Run one operation and return its measurements."""
+    counter.take()
+    start = time.perf_counter()
+    # The commands print progress and ask for confirmation; neither belongs in a benchmark.
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        run()
+    wall = time.perf_counter() - start
+    calls = counter.take()
+    return {'workload': workload, 'operation': name, 'files': files, 'bytes': size,
+            'wall_s': round(wall, 4), 'files_per_s': round(files / wall, 2), 'mb_per_s': round(size / MB / wall, 2),
+            'api_calls': calls, 'api_calls_total': sum(calls.values()), 'peak_rss_mb': round(peak_rss_mb(), 1)}
+
+
+def run_workload(workload:str, scale:float, workers:int, endpoint_url:Optional[str]) -> List[dict]:
+    """Generate a workload and time its upload and download (or re-sync) in this process."""
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'bench')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'bench')
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    if endpoint_url:
+        os.environ['AWS_ENDPOINT_URL'] = endpoint_url
+        mock = contextlib.nullcontext()
+    else:
+        from moto import mock_aws
+        mock = mock_aws()
+
+    builtins.input = lambda *args: 'yes'
+    work_dir = tempfile.mkdtemp(prefix=f"s3sync-bench-{workload}-")
+    source = os.path.join(work_dir, 'source')
+    target = os.path.join(work_dir, 'target')
+    state_dir = os.path.join(work_dir, 'state')
+    os.makedirs(state_dir)
+    results = []
+    try:
+        totals = generate(workload, source, scale)
+        with mock:
+            import boto3
+            from s3sync_util.commands.upload import upload_to_s3
+            from s3sync_util.commands.download import download_from_s3
+
+            counter = ApiCallCounter()
+            s3 = boto3.client('s3')
+            if not endpoint_url:
+                s3.create_bucket(Bucket=BUCKET)
+            prefix = f"bench/{workload}-{int(time.time())}"
+            # State and listing caches are kept in the working directory.
+            os.chdir(state_dir)
+
+            def upload():
+                upload_to_s3(source, BUCKET, prefix, [], workers=workers)
+
+            results.append(measure('upload', workload, counter, totals['files'], totals['bytes'], upload))
+            if workload == 'resync':
+                # Touch 1% of the files so the re-sync has a little to do.
+                changed = sorted(os.listdir(os.path.join(source, 'd00')))[:max(1, totals['files'] // 100)]
+                for name in changed:
+                    with open(os.path.join(source, 'd00', name), 'wb') as f:
+                        f.write(os.urandom(1024))
+                results.append(measure('resync', workload, counter, totals['files'], totals['bytes'], upload))
+            else:
+                results.append(measure('download', workload, counter, totals['files'], totals['bytes'],
+                                       lambda: download_from_s3(BUCKET, prefix, target, [], workers=workers)))
+            if endpoint_url:
+                for page in s3.get_paginator('list_objects_v2').paginate(Bucket=BUCKET, Prefix=prefix):
+                    keys = [{'Key': obj['Key']} for obj in page.get('Contents', [])]
+                    if keys:
+                        s3.delete_objects(Bucket=BUCKET, Delete={'Objects': keys, 'Quiet': True})
+    finally:
+        os.chdir(tempfile.gettempdir())
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return results
+
+
+def run_startup(runs:int=STARTUP_RUNS) -> List[dict]:
+    """Time cheap CLI invocations in fresh interpreters, from a directory without .config.ini."""
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [root, os.environ.get('PYTHONPATH')])))
+    results = []
+    with tempfile.TemporaryDirectory(prefix="s3sync-bench-startup-") as work_dir:
+        baseline = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, '-c', 'pass'], cwd=work_dir, env=env, check=True)
+            baseline.append(time.perf_counter() - start)
+        for name, argv in STARTUP_COMMANDS.items():
+            walls = []
+            for _ in range(runs):
+                start = time.perf_counter()
+                subprocess.run([sys.executable, '-m', 's3sync_util'] + argv, cwd=work_dir, env=env, check=True,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                walls.append(time.perf_counter() - start)
+            trace = subprocess.run([sys.executable, '-X', 'importtime', '-m', 's3sync_util'] + argv, cwd=work_dir, env=env,
+                                   capture_output=True, text=True)
+            imported = {line.rsplit('|', 1)[-1].strip() for line in trace.stderr.splitlines() if line.startswith('import time:')}
+            wall = sorted(walls)[len(walls) // 2]
+            results.append({'workload': 'startup', 'operation': name, 'files': 0, 'bytes': 0,
+                            'wall_s': round(wall, 4), 'files_per_s': 0.0, 'mb_per_s': 0.0,
+                            # Median time on top of a bare interpreter start.
+                            'overhead_s': round(wall - sorted(baseline)[len(baseline) // 2], 4),
+                            'imports_boto3': 'boto3' in imported or 'botocore' in imported,
+                            'api_calls': {}, 'api_calls_total': 0,
+                            'peak_rss_mb': round(peak_rss_mb(resource.RUSAGE_CHILDREN), 1)})
+    return results
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(old_path:str, new_path:str) -> None:
+    """Print the change of every measurement between two result files."""
+    with open(old_path) as f:
+        old = {(r['workload'], r['operation']): r for r in json.load(f)['results']}
+    with open(new_path) as f:
+        new = json.load(f)['results']
+    print(f"{'workload':<10}{'operation':<11}{'wall_s':>18}{'mb_per_s':>20}{'api_calls':>16}{'peak_rss_mb':>20}")
+    for result in new:
+        before = old.get((result['workload'], result['operation']))
+        if before is None:
+            continue
+        cells = []
+        for field, width in (('wall_s', 18), ('mb_per_s', 20), ('api_calls_total', 16), ('peak_rss_mb', 20)):
+            change = (result[field] - before[field]) / before[field] * 100 if before[field] else 0.0
+            cells.append(f"{result[field]:>{width - 9}} ({change:+.1f}%)")
+        print(f"{result['workload']:<10}{result['operation']:<11}" + "".join(cells))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark S3Sync against a local S3 stand-in")
+    parser.add_argument("--workloads", nargs='*', choices=WORKLOADS, default=list(WORKLOADS))
+    parser.add_argument("--scale", type=float, help="Multiply the number (or size) of generated files", default=1.0)
+    parser.add_argument("--workers", type=int, help="Number of concurrent transfer workers", default=8)
+    parser.add_argument("--endpoint-url", help="S3 endpoint to run against instead of moto's in-process mock", default=None)
+    parser.add_argument("--output", help="Where to write the JSON results", default=None)
+    parser.add_argument("--compare", nargs=2, metavar=('OLD', 'NEW'), help="Compare two result files and exit")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+    if args.child == 'startup':
+        print(json.dumps(run_startup()))
+        return
+    if args.child:
+        print(json.dumps(run_workload(args.child, args.scale, args.workers, args.endpoint_url)))
+        return
+
+    from s3sync_util.__version__ import __version__
+    results = []
+    failed = False
+    for workload in args.workloads:
+        command = [sys.executable, '-m', 'benchmarks.bench', '--child', workload, '--scale', str(args.scale),
+                   '--workers', str(args.workers)]
+        if args.endpoint_url:
+            command += ['--endpoint-url', args.endpoint_url]
+        child = subprocess.run(command, capture_output=True, text=True, cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        if child.returncode != 0:
+            print(f"Error occurred in workload {workload}:\n{child.stderr}")
+            sys.exit(1)
+        for result in json.loads(child.stdout.strip().splitlines()[-1]):
+            result['workload'] = workload
+            results.append(result)
+            print(f"{result['workload']:<8} {result['operation']:<11} {result['wall_s']:>9.2f} s "
+                  f"{result['files_per_s']:>10.1f} files/s {result['mb_per_s']:>8.2f} MB/s "
+                  f"{result['api_calls_total']:>7} calls {result['peak_rss_mb']:>8.1f} MB RSS")
+            if result.get('imports_boto3'):
+                print(f"Error occurred: `s3sync {' '.join(STARTUP_COMMANDS[result['operation']])}` imports boto3")
+                failed = True
+
+    report = {'version': __version__, 'revision': git_revision(), 'python': platform.python_version(),
+              'platform': platform.platform(), 'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'backend': args.endpoint_url or 'moto (in-process)', 'scale': args.scale, 'workers': args.workers,
+              'results': results}
+    output = args.output or f"bench-{__version__}-{time.strftime('%Y%m%d-%H%M%S')}.json"
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {output}")
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,19 @@
+"""Sync local directories with Amazon S3.
+
+The library API is `SyncClient` (see s3sync_util.client). It is imported on
+first use, so the CLI can start without loading boto3.
+"""
+__all__ = ['SyncClient', 'TransferResult', 'ProgressUpdate']
+
+
+def __getattr__(name):
+    if name == 'SyncClient':
+        from s3sync_util.client import SyncClient
+        return SyncClient
+    if name == 'TransferResult':
+        from s3sync_util.commands.stats import TransferResult
+        return TransferResult
+    if name == 'ProgressUpdate':
+        from s3sync_util.commands.pipeline import ProgressUpdate
+        return ProgressUpdate
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
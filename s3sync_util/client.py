@@ -0,0 +1,192 @@
+import os
+import asyncio
+import hashlib
+import logging
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Callable, List, Optional
+
+import boto3
+
+from botocore.client import BaseClient
+from s3sync_util.config.utils import DEFAULT_EXCLUDES
+from s3sync_util.commands import download, sync, upload
+from s3sync_util.commands.common import get_s3_client
+from s3sync_util.commands.stats import TransferResult
+from s3sync_util.commands.tuning import MAX_CONCURRENCY
+
+logger = logging.getLogger('s3sync_util')
+
+# Where the sync state of each job is kept when no state root is given.
+STATE_ROOT = os.path.join(os.path.expanduser('~'), '.cache', 's3sync')
+
+
+class SyncClient:
+    """Runs uploads, downloads and syncs from Python, for services that embed s3sync.
+
+    Jobs never prompt or exit the process: they raise on errors, write their
+    messages to the `s3sync_util` logger and return a TransferResult. Every
+    S3 client is created from one boto3 session and kept in a pool, so
+    concurrent jobs each check out a client of their own and later jobs reuse
+    its connections instead of opening new ones.
+
+    Each job keeps its sync state and its cache (the listing of the prefix,
+    the records of resumable uploads, bundles being written) under
+    `state_root`, in a directory derived from the bucket, prefix and local
+    directory, so jobs for different trees never share them and nothing is
+    written to the working directory.
+
+    Example:
+        with SyncClient(workers=8) as client:
+            result = client.upload('/data/reports', 'my-bucket', 'reports')
+            print(result.files_transferred, result.bytes_transferred)
+    """
+
+    def __init__(self, workers:int=4, max_jobs:int=4, session:Optional[boto3.session.Session]=None,
+                 state_root:Optional[str]=None, exclude:Optional[List[str]]=None, transfer_overrides:Optional[dict]=None,
+                 max_bandwidth:Optional[int]=None, max_requests:Optional[float]=None):
+        """
+        Args:
+            workers (int, optional): Concurrent transfer workers of each job. Defaults to 4.
+            max_jobs (int, optional): Jobs run at once by the async methods. Defaults to 4.
+            session (boto3.session.Session, optional): The session clients are created from. Defaults to a new session.
+            state_root (str, optional): Where the sync state of the jobs is kept. Defaults to ~/.cache/s3sync.
+            exclude (List[str], optional): Patterns excluded from every job, in addition to s3sync's own files.
+            transfer_overrides (dict, optional): Transfer settings that replace the tuned ones (see tuning.tune_transfer).
+            max_bandwidth (int, optional): Bytes per second of each job. Defaults to unlimited.
+            max_requests (float, optional): S3 requests per second of each job. Defaults to unlimited.
+        """
+        self.workers = max(1, workers)
+        self.session = session or boto3.session.Session()
+        self.state_root = state_root or STATE_ROOT
+        self.exclude = list(exclude or [])
+        self.transfer_overrides = transfer_overrides
+        self.max_bandwidth = max_bandwidth
+        self.max_requests = max_requests
+        self._executor = ThreadPoolExecutor(max_workers=max(1, max_jobs), thread_name_prefix='s3sync-job')
+        self._idle: List[BaseClient] = []
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def __enter__(self) -> 'SyncClient':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """Wait for running jobs, then close the pooled clients and their connections."""
+        self._executor.shutdown(wait=True)
+        with self._lock:
+            self._closed = True
+            idle, self._idle = self._idle, []
+        for client in idle:
+            client.close()
+
+    def _checkout(self) -> BaseClient:
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("SyncClient is closed")
+            if self._idle:
+                return self._idle.pop()
+            # Creating clients from a shared session is not thread-safe.
+            return get_s3_client(self.workers, MAX_CONCURRENCY, self.session)
+
+    def _checkin(self, client:BaseClient) -> None:
+        with self._lock:
+            if not self._closed:
+                self._idle.append(client)
+                return
+        client.close()
+
+    def state_dir(self, s3_bucket:str, s3_prefix:str, directory:str) -> str:
+        """Return the state directory of the jobs between a bucket prefix and a local directory."""
+        key = f"{s3_bucket}\0{s3_prefix.strip('/')}\0{os.path.abspath(directory)}"
+        path = os.path.join(self.state_root, hashlib.sha256(key.encode('utf-8')).hexdigest()[:16])
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def _run(self, func:Callable[..., Optional[TransferResult]], directory:str, s3_bucket:str, s3_prefix:str,
+             exclude:Optional[List[str]], **options) -> TransferResult:
+        options.setdefault('workers', self.workers)
+        options.setdefault('transfer_overrides', self.transfer_overrides)
+        options.setdefault('max_bandwidth', self.max_bandwidth)
+        options.setdefault('max_requests', self.max_requests)
+        client = self._checkout()
+        try:
+            return func(directory=directory, s3_bucket=s3_bucket, s3_prefix=s3_prefix,
+                        exclude_list=self.exclude + list(exclude or []) + DEFAULT_EXCLUDES,
+                        s3_client=client, state_dir=self.state_dir(s3_bucket, s3_prefix, directory),
+                        interactive=False, log=logger.info, **options)
+        finally:
+            self._checkin(client)
+
+    def upload(self, directory:str, s3_bucket:str, s3_prefix:str, exclude:Optional[List[str]]=None, **options) -> TransferResult:
+        """Upload a directory to an S3 prefix, skipping files that are already uploaded.
+
+        Args:
+            directory (str): The local directory.
+            s3_bucket (str): The name of the S3 bucket.
+            s3_prefix (str): The prefix to use for S3 object keys.
+            exclude (List[str], optional): Patterns excluded from this job.
+            **options: Further arguments of upload.upload_to_s3, e.g. checksum, dry_run, bundle or on_progress.
+
+        Returns:
+            TransferResult: The outcome of the upload.
+        """
+        return self._run(upload.upload_to_s3, directory, s3_bucket, s3_prefix, exclude, **options)
+
+    def download(self, s3_bucket:str, s3_prefix:str, directory:str, exclude:Optional[List[str]]=None, **options) -> TransferResult:
+        """Download an S3 prefix to a directory, skipping files that are already downloaded.
+
+        Args:
+            s3_bucket (str): The name of the S3 bucket.
+            s3_prefix (str): The prefix to download.
+            directory (str): The local directory.
+            exclude (List[str], optional): Patterns excluded from this job.
+            **options: Further arguments of download.download_from_s3, e.g. dry_run or on_progress.
+
+        Returns:
+            TransferResult: The outcome of the download.
+        """
+        return self._run(download.download_from_s3, directory, s3_bucket, s3_prefix, exclude, **options)
+
+    def sync(self, directory:str, s3_bucket:str, s3_prefix:str, direction:str='upload', delete:bool=False,
+             exclude:Optional[List[str]]=None, **options) -> TransferResult:
+        """Mirror a directory and an S3 prefix in one direction.
+
+        Args:
+            directory (str): The local directory.
+            s3_bucket (str): The name of the S3 bucket.
+            s3_prefix (str): The S3 prefix.
+            direction (str, optional): 'upload' or 'download'. Defaults to 'upload'.
+            delete (bool, optional): Delete files that exist only at the destination. Defaults to False.
+            exclude (List[str], optional): Patterns excluded from this job.
+            **options: Further arguments of sync.sync_with_s3, e.g. checksum, dry_run or on_progress.
+
+        Returns:
+            TransferResult: The outcome of the sync.
+        """
+        return self._run(sync.sync_with_s3, directory, s3_bucket, s3_prefix, exclude, direction=direction, delete=delete, **options)
+
+    async def _run_async(self, method:Callable[..., TransferResult], *args, **kwargs) -> TransferResult:
+        # Jobs block on file and network I/O, so they run on the client's own executor.
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, partial(method, *args, **kwargs))
+
+    async def upload_async(self, directory:str, s3_bucket:str, s3_prefix:str, exclude:Optional[List[str]]=None,
+                           **options) -> TransferResult:
+        """Like `upload`, without blocking the event loop."""
+        return await self._run_async(self.upload, directory, s3_bucket, s3_prefix, exclude, **options)
+
+    async def download_async(self, s3_bucket:str, s3_prefix:str, directory:str, exclude:Optional[List[str]]=None,
+                             **options) -> TransferResult:
+        """Like `download`, without blocking the event loop."""
+        return await self._run_async(self.download, s3_bucket, s3_prefix, directory, exclude, **options)
+
+    async def sync_async(self, directory:str, s3_bucket:str, s3_prefix:str, direction:str='upload', delete:bool=False,
+                         exclude:Optional[List[str]]=None, **options) -> TransferResult:
+        """Like `sync`, without blocking the event loop."""
+        return await self._run_async(self.sync, directory, s3_bucket, s3_prefix, direction, delete, exclude, **options)
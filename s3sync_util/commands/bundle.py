@@ -0,0 +1,473 @@
+import os
+import json
+import time
+import uuid
+import tarfile
+import sqlite3
+import hashlib
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+from botocore.client import BaseClient
+from botocore.exceptions import ClientError
+from s3sync_util.commands.manifest import ManifestEntry
+from s3sync_util.commands.exclude import compile_excludes
+from s3sync_util.commands.remote_index import BUNDLE_DIR, CACHE_DIR, PAGE_SIZE, RemoteIndex, RemoteObject
+from s3sync_util.commands.state_store import StateStore
+from s3sync_util.commands.tuning import TransferSettings
+
+INDEX_SUFFIX = '.index.json'
+BUNDLE_THRESHOLD = 16 * 1024  # 16 KB
+BUNDLE_SIZE = 64 * 1024 * 1024  # 64 MB
+
+# Bundle members are copied and restored in reads of this size.
+READ_SIZE = 1024 * 1024  # 1 MB
+# Needed members closer than this are fetched with one ranged GET.
+COALESCE_GAP = 256 * 1024  # 256 KB
+# When the needed ranges cover this much of a bundle, it is fetched with a single GET.
+WHOLE_FETCH_RATIO = 0.5
+
+
+class BundleMember(NamedTuple):
+    """A file stored inside a bundle, at `offset` bytes into the bundle object."""
+    relative_path: str
+    bundle_key: str
+    offset: int
+    size: int
+    checksum: str
+    mtime_ns: int
+
+
+def bundle_prefix(s3_prefix:str) -> str:
+    """Return the key prefix bundles of an S3 prefix are stored under."""
+    return os.path.join(s3_prefix, BUNDLE_DIR, '')
+
+
+class _HashingReader:
+    """A file wrapper that computes the MD5 of everything read through it."""
+
+    def __init__(self, file):
+        self.file = file
+        self.md5 = hashlib.md5()
+
+    def read(self, size:int=-1) -> bytes:
+        data = self.file.read(size)
+        self.md5.update(data)
+        return data
+
+
+class Bundler:
+    """Packs small files into tar bundles and uploads each with a sidecar index.
+
+    Files are added from the upload workers. Once the pending files reach
+    `bundle_size` bytes, the worker that added the last one writes them into a
+    tar file and uploads it, followed by `<bundle>.index.json` listing the
+    offset, size and MD5 of every member. A bundle only counts once its index
+    exists, so an interrupted upload never leaves a half-described bundle.
+    The bundle itself is an ordinary tar archive and can be unpacked with `tar -x`.
+    """
+
+    def __init__(self, s3:BaseClient, s3_bucket:str, s3_prefix:str, bundle_size:int=BUNDLE_SIZE,
+                 settings:Optional[TransferSettings]=None,
+                 on_uploaded:Optional[Callable[[ManifestEntry, str, str], None]]=None, log:Callable[[str], None]=print,
+                 state_dir:Optional[str]=None, index:Optional[RemoteIndex]=None):
+        """
+        Args:
+            s3 (BaseClient): The S3 client to upload with.
+            s3_bucket (str): The name of the S3 bucket.
+            s3_prefix (str): The prefix the bundled files belong to.
+            bundle_size (int, optional): Size at which a bundle is written and uploaded. Defaults to 64 MB.
+            settings (TransferSettings, optional): The settings of the transfer job.
+            on_uploaded (Callable, optional): Called with (entry, checksum, bundle key) for every member of an uploaded bundle.
+            log (Callable, optional): Where messages are written. Defaults to print.
+            state_dir (str, optional): The directory whose cache holds the bundles being written. Defaults to the working directory.
+            index (RemoteIndex, optional): An index of the prefix, to which every uploaded bundle and bundle index is added.
+        """
+        self.s3 = s3
+        self.s3_bucket = s3_bucket
+        self.s3_prefix = s3_prefix
+        self.bundle_size = bundle_size
+        self.settings = settings
+        self.on_uploaded = on_uploaded
+        self.log = log
+        self.state_dir = state_dir
+        self.index = index
+        self.bundles_uploaded = 0
+        self._lock = threading.Lock()
+        self._pending: List[ManifestEntry] = []
+        self._pending_bytes = 0
+
+    def add(self, entry:ManifestEntry) -> None:
+        """Queue a file for bundling, uploading a bundle if enough files are pending."""
+        with self._lock:
+            self._pending.append(entry)
+            self._pending_bytes += entry.size
+            if self._pending_bytes < self.bundle_size:
+                return
+            batch = self._take()
+        self._upload(batch)
+
+    def flush(self) -> None:
+        """Upload the files still pending as a final, smaller bundle."""
+        with self._lock:
+            batch = self._take()
+        if batch:
+            self._upload(batch)
+
+    def _take(self) -> List[ManifestEntry]:
+        batch, self._pending, self._pending_bytes = self._pending, [], 0
+        return batch
+
+    def _upload(self, entries:List[ManifestEntry]) -> None:
+        # Time-ordered names let downloads resolve a path packed more than once to its newest bundle.
+        name = f"{time.time_ns():020d}-{uuid.uuid4().hex[:8]}.tar"
+        bundle_key = os.path.join(self.s3_prefix, BUNDLE_DIR, name)
+        temp_dir = os.path.join(self.state_dir or os.getcwd(), CACHE_DIR, 'bundles')
+        os.makedirs(temp_dir, exist_ok=True)
+        temp_path = os.path.join(temp_dir, name)
+        members = []
+        try:
+            with tarfile.open(temp_path, 'w') as tar:
+                for entry in entries:
+                    with open(entry.path, 'rb') as f:
+                        info = tarfile.TarInfo(entry.relative_path.replace(os.sep, '/'))
+                        # The size of the file now, in case it changed since the scan.
+                        info.size = os.fstat(f.fileno()).st_size
+                        info.mtime = entry.mtime_ns / 1e9
+                        info.mode = 0o644
+                        # Copied into the tar a buffer at a time, and hashed on the way.
+                        reader = _HashingReader(f)
+                        tar.addfile(info, reader)
+                    # The data ends the member, padded to a whole tar block.
+                    offset = tar.offset - -(-info.size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+                    members.append((entry, info.name, offset, info.size, reader.md5.hexdigest()))
+            # Imported here because upload itself imports this module.
+            from s3sync_util.commands.upload import upload_file_to_s3
+            upload_file_to_s3(self.s3, temp_path, self.s3_bucket, bundle_key, os.path.getsize(temp_path), self.settings, self.log,
+                              state_dir=self.state_dir)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+        index = {'bundle': name, 'members': [[path, offset, size, checksum, entry.mtime_ns]
+                                             for entry, path, offset, size, checksum in members]}
+        body = json.dumps(index, separators=(',', ':')).encode()
+        response = self.s3.put_object(Bucket=self.s3_bucket, Key=bundle_key + INDEX_SUFFIX, Body=body,
+                                      ContentType='application/json')
+        if self.index is not None:
+            # A simple upload returns no ETag, so the bundle's own is asked for.
+            head = self.s3.head_object(Bucket=self.s3_bucket, Key=bundle_key)
+            self.index.put(bundle_key, head['ContentLength'], head['ETag'])
+            self.index.put(bundle_key + INDEX_SUFFIX, len(body), response['ETag'])
+        with self._lock:
+            self.bundles_uploaded += 1
+        if self.on_uploaded:
+            for entry, _, _, _, checksum in members:
+                self.on_uploaded(entry, checksum, bundle_key)
+
+
+def delete_superseded_bundles(s3:BaseClient, s3_bucket:str, bundle_keys:Iterable[str], state:StateStore,
+                              index:Optional[RemoteIndex]=None, log:Callable[[str], None]=print) -> int:
+    """Delete the bundles none of whose members is current any more, with their indexes.
+
+    A member is superseded once the state records its path in another bundle
+    or as an object of its own. A bundle is kept while any of its members is
+    still recorded in it, or has no record at all (a file since deleted
+    locally, which a download still restores from the bundle).
+
+    Args:
+        s3 (BaseClient): The S3 client.
+        s3_bucket (str): The name of the S3 bucket.
+        bundle_keys (Iterable[str]): The bundles to check: those that held files packed or uploaded again.
+        state (StateStore): The sync state of the upload.
+        index (RemoteIndex, optional): An index of the prefix, from which the deleted objects are removed.
+        log (Callable, optional): Where errors are written. Defaults to print.
+
+    Returns:
+        int: The number of bundles deleted.
+    """
+    deleted = 0
+    for bundle_key in sorted(bundle_keys):
+        try:
+            data = json.loads(s3.get_object(Bucket=s3_bucket, Key=bundle_key + INDEX_SUFFIX)['Body'].read())
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') not in ('NoSuchKey', '404'):
+                log(f"\nError occurred while reading the index of {bundle_key}: {e}")
+            continue
+        current = False
+        for path, *_ in data['members']:
+            record = state.get(path)
+            if record is None or record.get('bundle') == bundle_key:
+                current = True
+                break
+        if current:
+            continue
+        keys = [bundle_key, bundle_key + INDEX_SUFFIX]
+        response = s3.delete_objects(Bucket=s3_bucket, Delete={'Objects': [{'Key': key} for key in keys], 'Quiet': True})
+        errors = response.get('Errors', [])
+        for error in errors:
+            log(f"\nError occurred while deleting {error.get('Key')}: {error.get('Message')}")
+        if not errors:
+            deleted += 1
+            if index is not None:
+                index.delete(keys)
+    return deleted
+
+
+class BundleCatalog:
+    """The bundled files of an S3 prefix, resolved against the individually stored objects.
+
+    When a path was packed into several bundles, the newest bundle wins. When a
+    path exists both as a bundle member and as an individual object, whichever
+    was written last wins; the loser is hidden from the download.
+
+    Members and hidden keys are kept in a temporary SQLite database, like the
+    listing they are resolved against (see remote_index.RemoteIndex), so the
+    memory of a job does not grow with the number of bundled files. Only the
+    bundles themselves, one per `bundle_size` of files, are held in memory.
+    """
+
+    def __init__(self, s3_prefix:str):
+        self.s3_prefix = s3_prefix
+        self.prefix = bundle_prefix(s3_prefix)
+        self.bundles: Dict[str, RemoteObject] = {}
+        # Listed objects the catalog takes over from the plain download, for the job totals.
+        self.hidden_count = 0
+        self.hidden_bytes = 0
+        self._lock = threading.Lock()
+        # An empty name opens a private database on disk, deleted by SQLite when it is closed.
+        self._conn = sqlite3.connect('', check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=OFF")
+        self._conn.execute("PRAGMA synchronous=OFF")
+        self._conn.execute("CREATE TABLE members (path TEXT PRIMARY KEY, bundle_key TEXT NOT NULL, offset INTEGER NOT NULL, "
+                           "size INTEGER NOT NULL, checksum TEXT NOT NULL, mtime_ns INTEGER NOT NULL) WITHOUT ROWID")
+        self._conn.execute("CREATE INDEX members_bundle ON members(bundle_key, offset)")
+        self._conn.execute("CREATE TABLE hidden (key TEXT PRIMARY KEY) WITHOUT ROWID")
+
+    def add(self, members:Iterable[BundleMember]) -> None:
+        """Store members, replacing the ones stored before at the same paths."""
+        with self._lock:
+            self._conn.executemany("INSERT OR REPLACE INTO members VALUES (?, ?, ?, ?, ?, ?)", members)
+            self._conn.commit()
+
+    def discard(self, relative_path:str) -> None:
+        """Drop the member at a path."""
+        with self._lock:
+            self._conn.execute("DELETE FROM members WHERE path = ?", (relative_path,))
+            self._conn.commit()
+
+    def retain(self, select:Callable[[str], bool]) -> None:
+        """Drop every member whose path `select` rejects."""
+        for member in self:
+            if not select(member.relative_path):
+                self.discard(member.relative_path)
+
+    def hide(self, obj:RemoteObject) -> None:
+        """Take an individual object superseded by a member over from the plain download."""
+        with self._lock:
+            self._conn.execute("INSERT OR IGNORE INTO hidden VALUES (?)", (obj.key,))
+            self._conn.commit()
+        self.hidden_count += 1
+        self.hidden_bytes += obj.size
+
+    def owns(self, obj:RemoteObject) -> bool:
+        """Whether an object of the listing is a bundle, an index, or an individual object superseded by a bundle."""
+        if obj.key.startswith(self.prefix):
+            return True
+        with self._lock:
+            return self._conn.execute("SELECT 1 FROM hidden WHERE key = ?", (obj.key,)).fetchone() is not None
+
+    def member(self, relative_path:str) -> Optional[BundleMember]:
+        """Return the member a path is restored from, or None."""
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM members WHERE path = ?", (relative_path,)).fetchone()
+        return None if row is None else BundleMember(*row)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM members").fetchone()[0]
+
+    def total_size(self) -> int:
+        """Return the total size of the members."""
+        with self._lock:
+            return self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM members").fetchone()[0]
+
+    def __iter__(self) -> Iterator[BundleMember]:
+        # Read a page at a time in path order, as RemoteIndex.scan does.
+        last = None
+        while True:
+            with self._lock:
+                if last is None:
+                    rows = self._conn.execute("SELECT * FROM members ORDER BY path LIMIT ?", (PAGE_SIZE,)).fetchall()
+                else:
+                    rows = self._conn.execute("SELECT * FROM members WHERE path > ? ORDER BY path LIMIT ?",
+                                              (last, PAGE_SIZE)).fetchall()
+            for row in rows:
+                yield BundleMember(*row)
+            if len(rows) < PAGE_SIZE:
+                return
+            last = rows[-1][0]
+
+    def by_bundle(self, members:Optional[Iterable[BundleMember]]=None) -> Iterator[Tuple[RemoteObject, List[BundleMember]]]:
+        """Yield every bundle with the members that are read from it: all of them, or only `members`."""
+        if members is not None:
+            grouped: Dict[str, List[BundleMember]] = {}
+            for member in members:
+                grouped.setdefault(member.bundle_key, []).append(member)
+            for bundle_key in sorted(grouped):
+                yield self.bundles[bundle_key], sorted(grouped[bundle_key], key=lambda member: member.offset)
+            return
+        for bundle_key in sorted(self.bundles):
+            with self._lock:
+                rows = self._conn.execute("SELECT * FROM members WHERE bundle_key = ? ORDER BY offset", (bundle_key,)).fetchall()
+            if rows:
+                yield self.bundles[bundle_key], [BundleMember(*row) for row in rows]
+
+    def close(self) -> None:
+        """Release the database, which deletes it."""
+        with self._lock:
+            self._conn.close()
+
+
+def load_bundle_catalog(s3:BaseClient, index:RemoteIndex, s3_prefix:str, exclude_list:list, workers:int=1) -> BundleCatalog:
+    """Read the index of every bundle under a prefix.
+
+    Args:
+        s3 (BaseClient): The S3 client.
+        index (RemoteIndex): The listing of the prefix.
+        s3_prefix (str): The prefix.
+        exclude_list (list): List of items to exclude; excluded members are left out.
+        workers (int, optional): Number of indexes fetched concurrently. Defaults to 1.
+
+    Returns:
+        BundleCatalog: The resolved bundle members. Close it when done.
+    """
+    catalog = BundleCatalog(s3_prefix)
+    try:
+        _fill_catalog(s3, index, catalog, exclude_list, workers)
+    except BaseException:
+        catalog.close()
+        raise
+    return catalog
+
+
+def _fill_catalog(s3:BaseClient, index:RemoteIndex, catalog:BundleCatalog, exclude_list:list, workers:int) -> None:
+    """Read the bundle indexes of a prefix into an empty catalog (see load_bundle_catalog)."""
+    index_keys = []
+    # The index is sorted by key, so the bundles are one contiguous run of it.
+    for obj in index.scan(catalog.prefix):
+        key = obj.key
+        if not key.startswith(catalog.prefix):
+            break
+        catalog.hidden_count += 1
+        catalog.hidden_bytes += obj.size
+        if key.endswith(INDEX_SUFFIX):
+            index_keys.append(key)
+        else:
+            catalog.bundles[key] = obj
+    # An index without its bundle belongs to an upload that did not finish.
+    index_keys = sorted(key for key in index_keys if key[:-len(INDEX_SUFFIX)] in catalog.bundles)
+    if not index_keys:
+        return
+
+    def fetch(index_key):
+        return json.loads(s3.get_object(Bucket=index.bucket, Key=index_key)['Body'].read())
+
+    # A few indexes are fetched ahead of the one being stored, not all of them at once.
+    batch_size = max(1, workers) * 2
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        # Oldest bundle first, so a path packed again later is replaced by its newer member.
+        for start in range(0, len(index_keys), batch_size):
+            batch = index_keys[start:start + batch_size]
+            for index_key, data in zip(batch, executor.map(fetch, batch)):
+                bundle_key = index_key[:-len(INDEX_SUFFIX)]
+                catalog.add(BundleMember(path, bundle_key, offset, size, checksum, mtime_ns)
+                            for path, offset, size, checksum, mtime_ns in data['members'])
+
+    excludes = compile_excludes(exclude_list)
+    for member in catalog:
+        key = os.path.join(catalog.s3_prefix, member.relative_path)
+        if excludes.is_excluded(member.relative_path):
+            catalog.discard(member.relative_path)
+            continue
+        individual = index.get(key)
+        if individual is None:
+            continue
+        if individual.last_modified > catalog.bundles[member.bundle_key].last_modified:
+            catalog.discard(member.relative_path)
+        else:
+            catalog.hide(individual)
+
+
+def plan_ranges(members:List[BundleMember], bundle_size:int) -> List[Tuple[int, int, List[BundleMember]]]:
+    """Group the needed members of a bundle into as few GET requests as is sensible.
+
+    Args:
+        members (List[BundleMember]): The members to fetch, sorted by offset.
+        bundle_size (int): The size of the bundle object.
+
+    Returns:
+        List[Tuple[int, int, List[BundleMember]]]: (first byte, last byte, members) of each GET.
+    """
+    ranges = []
+    for member in members:
+        if ranges and member.offset - ranges[-1][1] - 1 <= COALESCE_GAP:
+            ranges[-1][1] = max(ranges[-1][1], member.offset + member.size - 1)
+            ranges[-1][2].append(member)
+        else:
+            ranges.append([member.offset, member.offset + member.size - 1, [member]])
+    if sum(end - start + 1 for start, end, _ in ranges) >= bundle_size * WHOLE_FETCH_RATIO:
+        return [(0, bundle_size - 1, list(members))]
+    return [(start, end, group) for start, end, group in ranges]
+
+
+def restore_bundle_members(s3:BaseClient, s3_bucket:str, bundle:RemoteObject, members:List[BundleMember], directory:str,
+                           on_restored:Optional[Callable[[BundleMember, str], None]]=None) -> None:
+    """Write members of a bundle to a local directory.
+
+    Neighbouring members are fetched with one ranged GET, and the whole bundle
+    with a single GET when most of it is needed. Every member is checked
+    against its MD5 before it is moved into place.
+
+    Args:
+        s3 (BaseClient): The S3 client.
+        s3_bucket (str): The name of the S3 bucket.
+        bundle (RemoteObject): The bundle object.
+        members (List[BundleMember]): The members to restore, sorted by offset.
+        directory (str): The local directory the prefix is restored to.
+        on_restored (Callable, optional): Called with (member, local path) for every restored member.
+    """
+    for start, end, group in plan_ranges(members, bundle.size):
+        kwargs = {'Bucket': s3_bucket, 'Key': bundle.key, 'IfMatch': f'"{bundle.etag}"'}
+        if (start, end) != (0, bundle.size - 1):
+            kwargs['Range'] = f"bytes={start}-{end}"
+        body = s3.get_object(**kwargs)['Body']
+        position = start
+        for member in group:
+            # Skip the tar headers and members that are not needed.
+            while position < member.offset:
+                position += len(body.read(min(member.offset - position, READ_SIZE)))
+            local_path = os.path.join(directory, member.relative_path)
+            os.makedirs(os.path.dirname(local_path), exist_ok=True)
+            temp_path = f"{local_path}.s3sync-download"
+            md5 = hashlib.md5()
+            with open(temp_path, 'wb') as f:
+                # Streamed a buffer at a time, so a member of any size takes little memory.
+                remaining = member.size
+                while remaining:
+                    data = body.read(min(remaining, READ_SIZE))
+                    if not data:
+                        break
+                    md5.update(data)
+                    f.write(data)
+                    remaining -= len(data)
+            position += member.size - remaining
+            if md5.hexdigest() != member.checksum:
+                os.remove(temp_path)
+                raise IOError(f"{member.relative_path} in {bundle.key} does not match its checksum")
+            os.replace(temp_path, local_path)
+            if on_restored:
+                on_restored(member, local_path)
+        body.close()
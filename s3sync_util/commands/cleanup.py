@@ -0,0 +1,62 @@
+import sys
+
+from datetime import datetime, timedelta, timezone
+
+from botocore.exceptions import BotoCoreError, ClientError, NoCredentialsError
+from s3sync_util.commands.common import get_s3_client
+from s3sync_util.commands.multipart import abort_multipart_upload, list_multipart_uploads
+
+
+def cleanup_multipart_uploads(s3_bucket:str, s3_prefix:str, older_than:float=24, dry_run:bool=False, verbose:bool=False) -> None:
+    """Abort stale multipart uploads under a prefix.
+
+    Parts of an upload that was never completed or aborted are stored, and
+    billed, until the upload is aborted.
+
+    Args:
+        s3_bucket (str): The name of the S3 bucket.
+        s3_prefix (str): The prefix to look for uploads under.
+        older_than (float, optional): Only abort uploads initiated more than this many hours ago. Defaults to 24.
+        dry_run (bool, optional): List the stale uploads without aborting them. Defaults to False.
+        verbose (bool, optional): Print every upload found. Defaults to False.
+    """
+    if not s3_bucket:
+        print("Error: --s3-bucket [S3_BUCKET] is required.")
+        sys.exit(1)
+
+    try:
+        print("Cleaning up multipart uploads:")
+        print(f"Bucket: {s3_bucket}")
+        print(f"Prefix: {s3_prefix}")
+
+        try:
+            s3 = get_s3_client()
+            cutoff = datetime.now(timezone.utc) - timedelta(hours=older_than)
+            stale_uploads = [upload for upload in list_multipart_uploads(s3, s3_bucket, s3_prefix)
+                             if upload['Initiated'] < cutoff]
+            print(f"Stale uploads (older than {older_than:g} hours): {len(stale_uploads)}")
+            if verbose or dry_run:
+                for upload in stale_uploads:
+                    print(f"  {upload['Key']} (initiated {upload['Initiated'].isoformat()}, UploadId {upload['UploadId']})")
+            if dry_run or not stale_uploads:
+                return
+
+            confirm = input("Abort these uploads? (yes/no): ").lower()
+            if confirm != 'yes':
+                print("Cleanup operation canceled.")
+                return
+
+            aborted = 0
+            for upload in stale_uploads:
+                try:
+                    abort_multipart_upload(s3, s3_bucket, upload['Key'], upload['UploadId'])
+                    aborted += 1
+                except ClientError as e:
+                    print(f"Error occurred while aborting {upload['Key']}: {e}")
+            print(f"Aborted {aborted} upload(s).")
+        except (BotoCoreError, NoCredentialsError) as e:
+            print(f"Error occurred: {e}")
+
+    except KeyboardInterrupt:
+        print("\nOperation interrupted by the user.")
+        sys.exit(0)
@@ -1,45 +1,125 @@
-import os
+import sys
 import boto3
 
-from boto3.s3.transfer import TransferConfig
+from typing import TYPE_CHECKING, Iterator, Optional
 
-config = TransferConfig(multipart_threshold=1024 * 25, 
-                        max_concurrency=10,
-                        multipart_chunksize=1024 * 25,
-                        use_threads=True)
+from botocore.client import BaseClient
+from botocore.config import Config
+from s3sync_util.commands.manifest import Manifest, scan_directory
+from s3sync_util.commands.throttle import RETRY_CONFIG
 
-def get_total_upload_objects(directory:str, exclude_list:list) -> int:
-    """Count the total number of objects (files and directories) in a directory.
+if TYPE_CHECKING:
+    from s3sync_util.commands.remote_index import RemoteIndex
+
+# Default size from which files use the multipart module instead of the managed
+# transfer; jobs tune their own threshold (see tuning.py).
+LARGE_FILE_THRESHOLD = 100_000_000 # 100 MB
+PART_SIZE = 5 * 1024 * 1024  # 5 MB
+MAX_PARTS = 10_000
+
+def multipart_part_size(size:int) -> int:
+    """Return the part size for a multipart upload of `size` bytes.
+
+    Parts are at least PART_SIZE and, for very large files, grown in whole
+    megabytes so the upload stays within S3's limit of 10,000 parts.
+
+    Args:
+        size (int): The size of the file in bytes.
+
+    Returns:
+        int: The part size in bytes.
+    """
+    megabyte = 1024 * 1024
+    minimum = -(-size // MAX_PARTS)
+    return max(PART_SIZE, -(-minimum // megabyte) * megabyte)
+
+def check_s3_location(s3_bucket:str, s3_prefix:str, interactive:bool=True) -> None:
+    """Stop a command that is missing its bucket or prefix.
+
+    Args:
+        s3_bucket (str): The name of the S3 bucket.
+        s3_prefix (str): The S3 prefix.
+        interactive (bool, optional): Print the error and exit, as the CLI does; otherwise raise ValueError. Defaults to True.
+    """
+    if s3_bucket and s3_prefix:
+        return
+    if not s3_bucket and not s3_prefix:
+        message = "Error: Both --s3-bucket [S3_BUCKET] and --s3-prefix [S3_PREFIX] are required."
+    elif not s3_bucket:
+        message = "Error: --s3-bucket [S3_BUCKET] is required."
+    else:
+        message = "Error: --s3-prefix [S3_PREFIX] is required."
+    if not interactive:
+        raise ValueError(message)
+    print(message)
+    sys.exit(1)
+
+def get_s3_client(workers:int=1, max_concurrency:int=10, session:Optional[boto3.session.Session]=None) -> BaseClient:
+    """Create an S3 client that can be shared by a pool of transfer workers.
+
+    boto3 clients are thread-safe, so one client is created per job and its
+    connection pool is sized for every worker running a managed transfer.
+    Requests are retried in botocore's standard mode, with jittered
+    exponential backoff on throttling (see throttle.RETRY_CONFIG).
+
+    Args:
+        workers (int, optional): Number of concurrent transfer workers. Defaults to 1.
+        max_concurrency (int, optional): Most parts each worker transfers at once. Defaults to 10.
+        session (boto3.session.Session, optional): The session to create the client from. Defaults to boto3's default session.
+
+    Returns:
+        BaseClient: The S3 client.
+    """
+    max_pool_connections = max(1, workers) * max_concurrency
+    return (session or boto3).client('s3', config=Config(max_pool_connections=max(10, max_pool_connections), retries=RETRY_CONFIG))
+
+def get_total_upload_objects(directory:str, exclude_list:list, manifest:Optional[Manifest]=None) -> int:
+    """Count the total number of files in a directory.
 
     Args:
         directory (str): The directory to count objects in.
         exclude_list (list): List of items to exclude from counting.
+        manifest (Manifest, optional): An existing scan of the directory to count instead of walking it again.
 
     Returns:
         int: The total number of objects in the directory.
     """
-    total_objects = 0
-    for _, dirs, files in os.walk(directory):
-        dirs[:] = [d for d in dirs if d not in exclude_list]
-        for file in files:
-            if file not in exclude_list:
-                total_objects += 1
-    return total_objects
+    if manifest is None:
+        return sum(1 for _ in scan_directory(directory, exclude_list))
+    return len(manifest)
+
+def iter_s3_objects(s3:BaseClient, bucket:str, prefix:str) -> Iterator[dict]:
+    """Yield every object under a prefix, following the listing across all pages.
 
-def get_total_download_objects(bucket:str, prefix:str) -> int:
+    Args:
+        s3 (BaseClient): The S3 client to list with.
+        bucket (str): The name of the S3 bucket.
+        prefix (str): The prefix to filter objects by.
+
+    Yields:
+        dict: The listing entry of each object (Key, Size, ETag, LastModified, ...).
+    """
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        yield from page.get('Contents', [])
+
+def get_total_download_objects(bucket:str, prefix:str, index:Optional['RemoteIndex']=None) -> int:
     """Count the total number of objects (files and directories) in an S3 bucket with a given prefix.
 
     Args:
         bucket (str): The name of the S3 bucket.
         prefix (str): The prefix to filter objects by.
+        index (RemoteIndex, optional): An existing listing of the prefix to count instead of listing it again.
 
     Returns:
         int: The total number of objects in the S3 bucket with the given prefix.
     """
+    if index is not None:
+        return len(index)
+
     s3 = boto3.client('s3')
 
-    response = s3.list_objects_v2(Bucket=bucket, Prefix=prefix)
-    total_objects = len(response.get('Contents', []))
+    total_objects = sum(1 for _ in iter_s3_objects(s3, bucket, prefix))
     return total_objects
 
 def format_time(seconds:int) -> str:
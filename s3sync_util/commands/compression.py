@@ -0,0 +1,185 @@
+import os
+import zlib
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
+from typing import Callable, Iterator, Optional
+
+from botocore.client import BaseClient
+from s3sync_util.commands.common import PART_SIZE, multipart_part_size
+from s3sync_util.commands.exclude import compile_excludes, to_posix
+
+try:
+    import zstandard
+except ImportError:  # optional: pip install zstandard
+    zstandard = None
+
+CODECS = ('gzip', 'zstd')
+# Object metadata (x-amz-meta-*) recording how an object was compressed and its original size.
+CODEC_METADATA = 's3sync-codec'
+SIZE_METADATA = 's3sync-size'
+READ_SIZE = 1024 * 1024  # 1 MB
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+
+
+def default_codec() -> str:
+    """Return zstd when the zstandard package is installed, gzip otherwise."""
+    return 'zstd' if zstandard else 'gzip'
+
+
+def _compressor(codec:str):
+    if codec == 'gzip':
+        return zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    if codec == 'zstd' and zstandard:
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+    raise ValueError(f"Codec '{codec}' is not available")
+
+
+def _decompressor(codec:str):
+    if codec == 'gzip':
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if codec == 'zstd' and zstandard:
+        return zstandard.ZstdDecompressor().decompressobj()
+    raise ValueError(f"The object is compressed with '{codec}', which needs the zstandard package")
+
+
+class Compression:
+    """Which files are stored compressed, and with which codec.
+
+    Patterns use the exclude syntax (see exclude.ExcludeMatcher), e.g. `*.log`
+    or `exports/`.
+    """
+
+    def __init__(self, patterns:list, codec:Optional[str]=None, log:Callable[[str], None]=print):
+        """
+        Args:
+            patterns (list): The files to compress.
+            codec (str, optional): 'gzip' or 'zstd'. Defaults to zstd if available, else gzip.
+            log (Callable, optional): Where warnings are written. Defaults to print.
+        """
+        if codec not in (None,) + CODECS:
+            raise ValueError(f"Unknown codec '{codec}', expected one of: {', '.join(CODECS)}")
+        if codec == 'zstd' and not zstandard:
+            log("Warning: zstd needs the zstandard package (pip install zstandard); compressing with gzip instead.")
+            codec = 'gzip'
+        self.codec = codec or default_codec()
+        self.patterns = compile_excludes(patterns)
+
+    def codec_for(self, relative_path:str) -> Optional[str]:
+        """Return the codec a file is stored with, or None if it is stored as is."""
+        return self.codec if self.patterns.is_excluded(to_posix(relative_path)) else None
+
+
+def compressed_chunks(local_path:str, codec:str, chunk_size:int) -> Iterator[bytes]:
+    """Read a file and yield its compressed content in chunks of `chunk_size` bytes (the last one shorter)."""
+    compressor = _compressor(codec)
+    pending = bytearray()
+    with open(local_path, 'rb') as file:
+        for block in iter(lambda: file.read(READ_SIZE), b''):
+            pending += compressor.compress(block)
+            while len(pending) >= chunk_size:
+                yield bytes(pending[:chunk_size])
+                del pending[:chunk_size]
+    pending += compressor.flush()
+    while len(pending) > chunk_size:
+        yield bytes(pending[:chunk_size])
+        del pending[:chunk_size]
+    yield bytes(pending)
+
+
+def upload_compressed(s3:BaseClient, local_path:str, s3_bucket:str, s3_key:str, codec:str, part_size:Optional[int]=None,
+                      workers:int=10) -> str:
+    """Compress a file while uploading it, holding at most `workers` + 1 parts in memory.
+
+    The object gets `Content-Encoding: <codec>` and the codec and original size
+    in its metadata, so downloads know to decompress it. A file that
+    compresses to less than one part is sent with a single PUT.
+
+    Args:
+        s3 (BaseClient): The S3 client.
+        local_path (str): The file to upload.
+        s3_bucket (str): The name of the S3 bucket.
+        s3_key (str): The key of the uploaded object.
+        codec (str): 'gzip' or 'zstd'.
+        part_size (int, optional): Size of each compressed part. Defaults to the smallest size within 10,000 parts.
+        workers (int, optional): Number of parts uploaded concurrently. Defaults to 10.
+
+    Returns:
+        str: The ETag of the uploaded object.
+    """
+    size = os.path.getsize(local_path)
+    # The compressed size is unknown up front; parts sized for the original stay within 10,000.
+    part_size = max(part_size or 0, PART_SIZE, multipart_part_size(size))
+    extra_args = {'ContentEncoding': codec, 'Metadata': {CODEC_METADATA: codec, SIZE_METADATA: str(size)}}
+    chunks = compressed_chunks(local_path, codec, part_size)
+    first = next(chunks)
+    second = next(chunks, None)
+    if second is None:
+        return s3.put_object(Bucket=s3_bucket, Key=s3_key, Body=first, **extra_args)['ETag'].strip('"')
+
+    upload_id = s3.create_multipart_upload(Bucket=s3_bucket, Key=s3_key, **extra_args)['UploadId']
+    slots = threading.BoundedSemaphore(max(1, workers))
+    failed = threading.Event()
+
+    def upload_part(part_number, body):
+        try:
+            response = s3.upload_part(Bucket=s3_bucket, Key=s3_key, UploadId=upload_id, PartNumber=part_number, Body=body)
+            return {'PartNumber': part_number, 'ETag': response['ETag']}
+        except BaseException:
+            failed.set()
+            raise
+        finally:
+            slots.release()
+
+    try:
+        futures = []
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            for part_number, body in enumerate(chain((first, second), chunks), 1):
+                # Compression waits for a free slot, so memory stays bounded however large the file.
+                slots.acquire()
+                if failed.is_set():
+                    slots.release()
+                    break
+                futures.append(executor.submit(upload_part, part_number, body))
+        parts = [future.result() for future in futures]
+        response = s3.complete_multipart_upload(Bucket=s3_bucket, Key=s3_key, UploadId=upload_id,
+                                                MultipartUpload={'Parts': parts})
+    except BaseException:
+        s3.abort_multipart_upload(Bucket=s3_bucket, Key=s3_key, UploadId=upload_id)
+        raise
+    return response['ETag'].strip('"')
+
+
+def stored_codec(response:dict) -> Optional[str]:
+    """Return the codec a GET or HEAD response says the object is compressed with, or None."""
+    codec = response.get('Metadata', {}).get(CODEC_METADATA)
+    return codec if codec in CODECS else None
+
+
+def save_object(response:dict, local_path:str) -> None:
+    """Stream the body of a GET response to a file, decompressing it if it was stored compressed.
+
+    The body is written to a temporary file next to `local_path` and renamed
+    into place once complete.
+    """
+    codec = stored_codec(response)
+    decompressor = _decompressor(codec) if codec else None
+    body = response['Body']
+    temp_path = f"{local_path}.s3sync-tmp"
+    try:
+        with open(temp_path, 'wb') as file:
+            for block in iter(lambda: body.read(READ_SIZE), b''):
+                file.write(decompressor.decompress(block) if decompressor else block)
+            if decompressor and hasattr(decompressor, 'flush'):
+                file.write(decompressor.flush())
+        os.replace(temp_path, local_path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except FileNotFoundError:
+            pass
+        raise
+    finally:
+        body.close()
@@ -0,0 +1,155 @@
+import os
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Tuple
+
+from botocore.client import BaseClient
+from botocore.exceptions import ClientError
+from s3sync_util.commands.common import multipart_part_size
+from s3sync_util.commands.hashing import transfer_part_size
+from s3sync_util.commands.manifest import ManifestEntry
+from s3sync_util.commands.remote_index import RemoteIndex
+from s3sync_util.commands.size import format_size
+from s3sync_util.commands.state_store import StateStore
+from s3sync_util.commands.tuning import GB, TransferSettings
+
+# Largest object a single CopyObject request can create; larger copies are multipart.
+COPY_OBJECT_LIMIT = 5 * GB
+# Answers to a conditional copy whose source is gone or has changed since it was recorded.
+STALE_SOURCE_CODES = frozenset(('PreconditionFailed', 'NoSuchKey', '404', '412'))
+
+
+def copy_s3_object(s3:BaseClient, s3_bucket:str, source_key:str, source_etag:str, s3_key:str, size:int,
+                   part_size:Optional[int]=None, workers:int=10) -> str:
+    """Create an object as a server-side copy of another object in the same bucket.
+
+    The copy only happens if the source still has the given ETag. Objects
+    above COPY_OBJECT_LIMIT are copied part by part with `upload_part_copy`,
+    in parts of `part_size` so the copy gets the ETag an upload would have,
+    and with the source's Content-Type, Content-Encoding and metadata.
+
+    Args:
+        s3 (BaseClient): The S3 client.
+        s3_bucket (str): The name of the S3 bucket.
+        source_key (str): The key of the object to copy.
+        source_etag (str): The ETag the source must have.
+        s3_key (str): The key of the new object.
+        size (int): The size of the content in bytes.
+        part_size (int, optional): Size of each copied part. Defaults to the smallest size within 10,000 parts.
+        workers (int, optional): Number of parts copied concurrently. Defaults to 10.
+
+    Returns:
+        str: The ETag of the new object.
+
+    Raises:
+        ClientError: PreconditionFailed or NoSuchKey if the source changed or is gone.
+    """
+    source = {'Bucket': s3_bucket, 'Key': source_key}
+    if_match = f'"{source_etag}"'
+    if size <= COPY_OBJECT_LIMIT:
+        response = s3.copy_object(Bucket=s3_bucket, Key=s3_key, CopySource=source, CopySourceIfMatch=if_match)
+        return response['CopyObjectResult']['ETag'].strip('"')
+
+    part_size = part_size or multipart_part_size(size)
+    # Unlike CopyObject, a multipart copy does not carry the source's headers over. The
+    # stored size is taken from the source too, as it differs from `size` for compressed objects.
+    head = s3.head_object(Bucket=s3_bucket, Key=source_key, IfMatch=if_match)
+    size = head['ContentLength']
+    headers = {name: head[name] for name in ('ContentType', 'ContentEncoding', 'Metadata') if head.get(name)}
+    upload_id = s3.create_multipart_upload(Bucket=s3_bucket, Key=s3_key, **headers)['UploadId']
+
+    def copy_part(part_number):
+        start = (part_number - 1) * part_size
+        end = min(start + part_size, size) - 1
+        response = s3.upload_part_copy(Bucket=s3_bucket, Key=s3_key, UploadId=upload_id, PartNumber=part_number,
+                                       CopySource=source, CopySourceRange=f"bytes={start}-{end}", CopySourceIfMatch=if_match)
+        return {'PartNumber': part_number, 'ETag': response['CopyPartResult']['ETag']}
+
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            parts = list(executor.map(copy_part, range(1, -(-size // part_size) + 1)))
+        response = s3.complete_multipart_upload(Bucket=s3_bucket, Key=s3_key, UploadId=upload_id,
+                                                MultipartUpload={'Parts': parts})
+    except BaseException:
+        s3.abort_multipart_upload(Bucket=s3_bucket, Key=s3_key, UploadId=upload_id)
+        raise
+    return response['ETag'].strip('"')
+
+
+class Deduplicator:
+    """Creates uploaded objects by server-side copy when their content is already in the bucket.
+
+    A file's content is looked up by MD5 in the sync state (files uploaded
+    from other paths) and by ETag in the listing of the prefix (objects
+    uploaded by anyone). The copy is conditional on the source's ETag, so a
+    source that changed or was deleted since it was recorded is never copied;
+    the file is then uploaded as usual.
+    """
+
+    def __init__(self, s3:BaseClient, s3_bucket:str, s3_prefix:str, state:StateStore, index:Optional[RemoteIndex]=None,
+                 settings:Optional[TransferSettings]=None):
+        """
+        Args:
+            s3 (BaseClient): The S3 client.
+            s3_bucket (str): The name of the S3 bucket.
+            s3_prefix (str): The prefix of the uploaded keys.
+            state (StateStore): The sync state, searched by checksum.
+            index (RemoteIndex, optional): The listing of the prefix, searched by ETag.
+            settings (TransferSettings, optional): The settings of the transfer job. Defaults to the default settings.
+        """
+        self.s3 = s3
+        self.s3_bucket = s3_bucket
+        self.s3_prefix = s3_prefix
+        self.state = state
+        self.index = index
+        self.settings = settings or TransferSettings()
+        self.copied_files = 0
+        self.copied_bytes = 0
+        self._lock = threading.Lock()
+
+    def find_source(self, entry:ManifestEntry, checksum:str, etag:str, codec:Optional[str]=None) -> Optional[Tuple[str, str]]:
+        """Return the (key, ETag) of an object with the same content as a file, stored with the same codec, or None."""
+        s3_key = os.path.join(self.s3_prefix, entry.relative_path)
+        found = self.state.find_by_checksum(checksum)
+        if found:
+            path, record = found
+            # Bundled files live inside a tar object and cannot be copied on their own.
+            if (path != entry.relative_path and record.get('etag') and not record.get('bundle')
+                    and record.get('size') == entry.size and record.get('codec') == codec):
+                return os.path.join(self.s3_prefix, path), record['etag']
+        # Listed ETags are those of the stored bytes, which only match an uncompressed file.
+        if self.index is not None and codec is None:
+            # Single-part objects have the MD5 as ETag, multipart ones the ETag of their parts.
+            for candidate in dict.fromkeys((etag, checksum)):
+                remote = self.index.find_by_etag(candidate, entry.size)
+                if remote and remote.key != s3_key:
+                    return remote.key, remote.etag
+        return None
+
+    def copy(self, entry:ManifestEntry, s3_key:str, checksum:str, etag:str, codec:Optional[str]=None) -> Optional[str]:
+        """Create `s3_key` by copying an object with the file's content.
+
+        Returns:
+            str: The ETag of the copy, or None if the file must be uploaded.
+        """
+        source = self.find_source(entry, checksum, etag, codec)
+        if source is None:
+            return None
+        source_key, source_etag = source
+        try:
+            copied_etag = copy_s3_object(self.s3, self.s3_bucket, source_key, source_etag, s3_key, entry.size,
+                                         transfer_part_size(entry.size, self.settings), self.settings.max_concurrency)
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in STALE_SOURCE_CODES:
+                return None
+            raise
+        with self._lock:
+            self.copied_files += 1
+            self.copied_bytes += entry.size
+        return copied_etag
+
+    def describe(self) -> str:
+        """Return a printable summary of the bytes deduplicated."""
+        return (f"Deduplicated {self.copied_files} file(s) by server-side copy, "
+                f"{format_size(self.copied_bytes)} not uploaded.")
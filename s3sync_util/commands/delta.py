@@ -0,0 +1,84 @@
+from typing import FrozenSet, List, NamedTuple, Optional, Tuple
+
+from s3sync_util.commands.common import MAX_PARTS
+from s3sync_util.commands.hashing import digest_file, digest_file_parts, transfer_part_size
+from s3sync_util.commands.manifest import ManifestEntry
+from s3sync_util.commands.tuning import TransferSettings
+
+
+class PartHashes(NamedTuple):
+    """The MD5 of every `part_size` range of a file, as kept in its state record."""
+    part_size: int
+    digests: List[str]
+
+
+class PartReuse(NamedTuple):
+    """The parts of a changed file that the object at its key already has, at the same offsets."""
+    source_etag: str
+    part_numbers: FrozenSet[int]
+    part_count: int
+
+
+def record_part_hashes(record:Optional[dict]) -> Optional[PartHashes]:
+    """Return the part hashes kept in a state record, or None."""
+    if not record or not record.get('parts') or not record.get('part_size'):
+        return None
+    return PartHashes(record['part_size'], record['parts'])
+
+
+def hash_file(entry:ManifestEntry, record:Optional[dict], settings:TransferSettings,
+              delta:bool=True) -> Tuple[str, str, Optional[PartHashes]]:
+    """Hash a file for upload, producing its MD5, its ETag and, for large files, its part hashes.
+
+    Large files are the ones uploaded with the resumable multipart module.
+    Their parts are hashed with the part size of their previous upload, when
+    the record has part hashes and that size still fits within 10,000 parts,
+    so they can be compared with the parts of the object; otherwise with the
+    part size of the job.
+
+    Args:
+        entry (ManifestEntry): The file.
+        record (dict, optional): The state record of the file.
+        settings (TransferSettings): The settings of the transfer job.
+        delta (bool, optional): Compute part hashes for large files. Defaults to True.
+
+    Returns:
+        Tuple[str, str, PartHashes]: The MD5 of the file, its ETag for the part size and the part hashes, or None.
+    """
+    part_size = transfer_part_size(entry.size, settings)
+    if not delta or entry.size < settings.large_file_threshold:
+        return digest_file(entry.path, part_size) + (None,)
+    previous = record_part_hashes(record)
+    if previous and -(-entry.size // previous.part_size) <= MAX_PARTS:
+        part_size = previous.part_size
+    checksum, etag, digests = digest_file_parts(entry.path, part_size)
+    return checksum, etag, PartHashes(part_size, digests)
+
+
+def plan_reuse(record:Optional[dict], parts:Optional[PartHashes], size:int) -> Optional[PartReuse]:
+    """Find the parts of a changed file that can be copied from the object uploaded before.
+
+    A part is reused when its hash equals the hash recorded for the same
+    range of the previous upload, which lies entirely within the previous
+    object. The copies are conditional on the ETag in the record, so an
+    object that was replaced meanwhile is never copied from.
+
+    Args:
+        record (dict, optional): The state record of the previous upload.
+        parts (PartHashes, optional): The part hashes of the file as it is now.
+        size (int): The size of the file as it is now.
+
+    Returns:
+        PartReuse: The parts to copy, or None if the whole file must be sent.
+    """
+    previous = record_part_hashes(record)
+    if (not parts or not previous or previous.part_size != parts.part_size or not record.get('etag')
+            or record.get('codec') or record.get('bundle')):
+        return None
+    reused = set()
+    for number, (old, new) in enumerate(zip(previous.digests, parts.digests), 1):
+        if old == new and min(number * parts.part_size, size) <= record.get('size', 0):
+            reused.add(number)
+    if not reused:
+        return None
+    return PartReuse(record['etag'], frozenset(reused), len(parts.digests))
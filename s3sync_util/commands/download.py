@@ -1,16 +1,78 @@
 import sys
 import os
-import time
-import boto3
+from datetime import datetime
+from typing import Callable, Optional
 
-from botocore.exceptions import BotoCoreError, NoCredentialsError
+from botocore.client import BaseClient
+from botocore.exceptions import BotoCoreError, ClientError, NoCredentialsError
 from s3sync_util.commands.multipart import multipart_download_from_s3
-from s3sync_util.commands.state_management import load_state, save_state
+from s3sync_util.commands.hashing import digest_file, etag_matches
+from s3sync_util.commands.bundle import load_bundle_catalog, restore_bundle_members
+from s3sync_util.commands.compression import save_object, stored_codec
+from s3sync_util.commands.exclude import compile_excludes
+from s3sync_util.commands.state_store import open_state_store
+from s3sync_util.commands.state_management import file_signature, signature_matches
+from s3sync_util.commands.stats import TransferResult, TransferStats
+from s3sync_util.commands.throttle import Throttle, retry_throttled
 from s3sync_util.commands.size import get_total_download_size, format_size
-from s3sync_util.commands.common import get_total_download_objects, format_time, config
+from s3sync_util.commands.pipeline import Progress, ProgressUpdate, run_pipeline
+from s3sync_util.commands.remote_index import get_remote_index
+from s3sync_util.commands.shard import Shard, parse_shard, write_summary
+from s3sync_util.commands.common import check_s3_location, get_total_download_objects, get_s3_client
+from s3sync_util.commands.tuning import MAX_CONCURRENCY, TransferSettings, TransferTuner, tune_transfer
 
 
-def download_from_s3(s3_bucket: str, s3_prefix: str, directory: str, exclude_list: list, dry_run: bool=False, progress: bool=False, verbose: bool=False) -> None:
+def build_record(local_stat:os.stat_result, etag:str, last_modified:datetime, s3_key:str) -> dict:
+    """Build the state record of a downloaded file.
+
+    Args:
+        local_stat (os.stat_result): The stat of the downloaded file.
+        etag (str): The ETag of the S3 object.
+        last_modified (datetime): The LastModified time of the S3 object.
+        s3_key (str): The key of the S3 object.
+
+    Returns:
+        dict: The record stored under the file's relative path.
+    """
+    return dict(file_signature(local_stat), etag=etag, last_modified=last_modified.isoformat(),
+                extension=os.path.splitext(s3_key)[-1])
+
+def download_file_from_s3(s3:BaseClient, s3_bucket:str, s3_key:str, local_path:str, total_size:int, etag:Optional[str]=None,
+                          settings:Optional[TransferSettings]=None, log:Callable[[str], None]=print) -> None:
+    """Download a single object, switching to multipart download for large objects.
+
+    The object size comes from the listing. Objects below the multipart
+    threshold are fetched with a single GET; larger ones are looked up with a
+    HEAD first. Objects stored compressed (see compression.py) are
+    decompressed as they are written to disk.
+
+    Args:
+        s3 (BaseClient): The S3 client to download with.
+        s3_bucket (str): The name of the S3 bucket.
+        s3_key (str): The key of the object.
+        local_path (str): Where to save the object.
+        total_size (int): The size of the object in bytes.
+        etag (str, optional): The ETag of the object, used to resume and verify large downloads.
+        settings (TransferSettings, optional): The settings of the transfer job. Defaults to the default settings.
+        log (Callable, optional): Where messages are written. Defaults to print.
+    """
+    settings = settings or TransferSettings()
+    os.makedirs(os.path.dirname(local_path), exist_ok=True)
+    conditions = {'IfMatch': f'"{etag}"'} if etag else {}
+    if total_size < settings.multipart_threshold:
+        # The response says whether the object is compressed, so no HEAD is needed.
+        save_object(s3.get_object(Bucket=s3_bucket, Key=s3_key, **conditions), local_path)
+    elif stored_codec(s3.head_object(Bucket=s3_bucket, Key=s3_key, **conditions)):
+        # A compressed stream is decompressed in order, so it is fetched in one piece.
+        save_object(s3.get_object(Bucket=s3_bucket, Key=s3_key, **conditions), local_path)
+    elif total_size >= settings.large_file_threshold:
+        log(f"\n{s3_key}'s size is over {format_size(settings.large_file_threshold)}, using multipart download for better transfer efficiency.")
+        multipart_download_from_s3(local_path, s3, s3_bucket, s3_key, total_size, etag, settings.max_concurrency,
+                                   settings.multipart_chunksize)
+    else:
+        s3.download_file(s3_bucket, s3_key, local_path, Config=settings.transfer_config())
+
+def download_from_s3(s3_bucket: str, s3_prefix: str, directory: str, exclude_list: list, dry_run: bool=False, progress: bool=False, verbose: bool=False, workers: int=1, state_backend: str='sqlite', index_ttl: float=0, transfer_overrides: Optional[dict]=None, stats: Optional[TransferStats]=None, max_bandwidth: Optional[int]=None, max_requests: Optional[float]=None, s3_client: Optional[BaseClient]=None, state_dir: Optional[str]=None, interactive: bool=True, log: Callable[[str], None]=print, on_progress: Optional[Callable[[ProgressUpdate], None]]=None, shard: Optional[Shard]=None) -> Optional[TransferResult]:
     """Download files(s) from an S3 bucket to a local directory.
     Args:
         s3_bucket (str): The name of the S3 bucket.
@@ -20,93 +82,213 @@ def download_from_s3(s3_bucket: str, s3_prefix: str, directory: str, exclude_lis
         dry_run (bool, optional): Simulate the download process without actual download. Defaults to False.
         progress (bool, optional): Display progress statistics. Defaults to False.
         verbose (bool, optional): Increase verbosity of the download process. Defaults to False.
+        workers (int, optional): Number of concurrent download workers. Defaults to 1.
+        state_backend (str, optional): Where sync state is kept, 'sqlite' or 'json'. Defaults to 'sqlite'.
+        index_ttl (float, optional): Reuse a cached listing of the prefix younger than this many seconds. Defaults to 0.
+        transfer_overrides (dict, optional): Transfer settings that replace the tuned ones (see tuning.tune_transfer).
+        stats (TransferStats, optional): Collects the phase timings and S3 request metrics of the job.
+        max_bandwidth (int, optional): Bytes per second shared by all workers. Defaults to unlimited.
+        max_requests (float, optional): S3 requests per second shared by all workers. Defaults to unlimited.
+        s3_client (BaseClient, optional): A client to reuse instead of creating one for the job.
+        state_dir (str, optional): Where the sync state is kept. Defaults to the working directory.
+        interactive (bool, optional): Ask for confirmation and report errors instead of raising them. Defaults to True.
+        log (Callable, optional): Where messages are written. Defaults to print.
+        on_progress (Callable, optional): Called with a ProgressUpdate after every downloaded or skipped file.
+        shard (Shard, optional): Download only this shard's objects (see shard.Shard), e.g. '2/8'. Defaults to every object.
+
+    Returns:
+        TransferResult: The outcome of the download, or None if it was canceled or failed.
     """
 
-    if not s3_bucket or not s3_prefix:
-        if not s3_bucket and not s3_prefix:
-            print("Error: Both --s3-bucket [S3_BUCKET] and --s3-prefix [S3_PREFIX] are required.")
-        elif not s3_bucket:
-            print("Error: --s3-bucket [S3_BUCKET] is required.")
-        else:
-            print("Error: --s3-prefix [S3_PREFIX] is required.")
-        sys.exit(1)
+    check_s3_location(s3_bucket, s3_prefix, interactive)
+
+    workers = max(1, workers)
+    stats = stats or TransferStats('download')
+    throttle = Throttle(workers * MAX_CONCURRENCY, max_bandwidth, max_requests)
+    shard = parse_shard(shard)
+    index = catalog = None
 
     try:
-        print("Downloading from S3:")
-        print(f"Bucket: {s3_bucket}")
-        print(f"Downloading From: {s3_prefix}")
+        log("Downloading from S3:")
+        log(f"Bucket: {s3_bucket}")
+        log(f"Downloading From: {s3_prefix}")
 
-        total_objects = get_total_download_objects(s3_bucket, s3_prefix)
-        download_size = get_total_download_size(s3_bucket, s3_prefix, exclude_list)
-        print(f"Total Objects: {total_objects}")
-        print(f"Total download size: {format_size(download_size)}")
+        # The prefix is listed once; counting, sizing and the download all read this index.
+        s3 = stats.attach(s3_client or get_s3_client(workers, MAX_CONCURRENCY))
+        throttle.attach(s3)
+        try:
+            with stats.phase('list'):
+                index = get_remote_index(s3, s3_bucket, s3_prefix, index_ttl, workers, exclude_list, state_dir)
+                # Files packed into bundles are restored from them rather than downloaded one by one.
+                catalog = load_bundle_catalog(s3, index, s3_prefix, exclude_list, workers)
+        except (BotoCoreError, ClientError, NoCredentialsError) as e:
+            if not interactive:
+                raise
+            log(f"Error occurred: {e}")
+            return
+        excludes = compile_excludes(exclude_list)
 
-        confirm = input("Proceed with download? (yes/no): ").lower()
-        if confirm == 'yes':
-            state = load_state()
+        def list_objects():
+            for obj in index:
+                if (not catalog.owns(obj) and not excludes.excludes_key(obj.key, s3_prefix)
+                        and (shard is None or shard.owns(os.path.relpath(obj.key, s3_prefix)))):
+                    yield obj
+
+        if shard:
+            catalog.retain(shard.owns)
+            total_objects = len(catalog)
+            download_size = catalog.total_size()
+            for obj in list_objects():
+                total_objects += 1
+                download_size += obj.size
+            log(f"Shard {shard}: {total_objects} of the listed object(s)")
+        else:
+            total_objects = get_total_download_objects(s3_bucket, s3_prefix, index) - catalog.hidden_count + len(catalog)
+            download_size = (get_total_download_size(s3_bucket, s3_prefix, exclude_list, index) - catalog.hidden_bytes
+                             + catalog.total_size())
+        log(f"Total Objects: {total_objects}")
+        log(f"Total download size: {format_size(download_size)}")
+        settings = tune_transfer(index.sizes(), workers, transfer_overrides)
+        log(f"Transfer settings: {settings.describe()}")
 
-            downloaded_files = 0
-            total_files = total_objects
-            skipped_files = 0
-            start_time = time.time()
+        confirm = input("Proceed with download? (yes/no): ").lower() if interactive else 'yes'
+        if confirm == 'yes':
+            state = open_state_store(state_backend, state_dir, shard)
+            tracker = Progress(total_objects, "Downloaded", progress, on_progress)
+            tuner = TransferTuner(settings)
 
             try:
-                s3 = boto3.client('s3')
-                response = s3.list_objects_v2(Bucket=s3_bucket, Prefix=s3_prefix)
-                for obj in response.get('Contents', []):
-                    s3_key = obj['Key']
-                    if not any(item in s3_key for item in exclude_list):
-                        local_path = os.path.join(directory, os.path.relpath(s3_key, s3_prefix))
-                        remote_etag = obj.get('ETag', '').strip('"')
-                        last_modified = obj.get('LastModified', None)
-                        if os.path.exists(local_path):
-                            # local_checksum = state.get(local_path, {}).get('hash', '')
-                            if remote_etag in state:
+                def download_stage(obj):
+                    s3_key = obj.key
+                    total_size = obj.size
+                    relative_path = os.path.relpath(s3_key, s3_prefix)
+                    local_path = os.path.join(directory, relative_path)
+                    remote_etag = obj.etag
+                    last_modified = obj.last_modified
+                    try:
+                        local_stat = os.stat(local_path)
+                    except FileNotFoundError:
+                        local_stat = None
+                    if local_stat:
+                        record = state.get(relative_path)
+                        # Unchanged when the local copy is still the one downloaded from this ETag.
+                        unchanged = (record is not None and record.get('etag') == remote_etag
+                                     and signature_matches(record, local_stat.st_size, local_stat.st_mtime_ns, local_stat.st_ino))
+                        # Without a usable record, hash the local copy and compare it with the listed ETag.
+                        if not unchanged:
+                            verified = state.pop_legacy(remote_etag, local_path)
+                            if not verified and local_stat.st_size == total_size:
+                                with stats.phase('checksum'):
+                                    verified = etag_matches(local_path, total_size, remote_etag, settings=settings)
+                            if verified:
+                                unchanged = True
+                                state.put(relative_path, build_record(local_stat, remote_etag, last_modified, s3_key))
+                        if unchanged:
+                            if verbose:
+                                log(f"Skipping {s3_key} as it's already downloaded and unchanged.")
+                            tracker.skip()
+                            return None
+
+                    if dry_run:
+                        log(f"\nSimulating: Would download {s3_key} from S3 bucket {s3_bucket} to {local_path}")
+                    else:
+                        if verbose:
+                            log(f"S3 Key: {s3_key}")
+                            log(f"Local Path: {local_path}")
+                        try:
+                            with stats.phase('transfer'):
+                                retry_throttled(download_file_from_s3, s3, s3_bucket, s3_key, local_path, total_size, remote_etag, settings, log)
+                        except Exception:
+                            tuner.observe(total_size, error=True)
+                            raise
+                        tuner.observe(total_size)
+                        if verbose:
+                            log(f"\nDownloaded {s3_key} as {local_path}")
+                        state.put(relative_path, build_record(os.stat(local_path), remote_etag, last_modified, s3_key))
+                    tracker.advance(total_size)
+
+                def bundle_stage(item):
+                    bundle, members = item
+                    needed = []
+                    for member in members:
+                        local_path = os.path.join(directory, member.relative_path)
+                        try:
+                            local_stat = os.stat(local_path)
+                        except FileNotFoundError:
+                            local_stat = None
+                        if local_stat:
+                            record = state.get(member.relative_path)
+                            unchanged = (record is not None and record.get('etag') == member.checksum
+                                         and signature_matches(record, local_stat.st_size, local_stat.st_mtime_ns, local_stat.st_ino))
+                            if not unchanged and local_stat.st_size == member.size:
+                                with stats.phase('checksum'):
+                                    verified = digest_file(local_path)[0] == member.checksum
+                                if verified:
+                                    unchanged = True
+                                    state.put(member.relative_path, dict(build_record(local_stat, member.checksum, bundle.last_modified,
+                                                                                      member.relative_path), bundle=member.bundle_key))
+                            if unchanged:
                                 if verbose:
-                                    print(f"Skipping {s3_key} as it's already downloaded and unchanged.")
-                                skipped_files += 1
+                                    log(f"Skipping {member.relative_path} as it's already downloaded and unchanged.")
+                                tracker.skip()
                                 continue
-                        # Download the file(s)
-                        downloaded_files += 1
-                        if downloaded_files > skipped_files:
-                            progress_percentage = (downloaded_files / (total_files - skipped_files)) * 100
-                            remaining_files = total_files - downloaded_files
-                            time_elapsed = time.time() - start_time
-                            files_per_second = downloaded_files / time_elapsed
-                            time_remaining = remaining_files / files_per_second
-                            progress_line = f"Progress: {progress_percentage:.2f}% | Downloaded: {downloaded_files}/{total_files} | Remaining: {format_time(time_remaining)}"
-                        else:
-                            progress_percentage = 0
-                            time_remaining = -1
-                            progress_line = f"Progress: {progress_percentage:.2f}% | Downloaded: {downloaded_files}/{total_files} | Remaining: N/A"
-                        if progress:
-                            sys.stdout.write("\r" + progress_line)
-                            sys.stdout.flush()
-                        if dry_run:
-                            print(f"\nSimulating: Would download {s3_key} from S3 bucket {s3_bucket} to {local_path}")
-                        else:
-                            # print(f"Downloading {s3_key} from S3 bucket {s3_bucket}")
-                            if verbose:
-                                print(f"S3 Key: {s3_key}")
-                                print(f"Local Path: {local_path}")
-                            os.makedirs(os.path.dirname(local_path), exist_ok=True)
-                            response = s3.head_object(Bucket=s3_bucket, Key=s3_key)
-                            total_size = response['ContentLength']
-                            if total_size >= 100_000_000: # 100 MB
-                                print(f"\n{s3_key}'s size is over 100 MB, using multipart download for better transfer efficiency.")
-                                multipart_download_from_s3(local_path, s3, s3_bucket, s3_key, total_size)
-                            else:
-                                s3.download_file(s3_bucket, s3_key, local_path, Config=config)
-                            if verbose:
-                                print(f"\nDownloaded {s3_key} as {local_path}")
-                            state[remote_etag] = {'file': local_path, 'last_modified': last_modified.isoformat(), 'extension': os.path.splitext(s3_key)[-1]}
-                save_state(state)
-                print("\nDownload completed.")
-            except (BotoCoreError, NoCredentialsError) as e:
-                print(f"Error occurred: {e}")
+                        needed.append(member)
+                    if not needed:
+                        return None
+
+                    if dry_run:
+                        for member in needed:
+                            log(f"\nSimulating: Would restore {member.relative_path} from bundle {bundle.key}")
+                            tracker.advance(member.size)
+                        return None
+
+                    done = set()
+
+                    def restored(member, local_path):
+                        done.add(member.relative_path)
+                        state.put(member.relative_path, dict(build_record(os.stat(local_path), member.checksum, bundle.last_modified,
+                                                                          member.relative_path), bundle=member.bundle_key))
+                        if verbose:
+                            log(f"\nRestored {member.relative_path} from bundle {bundle.key}")
+                        tracker.advance(member.size)
+
+                    with stats.phase('transfer'):
+                        # A retry after throttling fetches only the members not restored yet.
+                        retry_throttled(lambda: restore_bundle_members(
+                            s3, s3_bucket, bundle, [member for member in needed if member.relative_path not in done], directory, restored))
+                    return None
+
+                run_pipeline(list_objects(), [(download_stage, workers)], queue_size=workers * 4)
+                if catalog.bundles:
+                    run_pipeline(catalog.by_bundle(), [(bundle_stage, workers)], queue_size=workers * 4)
+                stats.finish(tracker.transferred_files, tracker.transferred_bytes, tracker.skipped_files)
+                if shard and not dry_run:
+                    write_summary(stats.to_dict(), shard, state_dir)
+                log("\nDownload completed.")
+                log(tracker.summary())
+                if throttle.concurrency.decreases:
+                    log(throttle.describe())
+                return stats.result()
+            except (BotoCoreError, ClientError, NoCredentialsError) as e:
+                if not interactive:
+                    raise
+                log(f"Error occurred: {e}")
+            finally:
+                state.close()
         else:
-            print("Download operation canceled.")
+            log("Download operation canceled.")
 
     except KeyboardInterrupt:
-        print("\nOperation interrupted by the user.")
+        if not interactive:
+            raise
+        log("\nOperation interrupted by the user.")
         sys.exit(0)
+    finally:
+        if catalog is not None:
+            catalog.close()
+        if index is not None:
+            index.close()
+        if s3_client is not None:
+            # A client passed in outlives the job: leave it without the job's hooks.
+            throttle.detach(s3_client)
+            stats.detach(s3_client)
@@ -0,0 +1,165 @@
+import os
+import re
+
+from functools import lru_cache
+from typing import Dict, Iterable, List, Pattern, Tuple
+
+# Directories whose exclusion a matcher remembers. Matchers are shared between
+# jobs (see compile_excludes), so the memo is emptied when it reaches this size.
+DIRECTORY_CACHE_SIZE = 4096
+
+
+def _translate(pattern:str) -> str:
+    """Translate the glob part of a gitignore pattern into a regular expression."""
+    parts = []
+    i, n = 0, len(pattern)
+    while i < n:
+        c = pattern[i]
+        if c == '*':
+            if pattern.startswith('**', i):
+                if pattern.startswith('**/', i):
+                    parts.append('(?:.*/)?')
+                    i += 3
+                else:
+                    parts.append('.*')
+                    i += 2
+                continue
+            parts.append('[^/]*')
+        elif c == '?':
+            parts.append('[^/]')
+        elif c == '[':
+            end = pattern.find(']', i + 2 if pattern.startswith('[!', i) or pattern.startswith('[]', i) else i + 1)
+            if end == -1:
+                parts.append(re.escape(c))
+            else:
+                body = pattern[i + 1:end].replace('\\', '\\\\')
+                if body.startswith('!'):
+                    body = '^' + body[1:]
+                elif body.startswith('^'):
+                    body = '\\' + body
+                parts.append('[' + body + ']')
+                i = end
+        elif c == '\\' and i + 1 < n:
+            i += 1
+            parts.append(re.escape(pattern[i]))
+        else:
+            parts.append(re.escape(c))
+        i += 1
+    return ''.join(parts)
+
+
+class ExcludeMatcher:
+    """Exclude patterns compiled once, with gitignore semantics.
+
+    - A pattern without a slash matches a file or directory name at any depth
+      (`.git` matches `.git` and `a/.git`, but not `foo.github.io`).
+    - A pattern with a slash is anchored to the root of the sync (`/build`, `docs/*.tmp`).
+    - A trailing slash matches directories only (`cache/`).
+    - `*` and `?` do not cross `/`, `**` does, and `[...]` is a character class.
+    - A leading `!` re-includes what an earlier pattern excluded; the last matching pattern wins.
+    - Everything under an excluded directory is excluded, so excluded subtrees
+      can be pruned without being walked or listed.
+
+    Paths are relative to the synced directory or S3 prefix and use '/'.
+    Consecutive patterns of the same kind are combined into one regular
+    expression, so a path is tested against a handful of expressions however
+    many patterns there are.
+    """
+
+    def __init__(self, patterns:Iterable[str]):
+        self.patterns: Tuple[str, ...] = tuple(p.strip() for p in patterns if p.strip() and not p.strip().startswith('#'))
+        groups: List[Tuple[bool, bool, List[str]]] = []
+        for pattern in self.patterns:
+            negated = pattern.startswith('!')
+            if negated:
+                pattern = pattern[1:]
+            dir_only = pattern.endswith('/')
+            pattern = pattern.rstrip('/')
+            if not pattern:
+                continue
+            anchored = '/' in pattern
+            regex = _translate(pattern.lstrip('/'))
+            if not anchored:
+                regex = '(?:.*/)?' + regex
+            if groups and groups[-1][:2] == (negated, dir_only):
+                groups[-1][2].append(regex)
+            else:
+                groups.append((negated, dir_only, [regex]))
+        # Evaluated last group first: the last matching pattern decides.
+        self._groups: List[Tuple[bool, bool, Pattern]] = [
+            (negated, dir_only, re.compile('(?:' + '|'.join(regexes) + r')\Z', re.DOTALL))
+            for negated, dir_only, regexes in reversed(groups)]
+        self._directories: Dict[str, bool] = {}
+
+    def __bool__(self) -> bool:
+        return bool(self._groups)
+
+    def matches(self, relative_path:str, is_dir:bool=False) -> bool:
+        """Whether the patterns exclude the path itself, without looking at its parent directories."""
+        for negated, dir_only, regex in self._groups:
+            if dir_only and not is_dir:
+                continue
+            if regex.match(relative_path):
+                return not negated
+        return False
+
+    def is_excluded(self, relative_path:str, is_dir:bool=False) -> bool:
+        """Whether a path is excluded by itself or by one of its parent directories.
+
+        Args:
+            relative_path (str): The path relative to the root of the sync, separated by '/'.
+            is_dir (bool, optional): Whether the path is a directory. Defaults to False.
+
+        Returns:
+            bool: True if the path is excluded.
+        """
+        if not self._groups:
+            return False
+        relative_path = relative_path.strip('/')
+        parent = relative_path.rpartition('/')[0]
+        if parent and self._directory_excluded(parent):
+            return True
+        return self.matches(relative_path, is_dir)
+
+    def excludes_key(self, key:str, s3_prefix:str) -> bool:
+        """Whether an S3 key under `s3_prefix` is excluded."""
+        if not self._groups:
+            return False
+        relative_key = key[len(s3_prefix):] if key.startswith(s3_prefix) else key
+        return self.is_excluded(relative_key, is_dir=key.endswith('/'))
+
+    def _directory_excluded(self, path:str) -> bool:
+        # Keys and files share their directories, so each directory is decided once.
+        excluded = self._directories.get(path)
+        if excluded is None:
+            parent = path.rpartition('/')[0]
+            excluded = bool(parent and self._directory_excluded(parent)) or self.matches(path, is_dir=True)
+            # Scans and listings visit a directory's paths together, so only recent directories are worth keeping.
+            if len(self._directories) >= DIRECTORY_CACHE_SIZE:
+                self._directories.clear()
+            self._directories[path] = excluded
+        return excluded
+
+
+@lru_cache(maxsize=32)
+def _compile(patterns:Tuple[str, ...]) -> ExcludeMatcher:
+    return ExcludeMatcher(patterns)
+
+
+def compile_excludes(exclude_list:Iterable[str]) -> ExcludeMatcher:
+    """Return the compiled matcher of an exclude list, compiling each distinct list only once.
+
+    Args:
+        exclude_list (Iterable[str]): Patterns from `.config.ini` EXCLUDE and `--exclude`.
+
+    Returns:
+        ExcludeMatcher: The matcher.
+    """
+    if isinstance(exclude_list, ExcludeMatcher):
+        return exclude_list
+    return _compile(tuple(exclude_list or ()))
+
+
+def to_posix(relative_path:str) -> str:
+    """Return a local relative path with '/' separators, as the matcher expects."""
+    return relative_path if os.sep == '/' else relative_path.replace(os.sep, '/')
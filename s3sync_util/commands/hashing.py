@@ -0,0 +1,161 @@
+import hashlib
+
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from s3sync_util.commands.tuning import TransferSettings
+
+READ_SIZE = 8 * 1024 * 1024  # 8 MB
+MB = 1024 * 1024
+
+# Part sizes commonly used by other S3 clients (the AWS CLI defaults to 8 MB).
+COMMON_PART_SIZES = (8 * MB, 16 * MB, 5 * MB, 64 * MB)
+
+
+def transfer_part_size(size:int, settings:Optional[TransferSettings]=None) -> Optional[int]:
+    """Return the part size this tool uploads a file of the given size with.
+
+    Args:
+        size (int): The size of the file in bytes.
+        settings (TransferSettings, optional): The settings of the transfer job. Defaults to the default settings.
+
+    Returns:
+        int: The part size in bytes, or None if the file is uploaded in a single request.
+    """
+    return (settings or TransferSettings()).part_size(size)
+
+
+def digest_file(file_path:str, part_size:Optional[int]=None) -> Tuple[str, str]:
+    """Hash a file in a single pass, producing its MD5 and its S3 ETag.
+
+    See digest_file_parts, which also returns the MD5 of every part.
+
+    Args:
+        file_path (str): The path to the file.
+        part_size (int, optional): The multipart part size the ETag is computed for.
+            None computes the ETag of a single-request upload. Defaults to None.
+
+    Returns:
+        Tuple[str, str]: The MD5 hex digest of the file and its S3 ETag.
+    """
+    checksum, etag, _ = digest_file_parts(file_path, part_size)
+    return checksum, etag
+
+
+def digest_file_parts(file_path:str, part_size:Optional[int]=None) -> Tuple[str, str, List[str]]:
+    """Hash a file in a single pass, producing its MD5, its S3 ETag and the MD5 of each part.
+
+    The file is read in large blocks into a reused buffer. hashlib releases the
+    GIL while hashing such blocks, so calls from several threads use several cores.
+
+    Args:
+        file_path (str): The path to the file.
+        part_size (int, optional): The multipart part size the ETag is computed for.
+            None computes the ETag of a single-request upload. Defaults to None.
+
+    Returns:
+        Tuple[str, str, List[str]]: The MD5 hex digest of the file, its S3 ETag and the
+            MD5 hex digests of its parts (empty without `part_size`). Multipart
+            ETags have the form `<md5 of the part MD5s>-<number of parts>`.
+    """
+    whole = hashlib.md5()
+    part = hashlib.md5()
+    part_digests = []
+    part_filled = 0
+    buffer = bytearray(READ_SIZE)
+    view = memoryview(buffer)
+    with open(file_path, 'rb', buffering=0) as f:
+        while True:
+            length = f.readinto(buffer)
+            if not length:
+                break
+            chunk = view[:length]
+            whole.update(chunk)
+            while part_size and chunk:
+                take = min(len(chunk), part_size - part_filled)
+                part.update(chunk[:take])
+                part_filled += take
+                chunk = chunk[take:]
+                if part_filled == part_size:
+                    part_digests.append(part.digest())
+                    part = hashlib.md5()
+                    part_filled = 0
+    if part_filled:
+        part_digests.append(part.digest())
+
+    checksum = whole.hexdigest()
+    if not part_size:
+        return checksum, checksum, []
+    etag = f"{hashlib.md5(b''.join(part_digests)).hexdigest()}-{len(part_digests)}"
+    return checksum, etag, [digest.hex() for digest in part_digests]
+
+
+def compute_etag(file_path:str, part_size:Optional[int]=None) -> str:
+    """Compute the ETag S3 would report for a file uploaded with the given part size.
+
+    Args:
+        file_path (str): The path to the file.
+        part_size (int, optional): The multipart part size, or None for a single-request upload.
+
+    Returns:
+        str: The ETag, without surrounding quotes.
+    """
+    return digest_file(file_path, part_size)[1]
+
+
+def etag_part_count(etag:str) -> int:
+    """Return the number of parts encoded in an ETag (0 for a single-request upload)."""
+    _, _, parts = etag.strip('"').partition('-')
+    return int(parts) if parts.isdigit() else 0
+
+
+def candidate_part_sizes(size:int, parts:int, settings:Optional[TransferSettings]=None) -> Iterator[int]:
+    """Yield the part sizes that split `size` bytes into exactly `parts` parts.
+
+    Args:
+        size (int): The size of the object in bytes.
+        parts (int): The number of parts encoded in the object's ETag.
+        settings (TransferSettings, optional): The settings of the transfer job, whose part size is tried first.
+
+    Yields:
+        int: Candidate part sizes, most likely first.
+    """
+    # Clients pick whole-MB part sizes, so the smallest whole-MB size giving
+    # `parts` parts is the best guess, followed by the common defaults.
+    guess = -(-size // parts)
+    guess = -(-guess // MB) * MB
+    seen = set()
+    for part_size in (transfer_part_size(size, settings), transfer_part_size(size), guess) + COMMON_PART_SIZES:
+        if part_size and part_size not in seen and -(-size // part_size) == parts:
+            seen.add(part_size)
+            yield part_size
+
+
+def etag_matches(file_path:str, size:int, etag:str, known:Optional[Dict[Optional[int], str]]=None,
+                 settings:Optional[TransferSettings]=None) -> bool:
+    """Check whether a local file has the content of an S3 object, using the object's ETag.
+
+    Args:
+        file_path (str): The path to the local file.
+        size (int): The size of the local file in bytes.
+        etag (str): The ETag from the S3 listing.
+        known (dict, optional): ETags already computed for the file, keyed by part size
+            (None for the plain MD5), so they are not recomputed.
+        settings (TransferSettings, optional): The settings of the transfer job.
+
+    Returns:
+        bool: True if the file hashes to the same ETag.
+    """
+    etag = etag.strip('"')
+    known = dict(known or {})
+    parts = etag_part_count(etag)
+    if not parts:
+        if None not in known:
+            known[None] = compute_etag(file_path)
+        return known[None] == etag
+    for part_size in candidate_part_sizes(size, parts, settings):
+        if part_size not in known:
+            known[part_size] = compute_etag(file_path, part_size)
+        if known[part_size] == etag:
+            return True
+    return False
+
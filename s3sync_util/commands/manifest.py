@@ -0,0 +1,146 @@
+import os
+import struct
+import tempfile
+import threading
+
+from typing import Callable, Iterator, NamedTuple, Optional
+
+from s3sync_util.commands.exclude import compile_excludes, to_posix
+
+# Manifests larger than this move from memory to a temporary file.
+SPOOL_SIZE = 8 * 1024 * 1024  # 8 MB
+READ_SIZE = 1024 * 1024  # 1 MB
+# size, mtime_ns, inode and the length of the relative path that follows.
+RECORD = struct.Struct('<qqQI')
+
+
+class ManifestEntry(NamedTuple):
+    """A local file as seen by a single directory scan."""
+    path: str
+    relative_path: str
+    size: int
+    mtime_ns: int
+    inode: int
+
+
+def scan_directory(directory:str, exclude_list:list, start:Optional[str]=None) -> Iterator[ManifestEntry]:
+    """Walk a directory once with os.scandir and yield an entry per file.
+
+    Excluded directories are pruned without being entered, and each file is
+    stat'ed exactly once; the size, mtime and inode of that stat are carried
+    in the entry so later stages never have to touch the file metadata again.
+
+    Args:
+        directory (str): The directory to scan.
+        exclude_list (list): Exclude patterns (see exclude.ExcludeMatcher).
+        start (str, optional): A subdirectory to scan instead of the whole directory; paths stay relative to `directory`.
+
+    Yields:
+        ManifestEntry: One entry per file, in directory order.
+    """
+    excludes = compile_excludes(exclude_list)
+    root_length = len(os.path.join(directory, ''))
+    pending = [start or directory]
+    while pending:
+        current = pending.pop()
+        try:
+            entries = os.scandir(current)
+        except OSError as e:
+            print(f"Error occurred while scanning {current}: {e}")
+            continue
+        subdirectories = []
+        with entries:
+            for entry in entries:
+                try:
+                    # Parent directories were already checked on the way down.
+                    if entry.is_dir(follow_symlinks=False):
+                        if not excludes.matches(to_posix(entry.path[root_length:]), is_dir=True):
+                            subdirectories.append(entry.path)
+                    elif entry.is_file() and not excludes.matches(to_posix(entry.path[root_length:])):
+                        stat = entry.stat()
+                        yield ManifestEntry(entry.path, entry.path[root_length:],
+                                            stat.st_size, stat.st_mtime_ns, stat.st_ino)
+                except OSError as e:
+                    print(f"Error occurred while scanning {entry.path}: {e}")
+        # Reverse so the stack visits subdirectories in listing order.
+        pending.extend(reversed(subdirectories))
+
+
+class Manifest:
+    """The files found by one directory scan, shared by counting, sizing and transfer.
+
+    Entries are packed into a SpooledTemporaryFile, which stays in memory for
+    small trees and moves to disk past SPOOL_SIZE, so a manifest of millions of
+    files takes the same memory as one of a few. The count and total size are
+    kept as entries are added; every iteration reads the entries back in scan
+    order, a block at a time.
+    """
+
+    def __init__(self, directory:str):
+        self.directory = directory
+        self.total_size = 0
+        # Files seen by the scan, including the ones left out of the manifest.
+        self.scanned = 0
+        self._count = 0
+        self._file = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+        self._lock = threading.Lock()
+
+    def add(self, entry:ManifestEntry) -> None:
+        """Append an entry of the scan."""
+        relative_path = os.fsencode(entry.relative_path)
+        with self._lock:
+            self._file.seek(0, os.SEEK_END)
+            self._file.write(RECORD.pack(entry.size, entry.mtime_ns, entry.inode, len(relative_path)) + relative_path)
+            self._count += 1
+            self.total_size += entry.size
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __iter__(self) -> Iterator[ManifestEntry]:
+        root = os.path.join(self.directory, '')
+        buffer = b''
+        offset = 0
+        while True:
+            # Each iteration keeps its own offset, so several can run one after the other or at once.
+            with self._lock:
+                self._file.seek(offset)
+                block = self._file.read(READ_SIZE)
+            if not block:
+                return
+            offset += len(block)
+            buffer += block
+            position = 0
+            while len(buffer) - position >= RECORD.size:
+                size, mtime_ns, inode, length = RECORD.unpack_from(buffer, position)
+                end = position + RECORD.size + length
+                if end > len(buffer):
+                    break
+                relative_path = os.fsdecode(buffer[position + RECORD.size:end])
+                yield ManifestEntry(root + relative_path, relative_path, size, mtime_ns, inode)
+                position = end
+            buffer = buffer[position:]
+
+    def close(self) -> None:
+        """Discard the spooled entries."""
+        self._file.close()
+
+
+def build_manifest(directory:str, exclude_list:list, select:Optional[Callable[[str], bool]]=None) -> Manifest:
+    """Scan a directory into a manifest shared by counting, sizing and upload.
+
+    Args:
+        directory (str): The directory to scan.
+        exclude_list (list): Exclude patterns (see exclude.ExcludeMatcher).
+        select (Callable, optional): Called with the relative path of every file; files it rejects
+            are counted in `scanned` but left out. Defaults to keeping every file.
+
+    Returns:
+        Manifest: The files found under the directory.
+    """
+    manifest = Manifest(directory)
+    for entry in scan_directory(directory, exclude_list):
+        manifest.scanned += 1
+        if select is None or select(entry.relative_path):
+            manifest.add(entry)
+    return manifest
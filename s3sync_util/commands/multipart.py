@@ -1,79 +1,343 @@
+import io
+import os
+import json
+import mmap
+import hashlib
+import threading
+
+from typing import AbstractSet, Dict, Iterator, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor
+
 from botocore.client import BaseClient
+from botocore.exceptions import BotoCoreError, ClientError, ConnectionError as BotoConnectionError
+from s3sync_util.commands.common import multipart_part_size, PART_SIZE
+from s3sync_util.commands.hashing import etag_matches, etag_part_count
+
+STREAM_CHUNK_SIZE = 1024 * 1024  # 1 MB
+UPLOADS_DIR = os.path.join('.s3sync-cache', 'uploads')
+
+class _MemoryviewReader(io.RawIOBase):
+    """A seekable, read-only file object over a memoryview slice, so a part is sent without copying it first."""
+
+    def __init__(self, view: memoryview):
+        self._view = view
+        self._position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        length = min(len(buffer), len(self._view) - self._position)
+        buffer[:length] = self._view[self._position:self._position + length]
+        self._position += length
+        return length
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self._position, io.SEEK_END: len(self._view)}[whence]
+        self._position = max(0, base + offset)
+        return self._position
+
+    def tell(self) -> int:
+        return self._position
+
+    def close(self) -> None:
+        # Drop the slice so the mapping can be closed once every part is sent.
+        self._view.release()
+        super().close()
+
+    def __len__(self) -> int:
+        return len(self._view)
+
 
-def multipart_upload_to_s3(local_file_path: str, s3: BaseClient, bucket_name: str, s3_prefix: str):
+def _upload_record_path(bucket_name: str, s3_key: str, state_dir: Optional[str] = None) -> str:
+    digest = hashlib.sha1(f"{bucket_name}/{s3_key}".encode()).hexdigest()
+    return os.path.join(state_dir or os.getcwd(), UPLOADS_DIR, f"{digest}.json")
+
+
+def _resume_upload(s3: BaseClient, bucket_name: str, s3_key: str, record_path: str, signature: dict) -> Tuple[Optional[str], Dict[int, dict]]:
+    """Return the UploadId and finished parts of an interrupted upload of the same file, if any."""
+    try:
+        with open(record_path) as record_file:
+            record = json.load(record_file)
+    except (IOError, ValueError):
+        return None, {}
+    if record.get('signature') != signature:
+        # The file changed since the upload started; its parts are useless.
+        try:
+            s3.abort_multipart_upload(Bucket=bucket_name, Key=s3_key, UploadId=record['upload_id'])
+        except ClientError:
+            pass
+        return None, {}
+    parts = {}
+    try:
+        paginator = s3.get_paginator('list_parts')
+        for page in paginator.paginate(Bucket=bucket_name, Key=s3_key, UploadId=record['upload_id']):
+            for part in page.get('Parts', []):
+                parts[part['PartNumber']] = {'PartNumber': part['PartNumber'], 'ETag': part['ETag'], 'Size': part['Size']}
+    except ClientError:
+        # The upload was completed or aborted in the meantime.
+        return None, {}
+    return record['upload_id'], parts
+
+
+def multipart_upload_to_s3(local_file_path: str, s3: BaseClient, bucket_name: str, s3_prefix: str, workers: int = 10,
+                           part_size: Optional[int] = None, copy_parts: AbstractSet[int] = frozenset(),
+                           source_etag: Optional[str] = None, state_dir: Optional[str] = None) -> str:
     """
-    Uploads a local file to S3 using multipart upload.
+    Uploads a local file to S3 using a concurrent, resumable multipart upload.
+
+    The file is memory-mapped and each part is sent from a memoryview slice of
+    the mapping. The UploadId is recorded under `.s3sync-cache/uploads` together
+    with the file's size and mtime, so if the process is interrupted the next
+    call for the same file asks S3 for the parts it already has (`list_parts`)
+    and only sends the rest. On any other error the upload is aborted, so no
+    orphaned parts are left behind.
+
+    Parts listed in `copy_parts` are not sent: they are copied with
+    `upload_part_copy` from the same byte range of the object currently at the
+    key, which must still have `source_etag` (see delta.py).
 
     Args:
         local_file_path (str): The path to the local file to be uploaded.
         s3 (BaseClient): An instance of the boto3 S3 client or resource.
         s3_bucket (str): The name of the S3 bucket.
         s3_prefix (str): The prefix to use for S3 object keys.
+        workers (int, optional): Number of parts uploaded concurrently. Defaults to 10.
+        part_size (int, optional): Size of each part. Defaults to the smallest size that keeps the upload within 10,000 parts.
+        copy_parts (AbstractSet[int], optional): Numbers of the parts whose content the current object already has at the same offset.
+        source_etag (str, optional): The ETag the current object must have for its parts to be copied.
+        state_dir (str, optional): The directory whose cache holds the UploadId record. Defaults to the working directory.
+
+    Returns:
+        str: The ETag of the uploaded object.
+
+    Raises:
+        ClientError: PreconditionFailed if parts are copied and the object no longer has `source_etag`.
+    """
+    stat = os.stat(local_file_path)
+    total_size = stat.st_size
+    part_size = part_size or multipart_part_size(total_size)
+    part_count = max(1, -(-total_size // part_size))
+    signature = {'size': total_size, 'mtime_ns': stat.st_mtime_ns, 'part_size': part_size}
+    record_path = _upload_record_path(bucket_name, s3_prefix, state_dir)
+
+    upload_id, parts = _resume_upload(s3, bucket_name, s3_prefix, record_path, signature)
+    if upload_id is None:
+        # Initialize multipart upload
+        response = s3.create_multipart_upload(Bucket=bucket_name, Key=s3_prefix)
+        upload_id = response['UploadId']
+        os.makedirs(os.path.dirname(record_path), exist_ok=True)
+        with open(record_path, 'w') as record_file:
+            json.dump({'bucket': bucket_name, 'key': s3_prefix, 'upload_id': upload_id, 'signature': signature}, record_file)
+
+    def expected_size(part_number):
+        return min(part_size, total_size - (part_number - 1) * part_size)
+
+    try:
+        with open(local_file_path, 'rb') as file:
+            mapping = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(mapping)
+        try:
+            def upload_part(part_number):
+                start = (part_number - 1) * part_size
+                body = _MemoryviewReader(view[start:start + part_size])
+                try:
+                    part_response = s3.upload_part(
+                        Bucket=bucket_name,
+                        Key=s3_prefix,
+                        PartNumber=part_number,
+                        UploadId=upload_id,
+                        Body=body
+                    )
+                finally:
+                    body.close()
+                return {'PartNumber': part_number, 'ETag': part_response['ETag']}
+
+            def copy_part(part_number):
+                start = (part_number - 1) * part_size
+                part_response = s3.upload_part_copy(
+                    Bucket=bucket_name,
+                    Key=s3_prefix,
+                    PartNumber=part_number,
+                    UploadId=upload_id,
+                    CopySource={'Bucket': bucket_name, 'Key': s3_prefix},
+                    CopySourceRange=f"bytes={start}-{start + expected_size(part_number) - 1}",
+                    CopySourceIfMatch=f'"{source_etag}"'
+                )
+                return {'PartNumber': part_number, 'ETag': part_response['CopyPartResult']['ETag']}
+
+            missing_parts = [n for n in range(1, part_count + 1)
+                             if n not in parts or parts[n]['Size'] != expected_size(n)]
+            with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+                for part in executor.map(lambda n: copy_part(n) if n in copy_parts else upload_part(n), missing_parts):
+                    parts[part['PartNumber']] = part
+        finally:
+            view.release()
+            mapping.close()
+
+        # Complete multipart upload
+        response = s3.complete_multipart_upload(
+            Bucket=bucket_name,
+            Key=s3_prefix,
+            UploadId=upload_id,
+            MultipartUpload={'Parts': [{'PartNumber': n, 'ETag': parts[n]['ETag']} for n in range(1, part_count + 1)]}
+        )
+    except (KeyboardInterrupt, BotoConnectionError):
+        # Keep the upload so the next run resumes it.
+        raise
+    except BaseException:
+        try:
+            s3.abort_multipart_upload(Bucket=bucket_name, Key=s3_prefix, UploadId=upload_id)
+        except (BotoCoreError, ClientError) as e:
+            print(f"\nError occurred while aborting the upload of {s3_prefix}: {e}")
+        _remove_upload_record(record_path)
+        raise
+    _remove_upload_record(record_path)
+    return response['ETag'].strip('"')
+
+
+def _remove_upload_record(record_path: str) -> None:
+    try:
+        os.remove(record_path)
+    except FileNotFoundError:
+        pass
+
+
+def abort_multipart_upload(s3: BaseClient, bucket_name: str, s3_key: str, upload_id: str, state_dir: Optional[str] = None) -> None:
     """
+    Aborts a multipart upload and forgets it locally, so it is not resumed.
 
-    # Initialize multipart upload
-    response = s3.create_multipart_upload(Bucket=bucket_name, Key=s3_prefix)
-    upload_id = response['UploadId']
-
-    # Calculate part size
-    part_size = 5 * 1024 * 1024  # 5 MB
-
-    # Prepare parts
-    with open(local_file_path, 'rb') as file:
-        parts = []
-        part_number = 1
-        while True:
-            data = file.read(part_size)
-            if not data:
-                break
-            part_response = s3.upload_part(
-                Bucket=bucket_name,
-                Key=s3_prefix,
-                PartNumber=part_number,
-                UploadId=upload_id,
-                Body=data
-            )
-            parts.append({'PartNumber': part_number, 'ETag': part_response['ETag']})
-            part_number += 1
-
-    # Complete multipart upload
-    s3.complete_multipart_upload(
-        Bucket=bucket_name,
-        Key=s3_prefix,
-        UploadId=upload_id,
-        MultipartUpload={'Parts': parts}
-    )
-
-def multipart_download_from_s3(local_file_path: str, s3: BaseClient, bucket_name: str, s3_prefix: str, total_size: int) -> None:
+    Args:
+        s3 (BaseClient): An instance of the boto3 S3 client.
+        bucket_name (str): The name of the S3 bucket.
+        s3_key (str): The key of the upload.
+        upload_id (str): The UploadId to abort.
+        state_dir (str, optional): The directory whose cache holds the UploadId record. Defaults to the working directory.
     """
-    Downloads an object from S3 using multipart download.
+    s3.abort_multipart_upload(Bucket=bucket_name, Key=s3_key, UploadId=upload_id)
+    record_path = _upload_record_path(bucket_name, s3_key, state_dir)
+    try:
+        with open(record_path) as record_file:
+            if json.load(record_file).get('upload_id') != upload_id:
+                return
+    except (IOError, ValueError):
+        return
+    _remove_upload_record(record_path)
+
+
+def list_multipart_uploads(s3: BaseClient, bucket_name: str, s3_prefix: str) -> Iterator[dict]:
+    """Yield the multipart uploads in progress under a prefix.
+
+    Args:
+        s3 (BaseClient): An instance of the boto3 S3 client.
+        bucket_name (str): The name of the S3 bucket.
+        s3_prefix (str): The prefix to list uploads under.
+
+    Yields:
+        dict: The Key, UploadId and Initiated time of each upload.
+    """
+    paginator = s3.get_paginator('list_multipart_uploads')
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=s3_prefix):
+        yield from page.get('Uploads', [])
+
+
+def _load_download_progress(progress_path: str, etag: str, total_size: int, part_size: int) -> set:
+    """Return the part numbers an interrupted download of the same object already wrote."""
+    try:
+        with open(progress_path) as progress_file:
+            header = json.loads(progress_file.readline())
+            if header != {'etag': etag, 'size': total_size, 'part_size': part_size}:
+                return set()
+            return {int(line) for line in progress_file if line.strip().isdigit()}
+    except (IOError, ValueError):
+        return set()
+
+def multipart_download_from_s3(local_file_path: str, s3: BaseClient, bucket_name: str, s3_prefix: str, total_size: int,
+                               etag: Optional[str] = None, workers: int = 10, part_size: int = PART_SIZE) -> None:
+    """
+    Downloads an object from S3 using concurrent ranged GETs into a preallocated file.
+
+    Parts are streamed in chunks and written at their offsets with os.pwrite, so
+    no part is held in memory as a whole. The data goes to `<path>.s3sync-download`
+    and every finished part is appended to `<path>.s3sync-download.json`; if the
+    download is interrupted, the next call for the same object (same ETag, size
+    and part size) only fetches the missing ranges. The finished file is checked
+    against the object's ETag before it is moved into place.
 
     Args:
         local_file_path (str): The desired path for the downloaded file.
         s3 (BaseClient): An instance of the boto3 S3 client or resource.
         bucket_name (str): The name of the S3 bucket.
         s3_prefix (str): The key of the object to be downloaded.
+        total_size (int): The size of the object in bytes.
+        etag (str, optional): The ETag of the object, used to resume safely and to verify the result.
+        workers (int, optional): Number of parts fetched concurrently. Defaults to 10.
+        part_size (int, optional): Size of each ranged GET in bytes. Defaults to 5 MB.
     """
     if isinstance(s3, BaseClient):
         s3_client = s3
     else:
         raise ValueError("s3 must be an instance of boto3 S3 client or resource")
 
-    # Get object information to determine the total size
-    # response = s3_client.head_object(Bucket=bucket_name, Key=object_key)
-    # total_size = response['ContentLength']
-
-    # Calculate part size
-    part_size = 5 * 1024 * 1024  # 5 MB
-
-    # Download parts
-    with open(local_file_path, 'wb') as file:
-        for part_number in range(1, total_size // part_size + 1):
-            start_byte = (part_number - 1) * part_size
-            end_byte = min(part_number * part_size, total_size) - 1
-            response = s3_client.get_object(
-                Bucket=bucket_name,
-                Key=s3_prefix,
-                Range=f"bytes={start_byte}-{end_byte}"
-            )
-            file.write(response['Body'].read())
\ No newline at end of file
+    etag = etag.strip('"') if etag else None
+    temp_path = f"{local_file_path}.s3sync-download"
+    progress_path = f"{temp_path}.json"
+    part_count = max(1, -(-total_size // part_size))
+    done_parts = _load_download_progress(progress_path, etag, total_size, part_size) if os.path.exists(temp_path) else set()
+    if not done_parts:
+        with open(progress_path, 'w') as progress_file:
+            progress_file.write(json.dumps({'etag': etag, 'size': total_size, 'part_size': part_size}) + "\n")
+
+    fd = os.open(temp_path, os.O_RDWR | os.O_CREAT, 0o644)
+    progress_file = open(progress_path, 'a')
+    progress_lock = threading.Lock()
+    server_side_encryption = []
+
+    def download_part(part_number):
+        start_byte = (part_number - 1) * part_size
+        end_byte = min(part_number * part_size, total_size) - 1
+        kwargs = {'Bucket': bucket_name, 'Key': s3_prefix, 'Range': f"bytes={start_byte}-{end_byte}"}
+        if etag:
+            # Fail instead of mixing ranges from two versions of the object.
+            kwargs['IfMatch'] = f'"{etag}"'
+        response = s3_client.get_object(**kwargs)
+        server_side_encryption.append(response.get('ServerSideEncryption'))
+        offset = start_byte
+        for chunk in response['Body'].iter_chunks(chunk_size=STREAM_CHUNK_SIZE):
+            view = memoryview(chunk)
+            while view:
+                written = os.pwrite(fd, view, offset)
+                offset += written
+                view = view[written:]
+        with progress_lock:
+            progress_file.write(f"{part_number}\n")
+            progress_file.flush()
+
+    try:
+        # Reserve the whole file up front so parts can land at any offset.
+        if hasattr(os, 'posix_fallocate') and total_size:
+            os.posix_fallocate(fd, 0, total_size)
+        else:
+            os.ftruncate(fd, total_size)
+        missing_parts = [n for n in range(1, part_count + 1) if n not in done_parts] if total_size else []
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            for _ in executor.map(download_part, missing_parts):
+                pass
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+        progress_file.close()
+
+    if etag and 'aws:kms' not in server_side_encryption and not etag_matches(temp_path, total_size, etag):
+        if etag_part_count(etag):
+            # The uploader's part size is only inferred, so a mismatch is not conclusive.
+            print(f"\nWarning: could not verify {s3_prefix} against its multipart ETag {etag}.")
+        else:
+            os.remove(temp_path)
+            os.remove(progress_path)
+            raise IOError(f"Downloaded data of {s3_prefix} does not match its ETag {etag}.")
+    os.replace(temp_path, local_file_path)
+    os.remove(progress_path)
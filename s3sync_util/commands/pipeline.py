@@ -0,0 +1,158 @@
+import sys
+import time
+import queue
+import threading
+
+from typing import Any, Callable, Iterable, List, NamedTuple, Optional, Tuple
+
+from s3sync_util.commands.common import format_time
+from s3sync_util.commands.size import format_size
+
+_DONE = object()
+
+
+class ProgressUpdate(NamedTuple):
+    """A snapshot of a job's counters, passed to progress callbacks."""
+    action: str
+    total_files: int
+    transferred_files: int
+    transferred_bytes: int
+    skipped_files: int
+    elapsed: float
+
+
+class Progress:
+    """Thread-safe transfer counters shared by the pipeline workers."""
+
+    def __init__(self, total_files:int, action:str, enabled:bool=False,
+                 callback:Optional[Callable[[ProgressUpdate], None]]=None):
+        """
+        Args:
+            total_files (int): The number of files the job may transfer.
+            action (str): Past-tense verb used in the progress line, e.g. "Uploaded".
+            enabled (bool, optional): Write the progress line to stdout. Defaults to False.
+            callback (Callable, optional): Called with a ProgressUpdate after every transferred or skipped file.
+        """
+        self.total_files = total_files
+        self.action = action
+        self.enabled = enabled
+        self.callback = callback
+        self.transferred_files = 0
+        self.transferred_bytes = 0
+        self.skipped_files = 0
+        self.start_time = time.time()
+        self._lock = threading.Lock()
+
+    def skip(self) -> None:
+        """Record a file that did not need to be transferred."""
+        with self._lock:
+            self.skipped_files += 1
+            update = self._update() if self.callback else None
+        if update:
+            self.callback(update)
+
+    def advance(self, size:int) -> None:
+        """Record a transferred file and refresh the progress line.
+
+        Args:
+            size (int): Number of bytes transferred for the file.
+        """
+        with self._lock:
+            self.transferred_files += 1
+            self.transferred_bytes += size
+            if self.enabled:
+                sys.stdout.write("\r" + self._progress_line())
+                sys.stdout.flush()
+            update = self._update() if self.callback else None
+        if update:
+            self.callback(update)
+
+    def _update(self) -> ProgressUpdate:
+        return ProgressUpdate(self.action, self.total_files, self.transferred_files, self.transferred_bytes,
+                              self.skipped_files, time.time() - self.start_time)
+
+    def _progress_line(self) -> str:
+        pending_files = max(self.total_files - self.skipped_files, 1)
+        progress_percentage = min(self.transferred_files / pending_files, 1) * 100
+        time_elapsed = time.time() - self.start_time
+        if self.transferred_files and time_elapsed > 0:
+            remaining_files = max(pending_files - self.transferred_files, 0)
+            time_remaining = format_time(remaining_files / (self.transferred_files / time_elapsed))
+        else:
+            time_remaining = "N/A"
+        return f"Progress: {progress_percentage:.2f}% | {self.action}: {self.transferred_files}/{self.total_files} | Remaining: {time_remaining}"
+
+    def summary(self) -> str:
+        """Return a one-line throughput summary for the job."""
+        with self._lock:
+            time_elapsed = max(time.time() - self.start_time, 1e-9)
+            files_per_second = self.transferred_files / time_elapsed
+            mb_per_second = self.transferred_bytes / (1024 * 1024) / time_elapsed
+            return (f"{self.action} {self.transferred_files} file(s) ({format_size(self.transferred_bytes)}), "
+                    f"skipped {self.skipped_files} in {format_time(time_elapsed)} | "
+                    f"{files_per_second:.2f} files/s | {mb_per_second:.2f} MB/s")
+
+
+def run_pipeline(source:Iterable[Any], stages:List[Tuple[Callable[[Any], Optional[Any]], int]], queue_size:int=64) -> None:
+    """Push items from `source` through a chain of worker-pool stages.
+
+    Every stage runs its function on its own pool of threads and hands each
+    non-None result to the next stage. Stages are connected by bounded queues,
+    so a fast producer (e.g. the directory walk) blocks instead of buffering
+    the whole job in memory. The first exception raised by any stage stops
+    the pipeline and is re-raised once all workers have finished.
+
+    Args:
+        source (Iterable[Any]): Items fed to the first stage, consumed on the calling thread.
+        stages (List[Tuple[Callable, int]]): (function, number of workers) for each stage, in order.
+        queue_size (int, optional): Capacity of each inter-stage queue. Defaults to 64.
+    """
+    stop = threading.Event()
+    errors = []
+    queues = [queue.Queue(maxsize=queue_size) for _ in stages]
+
+    def worker(func, q_in, q_out):
+        while True:
+            item = q_in.get()
+            if item is _DONE:
+                # Leave the sentinel for the sibling workers of this stage.
+                q_in.put(_DONE)
+                return
+            if stop.is_set():
+                continue
+            try:
+                result = func(item)
+            except BaseException as e:
+                errors.append(e)
+                stop.set()
+                continue
+            if result is not None and q_out is not None:
+                q_out.put(result)
+
+    stage_threads = []
+    for index, (func, workers) in enumerate(stages):
+        q_out = queues[index + 1] if index + 1 < len(queues) else None
+        threads = [threading.Thread(target=worker, args=(func, queues[index], q_out), daemon=True)
+                   for _ in range(max(1, workers))]
+        for thread in threads:
+            thread.start()
+        stage_threads.append(threads)
+
+    try:
+        for item in source:
+            if stop.is_set():
+                break
+            queues[0].put(item)
+    except BaseException:
+        stop.set()
+        raise
+    finally:
+        queues[0].put(_DONE)
+        for index, threads in enumerate(stage_threads):
+            for thread in threads:
+                thread.join()
+            if index + 1 < len(queues):
+                queues[index + 1].put(_DONE)
+
+    if errors:
+        raise errors[0]
@@ -0,0 +1,330 @@
+import os
+import time
+import hashlib
+import sqlite3
+import tempfile
+import threading
+
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, Iterator, List, NamedTuple, Optional
+
+from botocore.client import BaseClient
+from s3sync_util.commands.exclude import ExcludeMatcher, compile_excludes
+
+CACHE_DIR = '.s3sync-cache'
+# Bundles of small files (see bundle.py) live under this directory of a prefix.
+BUNDLE_DIR = '.s3sync-bundles'
+# Rows read per query while iterating; the only part of an index held in memory.
+PAGE_SIZE = 1000
+
+
+class RemoteObject(NamedTuple):
+    """An S3 object as seen by a single listing."""
+    key: str
+    size: int
+    etag: str
+    last_modified: datetime
+
+
+class RemoteIndex:
+    """Every object under a bucket prefix, listed once and shared by all stages of a job.
+
+    Entries are kept in an SQLite database under `.s3sync-cache` rather than
+    in memory, so the memory of a job does not grow with the number of
+    objects: lookups go through the primary key, and iteration reads the
+    rows in key order a page at a time. The database is also the persisted
+    listing, reused by later runs until it is older than their TTL.
+    """
+
+    def __init__(self, bucket:str, prefix:str, listed_at:Optional[float]=None, excludes:tuple=(), db_path:Optional[str]=None,
+                 state_dir:Optional[str]=None):
+        self.bucket = bucket
+        self.prefix = prefix
+        # The directory whose cache holds the index; the working directory by default.
+        self.state_dir = state_dir
+        # The patterns the listing was pruned with; a cached index is only reused with the same ones.
+        self.excludes = tuple(excludes)
+        self.listed_at = listed_at if listed_at is not None else time.time()
+        self._saved = db_path is not None
+        if db_path is None:
+            # A new listing is written next to the cache file and moved over it by save().
+            cache_dir = os.path.dirname(self.cache_path(bucket, prefix, self.excludes, state_dir))
+            os.makedirs(cache_dir, exist_ok=True)
+            handle, db_path = tempfile.mkstemp(suffix='.tmp', dir=cache_dir)
+            os.close(handle)
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._count: Optional[int] = None
+        self._conn = self._connect()
+        with self._lock:
+            self._conn.execute("CREATE TABLE IF NOT EXISTS objects (key TEXT PRIMARY KEY, size INTEGER NOT NULL, "
+                               "etag TEXT NOT NULL, last_modified REAL NOT NULL) WITHOUT ROWID")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value)")
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        # A cache that is rebuilt when lost: no journal, no fsync, and a bounded page cache.
+        conn.execute("PRAGMA journal_mode=OFF")
+        conn.execute("PRAGMA synchronous=OFF")
+        conn.execute("PRAGMA cache_size=-8192")
+        return conn
+
+    def add_page(self, contents:Iterable[dict]) -> None:
+        """Store the entries of one `list_objects_v2` page."""
+        rows = []
+        for obj in contents:
+            last_modified = obj.get('LastModified')
+            rows.append((obj['Key'], obj['Size'], obj.get('ETag', '').strip('"'),
+                         last_modified.timestamp() if last_modified else 0.0))
+        with self._lock:
+            self._conn.executemany("INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?)", rows)
+            self._conn.commit()
+            self._count = None
+
+    def put(self, key:str, size:int, etag:str, last_modified:Optional[float]=None) -> None:
+        """Record an object written by this job, so a cached index stays current without listing again.
+
+        Args:
+            key (str): The key of the object.
+            size (int): Its size in bytes.
+            etag (str): Its ETag, with or without quotes.
+            last_modified (float, optional): Its modification time as a timestamp. Defaults to now.
+        """
+        row = (key, size, etag.strip('"'), time.time() if last_modified is None else last_modified)
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?)", row)
+            self._conn.commit()
+            self._count = None
+
+    def delete(self, keys:Iterable[str]) -> None:
+        """Forget objects deleted by this job."""
+        with self._lock:
+            self._conn.executemany("DELETE FROM objects WHERE key = ?", ((key,) for key in keys))
+            self._conn.commit()
+            self._count = None
+
+    def __len__(self) -> int:
+        with self._lock:
+            if self._count is None:
+                self._count = self._conn.execute("SELECT COUNT(*) FROM objects").fetchone()[0]
+            return self._count
+
+    def __iter__(self) -> Iterator[RemoteObject]:
+        return self.scan()
+
+    def scan(self, start:str='') -> Iterator[RemoteObject]:
+        """Yield the objects whose key is `start` or sorts after it, in key order."""
+        for row in self._rows("key, size, etag, last_modified", start):
+            yield self._object(row)
+
+    def sizes(self) -> Iterator[int]:
+        """Yield the size of every object."""
+        for _, size in self._rows("key, size"):
+            yield size
+
+    def _rows(self, columns:str, start:str='') -> Iterator[tuple]:
+        # Each page resumes after the last key of the previous one, so no cursor is
+        # held open between pages and other threads can use the connection meanwhile.
+        with self._lock:
+            rows = self._conn.execute(f"SELECT {columns} FROM objects WHERE key >= ? ORDER BY key LIMIT ?",
+                                      (start, PAGE_SIZE)).fetchall()
+        while rows:
+            yield from rows
+            if len(rows) < PAGE_SIZE:
+                return
+            with self._lock:
+                rows = self._conn.execute(f"SELECT {columns} FROM objects WHERE key > ? ORDER BY key LIMIT ?",
+                                          (rows[-1][0], PAGE_SIZE)).fetchall()
+
+    @staticmethod
+    def _object(row:tuple) -> RemoteObject:
+        key, size, etag, last_modified = row
+        return RemoteObject(key, size, etag, datetime.fromtimestamp(last_modified, timezone.utc))
+
+    def get(self, key:str) -> Optional[RemoteObject]:
+        """Return the object with the given key, or None."""
+        with self._lock:
+            row = self._conn.execute("SELECT key, size, etag, last_modified FROM objects WHERE key = ?", (key,)).fetchone()
+        return None if row is None else self._object(row)
+
+    def find_by_etag(self, etag:str, size:int) -> Optional[RemoteObject]:
+        """Return an object with the given ETag and size, or None."""
+        with self._lock:
+            # Built on first use and kept in the cached database.
+            self._conn.execute("CREATE INDEX IF NOT EXISTS objects_etag ON objects(etag, size)")
+            row = self._conn.execute("SELECT key, size, etag, last_modified FROM objects WHERE etag = ? AND size = ? LIMIT 1",
+                                     (etag, size)).fetchone()
+        return None if row is None else self._object(row)
+
+    def total_size(self, exclude_list:Optional[list]=None) -> int:
+        """Return the total size of the indexed objects, skipping excluded keys."""
+        excludes = compile_excludes(exclude_list)
+        if not excludes:
+            with self._lock:
+                return self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM objects").fetchone()[0]
+        return sum(size for key, size in self._rows("key, size") if not excludes.excludes_key(key, self.prefix))
+
+    def age(self) -> float:
+        """Return the number of seconds since the prefix was listed."""
+        return time.time() - self.listed_at
+
+    @staticmethod
+    def cache_path(bucket:str, prefix:str, excludes:tuple=(), state_dir:Optional[str]=None) -> str:
+        """Return where the index of a bucket prefix, listed with the given exclude patterns, is persisted."""
+        digest = hashlib.sha1("\0".join((f"{bucket}/{prefix}",) + tuple(excludes)).encode()).hexdigest()
+        return os.path.join(state_dir or os.getcwd(), CACHE_DIR, f"{digest}.db")
+
+    def save(self) -> None:
+        """Persist the index to the local cache, replacing the one cached before."""
+        if self._saved:
+            return
+        path = self.cache_path(self.bucket, self.prefix, self.excludes, self.state_dir)
+        with self._lock:
+            try:
+                self._conn.executemany("INSERT OR REPLACE INTO meta VALUES (?, ?)",
+                                       [('bucket', self.bucket), ('prefix', self.prefix), ('listed_at', self.listed_at)])
+                self._conn.commit()
+                # Reopened afterwards, since an open database cannot be moved everywhere.
+                self._conn.close()
+                os.replace(self.db_path, path)
+                self.db_path = path
+                self._saved = True
+            except (OSError, sqlite3.Error) as e:
+                print(f"Error occurred while saving the remote index: {e}")
+            finally:
+                self._conn = self._connect()
+
+    def close(self) -> None:
+        """Release the database, deleting it if it was never saved."""
+        with self._lock:
+            self._conn.close()
+            if not self._saved:
+                try:
+                    os.remove(self.db_path)
+                except OSError:
+                    pass
+
+    @classmethod
+    def load_cached(cls, bucket:str, prefix:str, excludes:tuple=(), state_dir:Optional[str]=None) -> Optional['RemoteIndex']:
+        """Open a persisted index, or return None if there is no usable one."""
+        path = cls.cache_path(bucket, prefix, excludes, state_dir)
+        if not os.path.exists(path):
+            return None
+        try:
+            conn = sqlite3.connect(path)
+            try:
+                meta = dict(conn.execute("SELECT name, value FROM meta"))
+            finally:
+                conn.close()
+        except sqlite3.Error as e:
+            print(f"Error occurred while loading the remote index: {e}")
+            return None
+        if meta.get('bucket') != bucket or meta.get('prefix') != prefix or 'listed_at' not in meta:
+            return None
+        return cls(bucket, prefix, float(meta['listed_at']), excludes, db_path=path, state_dir=state_dir)
+
+
+def _list_prefix(s3:BaseClient, bucket:str, prefix:str, on_page:Callable[[List[dict]], None],
+                 delimiter:Optional[str]=None) -> List[str]:
+    """List a prefix, handing the objects of each page to `on_page`, and return the common prefixes found."""
+    paginator = s3.get_paginator('list_objects_v2')
+    kwargs = {'Bucket': bucket, 'Prefix': prefix}
+    if delimiter:
+        kwargs['Delimiter'] = delimiter
+    common_prefixes = []
+    for page in paginator.paginate(**kwargs):
+        on_page(page.get('Contents', []))
+        common_prefixes.extend(p['Prefix'] for p in page.get('CommonPrefixes', []))
+    return common_prefixes
+
+
+def list_remote_index(s3:BaseClient, bucket:str, prefix:str, workers:int=1, exclude_list:Optional[list]=None,
+                      state_dir:Optional[str]=None) -> RemoteIndex:
+    """List every object under a prefix, following all pages.
+
+    With more than one worker, or with exclude patterns, the levels below the
+    prefix are listed with a '/' delimiter and each sub-prefix found is then
+    listed on its own thread. Sub-prefixes of excluded directories are dropped
+    before they are listed, and excluded keys found deeper are left out of the index.
+    Every page goes into the index as it arrives, so no listing is held in memory.
+
+    Args:
+        s3 (BaseClient): The S3 client to list with.
+        bucket (str): The name of the S3 bucket.
+        prefix (str): The prefix to list.
+        workers (int, optional): Number of concurrent listings. Defaults to 1.
+        exclude_list (list, optional): Exclude patterns (see exclude.ExcludeMatcher).
+        state_dir (str, optional): The directory whose cache holds the index. Defaults to the working directory.
+
+    Returns:
+        RemoteIndex: The listed objects, sorted by key.
+    """
+    excludes = compile_excludes(exclude_list)
+    index = RemoteIndex(bucket, prefix, excludes=excludes.patterns, state_dir=state_dir)
+    try:
+        _fill_index(s3, index, workers, excludes)
+    except BaseException:
+        index.close()
+        raise
+    return index
+
+
+def _fill_index(s3:BaseClient, index:RemoteIndex, workers:int, excludes:ExcludeMatcher) -> None:
+    """List the prefix of an empty index into it (see list_remote_index)."""
+    bucket, prefix = index.bucket, index.prefix
+    if workers <= 1 and not excludes:
+        _list_prefix(s3, bucket, prefix, index.add_page)
+        return
+
+    # Bundles hold the excluded-or-not decision for each of their members, so they are never pruned.
+    bundles = os.path.join(prefix, BUNDLE_DIR, '')
+
+    def excluded(key):
+        return not key.startswith(bundles) and excludes.excludes_key(key, prefix)
+
+    def pruned(sub_prefixes):
+        return [sub_prefix for sub_prefix in sub_prefixes if not excluded(sub_prefix)]
+
+    def add_page(contents):
+        index.add_page(obj for obj in contents if not excluded(obj['Key']))
+
+    sub_prefixes = pruned(_list_prefix(s3, bucket, prefix, add_page, delimiter='/'))
+    # Fan out another level while there are too few sub-prefixes to keep the workers busy.
+    for _ in range(2):
+        if not 0 < len(sub_prefixes) < workers:
+            break
+        expanded = []
+        for sub_prefix in sub_prefixes:
+            expanded.extend(pruned(_list_prefix(s3, bucket, sub_prefix, add_page, delimiter='/')))
+        sub_prefixes = expanded
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        for _ in executor.map(lambda sub_prefix: _list_prefix(s3, bucket, sub_prefix, add_page), sub_prefixes):
+            pass
+
+
+def get_remote_index(s3:BaseClient, bucket:str, prefix:str, ttl:float=0, workers:int=1, exclude_list:Optional[list]=None,
+                     state_dir:Optional[str]=None) -> RemoteIndex:
+    """Return the index of a prefix, reusing the cached one while it is younger than `ttl`.
+
+    Args:
+        s3 (BaseClient): The S3 client to list with.
+        bucket (str): The name of the S3 bucket.
+        prefix (str): The prefix to index.
+        ttl (float, optional): Maximum age in seconds of a cached index. 0 always lists again. Defaults to 0.
+        workers (int, optional): Number of concurrent listings. Defaults to 1.
+        exclude_list (list, optional): Exclude patterns; excluded subtrees are not listed.
+        state_dir (str, optional): The directory whose cache holds the index. Defaults to the working directory.
+
+    Returns:
+        RemoteIndex: The index of the prefix.
+    """
+    if ttl > 0:
+        index = RemoteIndex.load_cached(bucket, prefix, compile_excludes(exclude_list).patterns, state_dir)
+        if index is not None:
+            if index.age() < ttl:
+                return index
+            index.close()
+    index = list_remote_index(s3, bucket, prefix, workers, exclude_list, state_dir)
+    index.save()
+    return index
@@ -0,0 +1,205 @@
+import os
+import re
+import sys
+import json
+import glob
+import hashlib
+
+from typing import List, NamedTuple, Optional, Union
+
+from s3sync_util.commands.exclude import to_posix
+from s3sync_util.commands.state_store import BACKENDS, STATE_DB, STATE_JSON, JsonStateStore, SQLiteStateStore, open_state_store
+
+SUMMARY_FILE = '.s3sync-summary.json'
+# Shard files carry the shard between the name and the extension, e.g. .state.2-of-8.db.
+SHARD_FILE = re.compile(r'\.(\d+)-of-(\d+)(\.[^.]+)$')
+
+
+class Shard(NamedTuple):
+    """One of `count` disjoint parts of a job, numbered from 1.
+
+    A file belongs to the shard picked by a hash of its path relative to the
+    directory (or of its key relative to the prefix, which is the same
+    path), so every host running the same job with a different shard index
+    gets a disjoint part of it without coordinating, and each file stays in
+    the same shard on every run.
+    """
+    index: int
+    count: int
+
+    def __str__(self) -> str:
+        return f"{self.index}/{self.count}"
+
+    def owns(self, relative_path:str) -> bool:
+        """Whether a file, by its path relative to the synced directory or prefix, belongs to this shard."""
+        return shard_index(relative_path, self.count) == self.index
+
+    def file_name(self, name:str) -> str:
+        """Return the name of this shard's copy of a state or summary file, e.g. .state.db -> .state.2-of-8.db."""
+        base, extension = os.path.splitext(name)
+        return f"{base}.{self.index}-of-{self.count}{extension}"
+
+
+def shard_index(relative_path:str, count:int) -> int:
+    """Return the shard (1 to `count`) a relative path belongs to.
+
+    The hash is BLAKE2b of the POSIX form of the path, which unlike hash()
+    is the same in every process, Python version and platform.
+    """
+    digest = hashlib.blake2b(to_posix(relative_path).encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big') % count + 1
+
+
+def parse_shard(value:Union[str, Shard, None]) -> Optional[Shard]:
+    """Parse a shard given as 'I/N', e.g. '2/8' for the second of eight shards.
+
+    Args:
+        value (str): The shard, a Shard, or None.
+
+    Returns:
+        Shard: The shard, or None if `value` is None.
+    """
+    if value is None or isinstance(value, Shard):
+        return value
+    index, separator, count = value.partition('/')
+    try:
+        shard = Shard(int(index), int(count))
+    except ValueError:
+        shard = None
+    if not separator or shard is None or not 1 <= shard.index <= shard.count:
+        raise ValueError(f"invalid shard '{value}', expected I/N with 1 <= I <= N, e.g. 2/8")
+    return shard
+
+
+def shard_of_file(path:str) -> Optional[Shard]:
+    """Return the shard a state or summary file was written by, from its name, or None."""
+    match = SHARD_FILE.search(os.path.basename(path))
+    if not match or not 1 <= int(match.group(1)) <= int(match.group(2)):
+        return None
+    return Shard(int(match.group(1)), int(match.group(2)))
+
+
+def write_summary(summary:dict, shard:Shard, directory:Optional[str]=None) -> str:
+    """Write the summary of a shard's job next to its state, for `s3sync state merge`.
+
+    Args:
+        summary (dict): The metrics of the job (see stats.TransferStats.to_dict).
+        shard (Shard): The shard the job ran.
+        directory (str, optional): Where the state files live. Defaults to the current working directory.
+
+    Returns:
+        str: The path of the summary file.
+    """
+    path = os.path.join(directory or os.getcwd(), shard.file_name(SUMMARY_FILE))
+    temp_path = f"{path}.tmp"
+    try:
+        with open(temp_path, 'w') as summary_file:
+            json.dump(dict(summary, shard=str(shard)), summary_file, indent=2)
+        os.replace(temp_path, path)
+    except IOError as e:
+        print(f"Error occurred while writing the shard summary: {e}")
+    return path
+
+
+def merge_summaries(summaries:List[dict]) -> dict:
+    """Combine the summaries of the shards of a job into the summary of the whole job.
+
+    Counters are added up; the duration runs from the first shard's start to
+    the last shard's end, so the throughput is that of all hosts together.
+    """
+    started_at = min(summary['started_at'] for summary in summaries)
+    finished_at = max(summary['started_at'] + summary['duration_s'] for summary in summaries)
+    duration = finished_at - started_at
+    merged = {'command': '+'.join(sorted({summary.get('command', '') for summary in summaries})),
+              'shards': sorted((summary.get('shard') for summary in summaries if summary.get('shard')),
+                               key=lambda label: tuple(int(part) for part in label.split('/'))),
+              'started_at': started_at, 'duration_s': round(duration, 3)}
+    for field in ('files', 'bytes', 'skipped', 'deleted', 'requests_total'):
+        merged[field] = sum(summary.get(field, 0) for summary in summaries)
+    merged['throughput_bytes_per_s'] = round(merged['bytes'] / duration, 1) if duration > 0 else 0.0
+
+    phases = {}
+    apis = {}
+    for summary in summaries:
+        for name, phase in summary.get('phases', {}).items():
+            total = phases.setdefault(name, {'seconds': 0.0, 'count': 0})
+            total['seconds'] = round(total['seconds'] + phase['seconds'], 3)
+            total['count'] += phase['count']
+        for name, api in summary.get('apis', {}).items():
+            total = apis.setdefault(name, {'requests': 0, 'errors': 0, 'retries': 0, 'throttles': 0, 'bytes_sent': 0,
+                                           'bytes_received': 0, 'latency': {'count': 0, 'sum_s': 0.0, 'mean_s': 0.0, 'buckets': {}}})
+            for field in ('requests', 'errors', 'retries', 'throttles', 'bytes_sent', 'bytes_received'):
+                total[field] += api.get(field, 0)
+            latency = total['latency']
+            latency['count'] += api['latency']['count']
+            latency['sum_s'] = round(latency['sum_s'] + api['latency']['sum_s'], 6)
+            latency['mean_s'] = round(latency['sum_s'] / latency['count'], 6) if latency['count'] else 0.0
+            for bound, count in api['latency']['buckets'].items():
+                latency['buckets'][bound] = latency['buckets'].get(bound, 0) + count
+    merged['phases'] = phases
+    merged['apis'] = dict(sorted(apis.items()))
+    return merged
+
+
+def merge_shards(paths:Optional[List[str]]=None, backend:str='sqlite') -> int:
+    """Merge the state and summary files of the shards of a job into the state of the current working directory.
+
+    Shards own disjoint paths, so their records are copied as they are. Files
+    are merged oldest first, so if a path is in several of them (the shard
+    count changed between runs) the most recent record wins. The summaries
+    found next to the state files are combined into `.s3sync-summary.json`.
+
+    Args:
+        paths (List[str], optional): The shard state files. Defaults to every shard state file of `backend` in the working directory.
+        backend (str, optional): The backend of the merged state, 'sqlite' or 'json'. Defaults to 'sqlite'.
+
+    Returns:
+        int: The number of records merged.
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown state backend '{backend}', expected one of: {', '.join(BACKENDS)}")
+    if not paths:
+        base, extension = os.path.splitext(STATE_DB if backend == 'sqlite' else STATE_JSON)
+        paths = glob.glob(os.path.join(os.getcwd(), f"{glob.escape(base)}.*-of-*{extension}"))
+    missing = [path for path in paths if not os.path.exists(path)]
+    if missing or not paths:
+        print(f"Error: {', '.join(missing) if missing else 'no shard state files'} found.")
+        sys.exit(1)
+
+    paths = sorted(paths, key=os.path.getmtime)
+    shards = {}
+    summaries = []
+    count = 0
+    with open_state_store(backend) as target:
+        for path in paths:
+            shard = shard_of_file(path)
+            source = JsonStateStore(path) if path.endswith('.json') else SQLiteStateStore(path)
+            with source:
+                for relative_path, record in source.items():
+                    target.put(relative_path, record)
+                    count += 1
+            if shard is None:
+                continue
+            shards.setdefault(shard.count, set()).add(shard.index)
+            summary_path = os.path.join(os.path.dirname(path), shard.file_name(SUMMARY_FILE))
+            if os.path.exists(summary_path):
+                with open(summary_path) as summary_file:
+                    summaries.append(json.load(summary_file))
+
+    target_name = STATE_DB if backend == 'sqlite' else STATE_JSON
+    print(f"Merged {count} record(s) from {len(paths)} shard state file(s) into {target_name}.")
+    if len(shards) > 1:
+        print(f"Warning: the state files come from jobs split into {', '.join(map(str, sorted(shards)))} shards.")
+    for shard_count, indexes in sorted(shards.items()):
+        absent = [f"{index}/{shard_count}" for index in range(1, shard_count + 1) if index not in indexes]
+        if absent:
+            print(f"Warning: no state for shard(s) {', '.join(absent)}; the merged state is incomplete.")
+    if summaries:
+        merged = merge_summaries(summaries)
+        try:
+            with open(os.path.join(os.getcwd(), SUMMARY_FILE), 'w') as summary_file:
+                json.dump(merged, summary_file, indent=2)
+        except IOError as e:
+            print(f"Error occurred while writing the summary: {e}")
+        print(json.dumps(merged, indent=2))
+    return count
@@ -1,47 +1,50 @@
-import os
 import boto3
+
+from typing import Optional
 from botocore.exceptions import BotoCoreError, NoCredentialsError
+from s3sync_util.commands.common import iter_s3_objects
+from s3sync_util.commands.exclude import compile_excludes
+from s3sync_util.commands.manifest import Manifest, scan_directory
+from s3sync_util.commands.remote_index import RemoteIndex
 
-def get_total_upload_size(directory:str, exclude_list:list) -> int:
+def get_total_upload_size(directory:str, exclude_list:list, manifest:Optional[Manifest]=None) -> int:
     """Calculate the total size of files in a directory for upload, excluding specified files.
 
     Args:
         directory (str): The directory to calculate the upload size for.
         exclude_list (list): List of items to exclude from the upload size calculation.
+        manifest (Manifest, optional): An existing scan of the directory to sum instead of walking it again.
 
     Returns:
         int: Total size of files in bytes.
     """
-    total_size: int = 0
-
-    for root, dirs, files in os.walk(directory):
-        dirs[:] = [d for d in dirs if d not in exclude_list]
-        for file in files:
-            if file not in exclude_list:
-                file_path = os.path.join(root, file)
-                total_size += os.path.getsize(file_path)
+    if manifest is not None:
+        return manifest.total_size
+    return sum(entry.size for entry in scan_directory(directory, exclude_list))
 
-    return total_size
-
-def get_total_download_size(s3_bucket:str, s3_prefix:str, exclude_list:list) -> int:
+def get_total_download_size(s3_bucket:str, s3_prefix:str, exclude_list:list, index:Optional[RemoteIndex]=None) -> int:
     """Calculate the total size of objects to be downloaded from an S3 bucket and prefix.
 
     Args:
         s3_bucket (str): The name of the S3 bucket.
         s3_prefix (str): The prefix to filter S3 objects.
-        exclude_list (list): List of items to exclude.
+        exclude_list (list): Exclude patterns (see exclude.ExcludeMatcher).
+        index (RemoteIndex, optional): An existing listing of the prefix to sum instead of listing it again.
 
     Returns:
         int: Total size of objects in bytes.
     """
+    if index is not None:
+        return index.total_size(exclude_list)
+
     total_size: int = 0
 
+    excludes = compile_excludes(exclude_list)
     try:
         s3 = boto3.client('s3')
-        response = s3.list_objects_v2(Bucket=s3_bucket, Prefix=s3_prefix)
-        for obj in response.get('Contents', []):
+        for obj in iter_s3_objects(s3, s3_bucket, s3_prefix):
             s3_key = obj['Key']
-            if not any(item in s3_key for item in exclude_list):
+            if not excludes.excludes_key(s3_key, s3_prefix):
                 total_size += obj['Size']
     except (BotoCoreError, NoCredentialsError) as e:
         print(f"Error occurred: {e}")
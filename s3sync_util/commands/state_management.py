@@ -2,12 +2,14 @@ import os
 import json
 import hashlib
 
-def calculate_checksum(file_path:str, block_size:int=4096) -> str:
+from typing import Optional
+
+def calculate_checksum(file_path:str, block_size:int=8 * 1024 * 1024) -> str:
     """Calculate the MD5 checksum of a file.
 
     Args:
         file_path (str): The path to the file.
-        block_size (int, optional): Size of data blocks for checksum calculation. Default is 8192 bytes.
+        block_size (int, optional): Size of data blocks for checksum calculation. Default is 8 MB.
 
     Returns:
         str: The MD5 checksum of the file.
@@ -18,14 +20,67 @@ def calculate_checksum(file_path:str, block_size:int=4096) -> str:
             checksum.update(block)
     return checksum.hexdigest()
 
-def load_state() -> dict:
+def file_signature(stat:os.stat_result) -> dict:
+    """Return the stat fields used to tell whether a file changed since it was synced.
+
+    Args:
+        stat (os.stat_result): The stat of the local file, or any object with the
+            same `st_size`, `st_mtime_ns` and `st_ino` attributes.
+
+    Returns:
+        dict: The size, mtime_ns and inode of the file.
+    """
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'inode': stat.st_ino}
+
+def signature_matches(record:Optional[dict], size:int, mtime_ns:int, inode:int) -> bool:
+    """Check whether a state record still describes the file on disk.
+
+    Args:
+        record (dict, optional): The state record of the file's relative path.
+        size (int): The current size of the file.
+        mtime_ns (int): The current modification time of the file in nanoseconds.
+        inode (int): The current inode number of the file.
+
+    Returns:
+        bool: True if size, mtime_ns and inode are all unchanged.
+    """
+    if not record:
+        return False
+    return (record.get('size') == size and record.get('mtime_ns') == mtime_ns
+            and record.get('inode') == inode)
+
+def pop_legacy_record(state:dict, digest:str, local_path:str) -> Optional[dict]:
+    """Remove and return a record written by releases that keyed state by checksum/ETag.
+
+    Such records are only trusted when they were written for the same local path;
+    otherwise identical files at different paths would shadow each other.
+
+    Args:
+        state (dict): The loaded state.
+        digest (str): The MD5 checksum or ETag the old record would be keyed by.
+        local_path (str): The local path the old record must refer to.
+
+    Returns:
+        dict: The legacy record, or None if there is no matching one.
+    """
+    record = state.get(digest)
+    if isinstance(record, dict) and record.get('file') == local_path:
+        return state.pop(digest)
+    return None
+
+def load_state(state_file_path:Optional[str]=None) -> dict:
     """
     Load the state from a JSON file.
 
+    The state is keyed by the file's path relative to the synced directory.
+
+    Args:
+        state_file_path (str, optional): The JSON file to load. Defaults to `.state.json` in the current working directory.
+
     Returns:
         dict: The loaded state as a dictionary. If the file doesn't exist, an empty dictionary is returned.
     """
-    state_file_path = os.path.join(os.getcwd(), '.state.json')
+    state_file_path = state_file_path or os.path.join(os.getcwd(), '.state.json')
     try:
         if os.path.exists(state_file_path):
             with open(state_file_path, 'r') as state_file:
@@ -46,6 +101,6 @@ def save_state(state:dict) -> None:
     state_file_path = os.path.join(os.getcwd(), '.state.json')
     try:
         with open(state_file_path, 'w') as state_file:
-            json.dump(state, state_file, indent=4)
+            json.dump(state, state_file, separators=(',', ':'))
     except IOError as e:
         print(f"Error occurred while saving state: {e}")
\ No newline at end of file
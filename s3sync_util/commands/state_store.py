@@ -0,0 +1,333 @@
+import os
+import sys
+import json
+import time
+import sqlite3
+import threading
+
+from typing import TYPE_CHECKING, Iterator, Optional, Tuple
+
+from s3sync_util.commands.state_management import load_state, pop_legacy_record
+
+if TYPE_CHECKING:
+    from s3sync_util.commands.shard import Shard
+
+STATE_DB = '.state.db'
+STATE_JSON = '.state.json'
+BACKENDS = ('sqlite', 'json')
+# Records read per query by SQLiteStateStore.items().
+PAGE_SIZE = 1000
+
+
+class StateStore:
+    """Base class of the sync state backends.
+
+    Records are keyed by the file's path relative to the synced directory.
+    Writes are committed in batches while a transfer runs (every `commit_every`
+    records or `commit_interval` seconds), so an interrupted run keeps the
+    progress it made and the next run resumes from there. All methods are
+    safe to call from several worker threads.
+    """
+
+    def __init__(self, commit_every:int=1000, commit_interval:float=5.0):
+        self.commit_every = commit_every
+        self.commit_interval = commit_interval
+        self._lock = threading.RLock()
+        self._pending = 0
+        self._last_commit = time.monotonic()
+
+    def get(self, path:str) -> Optional[dict]:
+        """Return the record of a relative path, or None."""
+        with self._lock:
+            return self._get(path)
+
+    def put(self, path:str, record:dict) -> None:
+        """Store the record of a relative path, committing if a checkpoint is due."""
+        with self._lock:
+            self._put(path, record)
+            self._pending += 1
+            if self._pending >= self.commit_every or time.monotonic() - self._last_commit >= self.commit_interval:
+                self.commit()
+
+    def delete(self, path:str) -> None:
+        """Remove the record of a relative path, if any."""
+        with self._lock:
+            self._delete(path)
+            self._pending += 1
+
+    def find_by_checksum(self, checksum:str) -> Optional[Tuple[str, dict]]:
+        """Return a (path, record) pair whose MD5 checksum matches, or None."""
+        with self._lock:
+            return self._find('checksum', checksum)
+
+    def find_by_etag(self, etag:str) -> Optional[Tuple[str, dict]]:
+        """Return a (path, record) pair whose ETag matches, or None."""
+        with self._lock:
+            return self._find('etag', etag)
+
+    def pop_legacy(self, digest:str, local_path:str) -> Optional[dict]:
+        """Remove and return a record from a checksum-keyed state file that refers to `local_path`."""
+        with self._lock:
+            return self._pop_legacy(digest, local_path)
+
+    def items(self) -> Iterator[Tuple[str, dict]]:
+        """Yield every (path, record) pair."""
+        with self._lock:
+            items = list(self._items())
+        yield from items
+
+    def commit(self) -> None:
+        """Persist all pending writes."""
+        with self._lock:
+            self._commit()
+            self._pending = 0
+            self._last_commit = time.monotonic()
+
+    def close(self) -> None:
+        """Commit pending writes and release the backend."""
+        with self._lock:
+            self.commit()
+            self._close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _get(self, path):
+        raise NotImplementedError
+
+    def _put(self, path, record):
+        raise NotImplementedError
+
+    def _delete(self, path):
+        raise NotImplementedError
+
+    def _find(self, field, value):
+        raise NotImplementedError
+
+    def _pop_legacy(self, digest, local_path):
+        raise NotImplementedError
+
+    def _items(self):
+        raise NotImplementedError
+
+    def _commit(self):
+        raise NotImplementedError
+
+    def _close(self):
+        pass
+
+
+class SQLiteStateStore(StateStore):
+    """State kept in an SQLite database in WAL mode, indexed by path, checksum and ETag."""
+
+    def __init__(self, db_path:str, **kwargs):
+        super().__init__(**kwargs)
+        self.db_path = db_path
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level='DEFERRED')
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                checksum TEXT,
+                etag TEXT,
+                record TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS files_checksum ON files(checksum);
+            CREATE INDEX IF NOT EXISTS files_etag ON files(etag);
+            CREATE TABLE IF NOT EXISTS legacy (
+                digest TEXT NOT NULL,
+                file TEXT NOT NULL,
+                record TEXT NOT NULL,
+                PRIMARY KEY (digest, file)
+            );
+        """)
+
+    def _get(self, path):
+        row = self._conn.execute("SELECT record FROM files WHERE path = ?", (path,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _put(self, path, record):
+        self._conn.execute("INSERT OR REPLACE INTO files (path, checksum, etag, record) VALUES (?, ?, ?, ?)",
+                           (path, record.get('checksum'), record.get('etag'), json.dumps(record, separators=(',', ':'))))
+
+    def _delete(self, path):
+        self._conn.execute("DELETE FROM files WHERE path = ?", (path,))
+
+    def _find(self, field, value):
+        row = self._conn.execute(f"SELECT path, record FROM files WHERE {field} = ? LIMIT 1", (value,)).fetchone()
+        return (row[0], json.loads(row[1])) if row else None
+
+    def _pop_legacy(self, digest, local_path):
+        row = self._conn.execute("SELECT record FROM legacy WHERE digest = ? AND file = ?", (digest, local_path)).fetchone()
+        if not row:
+            return None
+        self._conn.execute("DELETE FROM legacy WHERE digest = ? AND file = ?", (digest, local_path))
+        return json.loads(row[0])
+
+    def items(self) -> Iterator[Tuple[str, dict]]:
+        """Yield every (path, record) pair in path order, reading PAGE_SIZE records at a time."""
+        last_path = ''
+        while True:
+            with self._lock:
+                rows = self._conn.execute("SELECT path, record FROM files WHERE path > ? ORDER BY path LIMIT ?",
+                                          (last_path, PAGE_SIZE)).fetchall()
+            for path, record in rows:
+                yield path, json.loads(record)
+            if len(rows) < PAGE_SIZE:
+                return
+            last_path = rows[-1][0]
+
+    def _commit(self):
+        self._conn.commit()
+
+    def _close(self):
+        self._conn.close()
+
+    def import_legacy(self, digest:str, record:dict) -> None:
+        """Store a record from a checksum-keyed state file until its path is synced again."""
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO legacy (digest, file, record) VALUES (?, ?, ?)",
+                               (digest, record['file'], json.dumps(record, separators=(',', ':'))))
+
+
+class JsonStateStore(StateStore):
+    """State kept in memory and written to a single JSON file on every checkpoint.
+
+    Checkpoints rewrite the whole file, so they default to once a minute.
+    """
+
+    def __init__(self, json_path:str, commit_interval:float=60.0):
+        super().__init__(commit_every=10 ** 9, commit_interval=commit_interval)
+        self.json_path = json_path
+        self._state = load_state(json_path)
+        self._dirty = False
+
+    def _get(self, path):
+        record = self._state.get(path)
+        return None if record is None or 'file' in record else record
+
+    def _put(self, path, record):
+        self._state[path] = record
+        self._dirty = True
+
+    def _delete(self, path):
+        self._dirty = self._state.pop(path, None) is not None or self._dirty
+
+    def _find(self, field, value):
+        for path, record in self._items():
+            if record.get(field) == value:
+                return path, record
+        return None
+
+    def _pop_legacy(self, digest, local_path):
+        record = pop_legacy_record(self._state, digest, local_path)
+        self._dirty = self._dirty or record is not None
+        return record
+
+    def _items(self):
+        for path, record in self._state.items():
+            if 'file' not in record:
+                yield path, record
+
+    def _commit(self):
+        if not self._dirty:
+            return
+        # Write to a temporary file first so an interrupted checkpoint never truncates the state.
+        temp_path = f"{self.json_path}.tmp"
+        try:
+            with open(temp_path, 'w') as state_file:
+                json.dump(self._state, state_file, separators=(',', ':'))
+            os.replace(temp_path, self.json_path)
+            self._dirty = False
+        except IOError as e:
+            print(f"Error occurred while saving state: {e}")
+
+
+def import_json_state(json_path:str, store:SQLiteStateStore) -> int:
+    """Import a `.state.json` file into an SQLite state store.
+
+    Path-keyed records are imported as they are. Records from releases that keyed
+    state by checksum or ETag are kept aside and matched by local path on the next run.
+
+    Args:
+        json_path (str): The path to the JSON state file.
+        store (SQLiteStateStore): The store to import into.
+
+    Returns:
+        int: The number of records imported.
+    """
+    count = 0
+    for key, record in load_state(json_path).items():
+        if not isinstance(record, dict):
+            continue
+        if 'file' in record:
+            store.import_legacy(key, record)
+        else:
+            store.put(key, record)
+        count += 1
+    store.commit()
+    return count
+
+
+def open_state_store(backend:str='sqlite', directory:Optional[str]=None, shard:Optional['Shard']=None) -> StateStore:
+    """Open the state store of the current working directory.
+
+    The first time the SQLite backend is opened next to an existing `.state.json`,
+    that file is imported so earlier progress is kept. A shard keeps its own
+    state file (e.g. `.state.2-of-8.db`), which starts from the records of the
+    shard's paths in the unsharded state, if there is one.
+
+    Args:
+        backend (str, optional): 'sqlite' or 'json'. Defaults to 'sqlite'.
+        directory (str, optional): Where the state files live. Defaults to the current working directory.
+        shard (Shard, optional): The shard of the job (see shard.py). Defaults to the unsharded state.
+
+    Returns:
+        StateStore: The opened store.
+    """
+    directory = directory or os.getcwd()
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown state backend '{backend}', expected one of: {', '.join(BACKENDS)}")
+    file_name = STATE_DB if backend == 'sqlite' else STATE_JSON
+    path = os.path.join(directory, shard.file_name(file_name) if shard else file_name)
+    is_new = not os.path.exists(path)
+    store = SQLiteStateStore(path) if backend == 'sqlite' else JsonStateStore(path)
+    if not is_new:
+        return store
+
+    if shard:
+        unsharded_path = os.path.join(directory, file_name)
+        if os.path.exists(unsharded_path):
+            count = 0
+            with (SQLiteStateStore(unsharded_path) if backend == 'sqlite' else JsonStateStore(unsharded_path)) as unsharded:
+                for relative_path, record in unsharded.items():
+                    if shard.owns(relative_path):
+                        store.put(relative_path, record)
+                        count += 1
+            store.commit()
+            print(f"Imported {count} record(s) of shard {shard} from {file_name} into {os.path.basename(path)}.")
+        return store
+    json_path = os.path.join(directory, STATE_JSON)
+    if backend == 'sqlite' and os.path.exists(json_path):
+        count = import_json_state(json_path, store)
+        print(f"Imported {count} record(s) from {STATE_JSON} into {STATE_DB}.")
+    return store
+
+
+def import_state(json_path:Optional[str]=None) -> None:
+    """Import a `.state.json` file into the SQLite state store of the current working directory.
+
+    Args:
+        json_path (str, optional): The JSON state file. Defaults to `.state.json` in the current working directory.
+    """
+    json_path = json_path or os.path.join(os.getcwd(), STATE_JSON)
+    if not os.path.exists(json_path):
+        print(f"Error: {json_path} does not exist.")
+        sys.exit(1)
+    with SQLiteStateStore(os.path.join(os.getcwd(), STATE_DB)) as store:
+        count = import_json_state(json_path, store)
+    print(f"Imported {count} record(s) from {json_path} into {STATE_DB}.")
@@ -0,0 +1,249 @@
+import os
+import json
+import time
+import threading
+
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, NamedTuple, Optional
+
+from botocore.client import BaseClient
+from botocore.utils import determine_content_length
+
+# Upper bounds of the request latency histogram, in seconds.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+THROTTLE_CODES = frozenset(('SlowDown', 'Throttling', 'ThrottlingException', 'RequestLimitExceeded',
+                            'TooManyRequestsException', 'RequestThrottled', 'ServiceUnavailable'))
+
+
+class TransferResult(NamedTuple):
+    """The outcome of a transfer job, as returned by the command functions and the library API."""
+    command: str
+    files_transferred: int
+    bytes_transferred: int
+    files_skipped: int
+    files_deleted: int
+    duration_s: float
+    metrics: dict
+
+
+class ApiStats:
+    """Counters of one S3 API operation."""
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.retries = 0
+        self.throttles = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.latency_sum = 0.0
+        self.latency_buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def observe_latency(self, seconds:float) -> None:
+        self.latency_sum += seconds
+        self.latency_buckets[bisect_left(LATENCY_BUCKETS, seconds)] += 1
+
+    def to_dict(self) -> dict:
+        count = sum(self.latency_buckets)
+        return {'requests': self.requests, 'errors': self.errors, 'retries': self.retries, 'throttles': self.throttles,
+                'bytes_sent': self.bytes_sent, 'bytes_received': self.bytes_received,
+                'latency': {'count': count, 'sum_s': round(self.latency_sum, 6),
+                            'mean_s': round(self.latency_sum / count, 6) if count else 0.0,
+                            'buckets': {str(bound): n for bound, n in zip(LATENCY_BUCKETS + ('+Inf',), self.latency_buckets)}}}
+
+
+class TransferStats:
+    """Metrics of one transfer job: phase timers and per-API request statistics.
+
+    Requests are observed through botocore event hooks on the job's S3 client
+    (`attach`), so every call made by the managed transfers, the multipart
+    module and the listings is counted, including retries and throttling
+    responses. Phases are timed with `phase` (sequential steps, wall time) or
+    `timed` (pipeline stages, where the time of every worker is summed).
+    """
+
+    def __init__(self, command:str=''):
+        self.command = command
+        self.started_at = time.time()
+        self.finished_at: Optional[float] = None
+        self.apis: Dict[str, ApiStats] = defaultdict(ApiStats)
+        self.phases: Dict[str, Dict[str, float]] = defaultdict(lambda: {'seconds': 0.0, 'count': 0})
+        self.totals: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def attach(self, s3:BaseClient) -> BaseClient:
+        """Register the request hooks on an S3 client and return it."""
+        events = s3.meta.events
+        events.register('before-call.s3', self._before_call, unique_id='s3sync-stats-before-call')
+        events.register('needs-retry.s3', self._needs_retry, unique_id='s3sync-stats-needs-retry')
+        events.register('after-call.s3', self._after_call, unique_id='s3sync-stats-after-call')
+        events.register('after-call-error.s3', self._after_call_error, unique_id='s3sync-stats-after-call-error')
+        return s3
+
+    def detach(self, s3:BaseClient) -> None:
+        """Remove the request hooks, so a shared client can be handed to the next job."""
+        events = s3.meta.events
+        for event, name in (('before-call.s3', 'before-call'), ('needs-retry.s3', 'needs-retry'),
+                            ('after-call.s3', 'after-call'), ('after-call-error.s3', 'after-call-error')):
+            events.unregister(event, unique_id=f's3sync-stats-{name}')
+
+    def _before_call(self, model, params, context, **kwargs):
+        context['s3sync_start'] = time.monotonic()
+        body = params.get('body')
+        sent = 0
+        if body:
+            try:
+                sent = determine_content_length(body) or 0
+            except Exception:
+                sent = 0
+        with self._lock:
+            api = self.apis[model.name]
+            api.requests += 1
+            api.bytes_sent += sent
+
+    def _needs_retry(self, response, operation, caught_exception=None, **kwargs):
+        if response is None:
+            return None
+        http_response, parsed = response
+        code = (parsed or {}).get('Error', {}).get('Code')
+        if code in THROTTLE_CODES or http_response.status_code in (429, 503):
+            with self._lock:
+                self.apis[operation.name].throttles += 1
+        return None
+
+    def _after_call(self, http_response, parsed, model, context, **kwargs):
+        latency = time.monotonic() - context.get('s3sync_start', time.monotonic())
+        received = int(http_response.headers.get('content-length') or 0) if model.has_streaming_output else 0
+        retries = (parsed or {}).get('ResponseMetadata', {}).get('RetryAttempts', 0)
+        with self._lock:
+            api = self.apis[model.name]
+            api.retries += retries
+            api.bytes_received += received
+            api.observe_latency(latency)
+            if http_response.status_code >= 300:
+                api.errors += 1
+
+    def _after_call_error(self, event_name, context, exception=None, **kwargs):
+        # Requests that failed without a response (connection errors after all retries).
+        latency = time.monotonic() - context.get('s3sync_start', time.monotonic())
+        with self._lock:
+            api = self.apis[event_name.rsplit('.', 1)[-1]]
+            api.errors += 1
+            api.observe_latency(latency)
+
+    @contextmanager
+    def phase(self, name:str) -> Iterator[None]:
+        """Time a step of the job."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._add_phase(name, time.perf_counter() - start)
+
+    def timed(self, name:str, func:Callable[[Any], Any]) -> Callable[[Any], Any]:
+        """Wrap a pipeline stage so the time spent in it is added to a phase."""
+        def wrapper(item):
+            start = time.perf_counter()
+            try:
+                return func(item)
+            finally:
+                self._add_phase(name, time.perf_counter() - start)
+        return wrapper
+
+    def _add_phase(self, name:str, seconds:float) -> None:
+        with self._lock:
+            self.phases[name]['seconds'] += seconds
+            self.phases[name]['count'] += 1
+
+    def finish(self, files:int=0, transferred_bytes:int=0, skipped:int=0, deleted:int=0) -> None:
+        """Record the outcome of the job."""
+        self.finished_at = time.time()
+        self.totals = {'files': files, 'bytes': transferred_bytes, 'skipped': skipped, 'deleted': deleted}
+
+    def result(self) -> TransferResult:
+        """Return the outcome of the job with its metrics."""
+        summary = self.to_dict()
+        return TransferResult(self.command, summary['files'], summary['bytes'], summary['skipped'], summary['deleted'],
+                              summary['duration_s'], summary)
+
+    def to_dict(self) -> dict:
+        """Return the metrics as a JSON-serialisable summary."""
+        duration = (self.finished_at or time.time()) - self.started_at
+        with self._lock:
+            return {'command': self.command, 'started_at': self.started_at, 'duration_s': round(duration, 3),
+                    'files': self.totals.get('files', 0), 'bytes': self.totals.get('bytes', 0),
+                    'skipped': self.totals.get('skipped', 0), 'deleted': self.totals.get('deleted', 0),
+                    'throughput_bytes_per_s': round(self.totals.get('bytes', 0) / duration, 1) if duration > 0 else 0.0,
+                    'phases': {name: {'seconds': round(phase['seconds'], 3), 'count': int(phase['count'])}
+                               for name, phase in self.phases.items()},
+                    'requests_total': sum(api.requests for api in self.apis.values()),
+                    'apis': {name: api.to_dict() for name, api in sorted(self.apis.items())}}
+
+    def to_json(self) -> str:
+        return json.dumps(self.to_dict(), indent=2)
+
+    def to_prometheus(self) -> str:
+        """Return the metrics in the Prometheus text exposition format."""
+        summary = self.to_dict()
+        command = f'command="{self.command}"'
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                lines.append(f"{name}{{{','.join([command] + labels)}}} {value}")
+
+        metric('s3sync_last_run_timestamp_seconds', 'gauge', 'When the last run started.', [([], self.started_at)])
+        metric('s3sync_duration_seconds', 'gauge', 'Wall time of the last run.', [([], summary['duration_s'])])
+        metric('s3sync_files_transferred', 'gauge', 'Files transferred by the last run.', [([], summary['files'])])
+        metric('s3sync_files_skipped', 'gauge', 'Files skipped as unchanged by the last run.', [([], summary['skipped'])])
+        metric('s3sync_bytes_transferred', 'gauge', 'Bytes transferred by the last run.', [([], summary['bytes'])])
+        metric('s3sync_throughput_bytes_per_second', 'gauge', 'Average throughput of the last run.',
+               [([], summary['throughput_bytes_per_s'])])
+        metric('s3sync_phase_seconds', 'gauge', 'Time spent in each phase (summed over workers).',
+               [([f'phase="{name}"'], phase['seconds']) for name, phase in sorted(summary['phases'].items())])
+        for field, help_text in (('requests', 'S3 requests.'), ('errors', 'S3 requests that failed.'),
+                                 ('retries', 'S3 request retries.'), ('throttles', 'S3 throttling responses.'),
+                                 ('bytes_sent', 'Request body bytes sent.'), ('bytes_received', 'Response body bytes received.')):
+            metric(f's3sync_{field}_total', 'counter', help_text,
+                   [([f'operation="{name}"'], getattr(api, field)) for name, api in sorted(self.apis.items())])
+
+        name = 's3sync_request_duration_seconds'
+        lines.append(f"# HELP {name} Latency of S3 requests, including retries.")
+        lines.append(f"# TYPE {name} histogram")
+        for operation, api in sorted(self.apis.items()):
+            labels = f'{command},operation="{operation}"'
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), api.latency_buckets):
+                cumulative += count
+                lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f"{name}_sum{{{labels}}} {api.latency_sum}")
+            lines.append(f"{name}_count{{{labels}}} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path:str) -> None:
+        """Write the metrics for the node_exporter textfile collector.
+
+        The file is written next to its destination and renamed into place, so
+        the collector never reads a partial file.
+        """
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(temp_path, 'w') as metrics_file:
+                metrics_file.write(self.to_prometheus())
+            os.replace(temp_path, path)
+        except IOError as e:
+            print(f"Error occurred while writing metrics: {e}")
+
+
+def report_stats(stats:Optional[TransferStats], show:bool=False, metrics_file:Optional[str]=None) -> None:
+    """Print the JSON summary and/or write the Prometheus textfile of a finished job."""
+    if stats is None:
+        return
+    if show:
+        print(stats.to_json())
+    if metrics_file:
+        stats.write_prometheus(metrics_file)
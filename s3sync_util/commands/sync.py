@@ -0,0 +1,610 @@
+import sys
+import os
+import json
+import sqlite3
+import threading
+
+from datetime import datetime, timezone
+from itertools import islice
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple, Union
+
+from botocore.client import BaseClient
+from botocore.exceptions import BotoCoreError, ClientError, NoCredentialsError
+from s3sync_util.commands import upload, download
+from s3sync_util.commands.size import format_size
+from s3sync_util.commands.bundle import BundleCatalog, BundleMember, bundle_prefix, load_bundle_catalog, restore_bundle_members
+from s3sync_util.commands.dedup import Deduplicator
+from s3sync_util.commands.delta import hash_file, plan_reuse
+from s3sync_util.commands.compression import Compression
+from s3sync_util.commands.exclude import compile_excludes
+from s3sync_util.commands.pipeline import Progress, ProgressUpdate, run_pipeline
+from s3sync_util.commands.manifest import ManifestEntry, scan_directory
+from s3sync_util.commands.common import check_s3_location, get_s3_client
+from s3sync_util.commands.hashing import digest_file, etag_matches, transfer_part_size
+from s3sync_util.commands.remote_index import PAGE_SIZE, RemoteIndex, RemoteObject, get_remote_index
+from s3sync_util.commands.state_store import StateStore, open_state_store
+from s3sync_util.commands.state_management import signature_matches
+from s3sync_util.commands.stats import TransferResult, TransferStats
+from s3sync_util.commands.throttle import Throttle, retry_throttled
+from s3sync_util.commands.tuning import MAX_CONCURRENCY, TransferSettings, TransferTuner, tune_transfer
+
+DIRECTIONS = ('upload', 'download')
+DELETE_BATCH_SIZE = 1000
+
+
+class PlanItems:
+    """One list of a sync plan, read back from its database a page at a time."""
+
+    def __init__(self, plan:'SyncPlan', kind:str):
+        self._plan = plan
+        self._kind = kind
+
+    def __len__(self) -> int:
+        return self._plan._counts[self._kind]
+
+    def __bool__(self) -> bool:
+        return len(self) > 0
+
+    def __iter__(self) -> Iterator:
+        return self._plan._items(self._kind)
+
+
+class SyncPlan:
+    """The difference between a local directory and an S3 prefix.
+
+    Files present on both sides are split into changed and unchanged; files
+    present on one side only are kept as local-only and remote-only. Which of
+    those are new (to be transferred) and which are extraneous (to be deleted
+    with --delete) depends on the sync direction. On the remote side, a file
+    is an object or, when downloading, a member of a bundle.
+
+    The three lists, and the keys matched so far while the plan is built, are
+    kept in a temporary SQLite database rather than in memory, like the
+    listing they are compared with (see remote_index.RemoteIndex). Only their
+    counts and sizes are kept in memory; every iteration reads the files back
+    a page at a time, in the order they were added. Close the plan when done.
+    """
+
+    LOCAL_ONLY, REMOTE_ONLY, CHANGED = 'local', 'remote', 'changed'
+
+    def __init__(self, direction:str, settings:Optional[TransferSettings]=None):
+        self.direction = direction
+        self.settings = settings
+        self.local_only = PlanItems(self, self.LOCAL_ONLY)
+        self.remote_only = PlanItems(self, self.REMOTE_ONLY)
+        # Pairs of (local file, remote object or bundle member).
+        self.changed = PlanItems(self, self.CHANGED)
+        self.unchanged_files = 0
+        self.unchanged_bytes = 0
+        self._counts = {self.LOCAL_ONLY: 0, self.REMOTE_ONLY: 0, self.CHANGED: 0}
+        self._lock = threading.Lock()
+        # An empty name opens a private database on disk, deleted by SQLite when it is closed.
+        self._conn = sqlite3.connect('', check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=OFF")
+        self._conn.execute("PRAGMA synchronous=OFF")
+        # Bundle members to restore carry their bundle and offset, so they can be read back bundle by bundle.
+        self._conn.execute("CREATE TABLE items (id INTEGER PRIMARY KEY, kind TEXT NOT NULL, local TEXT, remote TEXT, "
+                           "bundle_key TEXT, offset INTEGER)")
+        self._conn.execute("CREATE INDEX items_kind ON items(kind, id)")
+        self._conn.execute("CREATE INDEX items_bundle ON items(bundle_key, offset)")
+        self._conn.execute("CREATE TABLE matched (key TEXT PRIMARY KEY) WITHOUT ROWID")
+
+    def add_local_only(self, entry:ManifestEntry) -> None:
+        self._add(self.LOCAL_ONLY, entry, None)
+
+    def add_remote_only(self, remote:Union[RemoteObject, BundleMember]) -> None:
+        self._add(self.REMOTE_ONLY, None, remote)
+
+    def add_changed(self, entry:ManifestEntry, remote:Union[RemoteObject, BundleMember]) -> None:
+        self._add(self.CHANGED, entry, remote)
+
+    def _add(self, kind:str, entry:Optional[ManifestEntry], remote:Union[RemoteObject, BundleMember, None]) -> None:
+        member = remote if isinstance(remote, BundleMember) else None
+        row = (kind, _encode(entry), _encode(remote), member and member.bundle_key, member and member.offset)
+        with self._lock:
+            self._conn.execute("INSERT INTO items (kind, local, remote, bundle_key, offset) VALUES (?, ?, ?, ?, ?)", row)
+            self._conn.commit()
+            self._counts[kind] += 1
+
+    def match(self, s3_key:str) -> None:
+        """Record that a key has a local file, so it is not remote-only."""
+        with self._lock:
+            self._conn.execute("INSERT OR IGNORE INTO matched VALUES (?)", (s3_key,))
+            self._conn.commit()
+
+    def is_matched(self, s3_key:str) -> bool:
+        with self._lock:
+            return self._conn.execute("SELECT 1 FROM matched WHERE key = ?", (s3_key,)).fetchone() is not None
+
+    def _items(self, kind:str) -> Iterator:
+        last = 0
+        while True:
+            # Keyset paging: no cursor stays open between pages, so other threads can use the connection.
+            with self._lock:
+                rows = self._conn.execute("SELECT id, local, remote FROM items WHERE kind = ? AND id > ? ORDER BY id LIMIT ?",
+                                          (kind, last, PAGE_SIZE)).fetchall()
+            for _, local, remote in rows:
+                if kind == self.CHANGED:
+                    yield _decode(local), _decode(remote)
+                else:
+                    yield _decode(local if kind == self.LOCAL_ONLY else remote)
+            if len(rows) < PAGE_SIZE:
+                return
+            last = rows[-1][0]
+
+    def members_by_bundle(self) -> Iterator[Tuple[str, List[BundleMember]]]:
+        """Yield the key of every bundle that members are restored from, with those members in offset order."""
+        # Only downloads compare with bundle members, and every member in their plan is transferred.
+        if self.direction != 'download':
+            return
+        with self._lock:
+            bundle_keys = [row[0] for row in self._conn.execute(
+                "SELECT DISTINCT bundle_key FROM items WHERE bundle_key IS NOT NULL ORDER BY bundle_key")]
+        for bundle_key in bundle_keys:
+            with self._lock:
+                rows = self._conn.execute("SELECT remote FROM items WHERE bundle_key = ? ORDER BY offset", (bundle_key,)).fetchall()
+            yield bundle_key, [_decode(remote) for remote, in rows]
+
+    def close(self) -> None:
+        """Release the database, which deletes it."""
+        with self._lock:
+            self._conn.close()
+
+    @property
+    def new(self) -> List[Union[ManifestEntry, RemoteObject, BundleMember]]:
+        """Files that exist only at the source."""
+        return self.local_only if self.direction == 'upload' else self.remote_only
+
+    @property
+    def extraneous(self) -> List[Union[ManifestEntry, RemoteObject, BundleMember]]:
+        """Files that exist only at the destination."""
+        return self.remote_only if self.direction == 'upload' else self.local_only
+
+    def transfers(self) -> Iterator[Union[ManifestEntry, RemoteObject, BundleMember]]:
+        """Yield the source side of every file to transfer."""
+        yield from self.new
+        yield from self.changed_sources()
+
+    def changed_sources(self) -> Iterator[Union[ManifestEntry, RemoteObject, BundleMember]]:
+        """Yield the source side of every changed file."""
+        side = 0 if self.direction == 'upload' else 1
+        for pair in self.changed:
+            yield pair[side]
+
+    def transfer_count(self) -> int:
+        return len(self.new) + len(self.changed)
+
+    def transfer_bytes(self) -> int:
+        return sum(item.size for item in self.transfers())
+
+    def request_count(self, delete:bool=False) -> int:
+        """Estimate the number of S3 requests needed to execute the plan."""
+        requests = sum(estimate_requests(item.size, self.direction, self.settings) for item in self.transfers())
+        if delete and self.direction == 'upload':
+            requests += -(-len(self.remote_only) // DELETE_BATCH_SIZE)
+        return requests
+
+    def summary(self, delete:bool=False) -> str:
+        """Return a printable summary of the plan."""
+        verb = "Upload" if self.direction == 'upload' else "Download"
+        extraneous_side = "Remote-only" if self.direction == 'upload' else "Local-only"
+        extraneous_action = "delete" if delete else "keep"
+        lines = [
+            f"Sync plan ({self.direction}):",
+            f"  New:         {len(self.new)} file(s), {format_size(sum(item.size for item in self.new))} -> {verb.lower()}",
+            f"  Changed:     {len(self.changed)} file(s), {format_size(sum(item.size for item in self.changed_sources()))} -> {verb.lower()}",
+            f"  Unchanged:   {self.unchanged_files} file(s), {format_size(self.unchanged_bytes)} -> skip",
+            f"  {extraneous_side + ':':<13}{len(self.extraneous)} file(s), {format_size(sum(item.size for item in self.extraneous))} -> {extraneous_action}",
+            f"  {verb}: {format_size(self.transfer_bytes())} in about {self.request_count(delete)} request(s)",
+        ]
+        return "\n".join(lines)
+
+
+def _encode(item:Union[ManifestEntry, RemoteObject, BundleMember, None]) -> Optional[str]:
+    """Serialize a file of a sync plan for its database."""
+    if item is None:
+        return None
+    if isinstance(item, RemoteObject):
+        return json.dumps(['object', item.key, item.size, item.etag, item.last_modified.timestamp()])
+    return json.dumps(['member' if isinstance(item, BundleMember) else 'file'] + list(item))
+
+
+def _decode(text:Optional[str]) -> Union[ManifestEntry, RemoteObject, BundleMember, None]:
+    if text is None:
+        return None
+    kind, *fields = json.loads(text)
+    if kind == 'object':
+        key, size, etag, last_modified = fields
+        return RemoteObject(key, size, etag, datetime.fromtimestamp(last_modified, timezone.utc))
+    return BundleMember(*fields) if kind == 'member' else ManifestEntry(*fields)
+
+
+def describe(item:Union[ManifestEntry, RemoteObject, BundleMember]) -> str:
+    """Return the key of an S3 object, or the relative path of a local file or bundle member."""
+    return item.key if isinstance(item, RemoteObject) else item.relative_path
+
+
+def estimate_requests(size:int, direction:str, settings:Optional[TransferSettings]=None) -> int:
+    """Estimate how many S3 requests transferring one file of the given size takes."""
+    settings = settings or TransferSettings()
+    if direction == 'upload':
+        part_size = transfer_part_size(size, settings)
+        # Multipart uploads add a create and a complete request around the parts.
+        return 1 if part_size is None else -(-size // part_size) + 2
+    # Downloads above either threshold are fetched in ranged GETs of one part each.
+    if size >= min(settings.multipart_threshold, settings.large_file_threshold):
+        return -(-size // settings.multipart_chunksize)
+    return 1
+
+
+def is_unchanged(entry:ManifestEntry, remote:RemoteObject, state:StateStore, checksum:bool=False) -> bool:
+    """Decide whether a local file and an S3 object have the same content.
+
+    A state record that still matches the file's stat and the object's ETag
+    settles it without reading the file; otherwise sizes are compared and,
+    only if they are equal, the file is hashed and compared with the ETag.
+
+    Args:
+        entry (ManifestEntry): The local file.
+        remote (RemoteObject): The S3 object at the file's key.
+        state (StateStore): The sync state.
+        checksum (bool, optional): Always hash instead of trusting the state record. Defaults to False.
+
+    Returns:
+        bool: True if the file and the object have the same content.
+    """
+    record = state.get(entry.relative_path)
+    if not checksum and record and record.get('etag') == remote.etag and \
+            signature_matches(record, entry.size, entry.mtime_ns, entry.inode):
+        return True
+    if entry.size != remote.size or not etag_matches(entry.path, entry.size, remote.etag):
+        return False
+    state.put(entry.relative_path, {'size': entry.size, 'mtime_ns': entry.mtime_ns, 'inode': entry.inode,
+                                    'etag': remote.etag, 'last_modified': remote.last_modified.isoformat(),
+                                    'extension': os.path.splitext(entry.relative_path)[1]})
+    return True
+
+
+def is_member_unchanged(entry:ManifestEntry, member:BundleMember, bundle:RemoteObject, state:StateStore,
+                        checksum:bool=False) -> bool:
+    """Decide whether a local file has the content of a bundle member, as is_unchanged does for objects.
+
+    The MD5 recorded for the member in its bundle's index stands in for the ETag.
+
+    Args:
+        entry (ManifestEntry): The local file.
+        member (BundleMember): The bundle member at the file's path.
+        bundle (RemoteObject): The bundle the member is stored in.
+        state (StateStore): The sync state.
+        checksum (bool, optional): Always hash instead of trusting the state record. Defaults to False.
+
+    Returns:
+        bool: True if the file and the member have the same content.
+    """
+    record = state.get(entry.relative_path)
+    if not checksum and record and record.get('etag') == member.checksum and \
+            signature_matches(record, entry.size, entry.mtime_ns, entry.inode):
+        return True
+    if entry.size != member.size or digest_file(entry.path)[0] != member.checksum:
+        return False
+    state.put(entry.relative_path, {'size': entry.size, 'mtime_ns': entry.mtime_ns, 'inode': entry.inode,
+                                    'etag': member.checksum, 'last_modified': bundle.last_modified.isoformat(),
+                                    'extension': os.path.splitext(entry.relative_path)[1], 'bundle': member.bundle_key})
+    return True
+
+
+def build_sync_plan(directory:str, s3_prefix:str, exclude_list:list, direction:str, index:RemoteIndex,
+                    state:StateStore, checksum:bool=False, catalog:Optional[BundleCatalog]=None) -> SyncPlan:
+    """Compare a local directory with an indexed S3 prefix.
+
+    Args:
+        directory (str): The local directory.
+        s3_prefix (str): The S3 prefix the directory is mirrored to.
+        exclude_list (list): List of items to exclude on both sides.
+        direction (str): 'upload' or 'download'.
+        index (RemoteIndex): The listing of the S3 prefix.
+        state (StateStore): The sync state.
+        checksum (bool, optional): Always hash files present on both sides. Defaults to False.
+        catalog (BundleCatalog, optional): The bundled files of the prefix, compared like objects. Defaults to none.
+
+    Returns:
+        SyncPlan: The plan. Close it when done.
+    """
+    plan = SyncPlan(direction)
+    lock = threading.Lock()
+
+    def classify(entry):
+        s3_key = os.path.join(s3_prefix, entry.relative_path)
+        remote = index.get(s3_key)
+        if catalog is not None and remote is not None and catalog.owns(remote):
+            remote = None  # superseded by a newer bundle member
+        member = catalog.member(entry.relative_path) if catalog is not None and remote is None else None
+        if member is not None:
+            unchanged = is_member_unchanged(entry, member, catalog.bundles[member.bundle_key], state, checksum)
+            plan.match(s3_key)
+            if not unchanged:
+                plan.add_changed(entry, member)
+                return None
+            with lock:
+                plan.unchanged_files += 1
+                plan.unchanged_bytes += entry.size
+            return None
+        if remote is None:
+            record = state.get(entry.relative_path)
+            # Files packed into a bundle by `upload --bundle` have no object of their own.
+            if (record and upload.is_recorded_upload(record, None, index)
+                    and signature_matches(record, entry.size, entry.mtime_ns, entry.inode)):
+                with lock:
+                    plan.unchanged_files += 1
+                    plan.unchanged_bytes += entry.size
+                return None
+            plan.add_local_only(entry)
+            return None
+        unchanged = is_unchanged(entry, remote, state, checksum)
+        plan.match(s3_key)
+        if not unchanged:
+            plan.add_changed(entry, remote)
+            return None
+        with lock:
+            plan.unchanged_files += 1
+            plan.unchanged_bytes += entry.size
+        return None
+
+    try:
+        # Only files with equal sizes and no matching state record are hashed; spread those over every core.
+        run_pipeline(scan_directory(directory, exclude_list), [(classify, os.cpu_count() or 1)])
+
+        bundles = bundle_prefix(s3_prefix)
+        excludes = compile_excludes(exclude_list)
+        for remote in index:
+            if (remote.key.endswith('/') or remote.key.startswith(bundles) or (catalog is not None and catalog.owns(remote))
+                    or plan.is_matched(remote.key)):
+                continue
+            if not excludes.excludes_key(remote.key, s3_prefix):
+                plan.add_remote_only(remote)
+        # Excluded members were left out of the catalog when it was loaded.
+        for member in catalog if catalog is not None else ():
+            if not plan.is_matched(os.path.join(s3_prefix, member.relative_path)):
+                plan.add_remote_only(member)
+    except BaseException:
+        plan.close()
+        raise
+    return plan
+
+
+def delete_remote_objects(s3:BaseClient, s3_bucket:str, keys:Iterable[str], log:Callable[[str], None]=print,
+                          index:Optional[RemoteIndex]=None) -> int:
+    """Delete objects with one `delete_objects` request per 1000 keys.
+
+    Args:
+        s3 (BaseClient): The S3 client.
+        s3_bucket (str): The name of the S3 bucket.
+        keys (Iterable[str]): The keys to delete, read DELETE_BATCH_SIZE at a time.
+        log (Callable, optional): Where errors are written. Defaults to print.
+        index (RemoteIndex, optional): An index of the prefix, from which the deleted objects are removed.
+
+    Returns:
+        int: The number of objects deleted.
+    """
+    deleted = 0
+    keys = iter(keys)
+    while True:
+        batch = list(islice(keys, DELETE_BATCH_SIZE))
+        if not batch:
+            break
+        response = s3.delete_objects(Bucket=s3_bucket, Delete={'Objects': [{'Key': key} for key in batch], 'Quiet': True})
+        errors = response.get('Errors', [])
+        for error in errors:
+            log(f"\nError occurred while deleting {error.get('Key')}: {error.get('Message')}")
+        deleted += len(batch) - len(errors)
+        if index is not None:
+            failed = {error.get('Key') for error in errors}
+            index.delete(key for key in batch if key not in failed)
+    return deleted
+
+
+def sync_with_s3(directory:str, s3_bucket:str, s3_prefix:str, exclude_list:list, direction:str='upload', delete:bool=False,
+                 dry_run:bool=False, progress:bool=False, verbose:bool=False, workers:int=1, checksum:bool=False,
+                 state_backend:str='sqlite', index_ttl:float=0, transfer_overrides:Optional[dict]=None,
+                 stats:Optional[TransferStats]=None, max_bandwidth:Optional[int]=None, max_requests:Optional[float]=None,
+                 s3_client:Optional[BaseClient]=None, state_dir:Optional[str]=None, interactive:bool=True,
+                 log:Callable[[str], None]=print, on_progress:Optional[Callable[[ProgressUpdate], None]]=None,
+                 dedup:bool=True, compress:Optional[list]=None, codec:Optional[str]=None, delta:bool=True) -> Optional[TransferResult]:
+    """Mirror a local directory and an S3 prefix in one direction, following a precomputed plan.
+
+    Args:
+        directory (str): The local directory.
+        s3_bucket (str): The name of the S3 bucket.
+        s3_prefix (str): The prefix to use for S3 object keys.
+        exclude_list (list): List of items to exclude from the sync.
+        direction (str, optional): 'upload' mirrors the directory to S3, 'download' mirrors S3 to the directory. Defaults to 'upload'.
+        delete (bool, optional): Delete files that exist only at the destination. Defaults to False.
+        dry_run (bool, optional): Print the plan without executing it. Defaults to False.
+        progress (bool, optional): Display progress statistics. Defaults to False.
+        verbose (bool, optional): Increase verbosity of the sync process. Defaults to False.
+        workers (int, optional): Number of concurrent transfer workers. Defaults to 1.
+        checksum (bool, optional): Hash every file present on both sides instead of trusting the state. Defaults to False.
+        state_backend (str, optional): Where sync state is kept, 'sqlite' or 'json'. Defaults to 'sqlite'.
+        index_ttl (float, optional): Reuse a cached listing of the prefix younger than this many seconds. Defaults to 0.
+        transfer_overrides (dict, optional): Transfer settings that replace the tuned ones (see tuning.tune_transfer).
+        stats (TransferStats, optional): Collects the phase timings and S3 request metrics of the job.
+        max_bandwidth (int, optional): Bytes per second shared by all workers. Defaults to unlimited.
+        max_requests (float, optional): S3 requests per second shared by all workers. Defaults to unlimited.
+        s3_client (BaseClient, optional): A client to reuse instead of creating one for the job.
+        state_dir (str, optional): Where the sync state is kept. Defaults to the working directory.
+        interactive (bool, optional): Ask for confirmation and report errors instead of raising them. Defaults to True.
+        log (Callable, optional): Where messages are written. Defaults to print.
+        on_progress (Callable, optional): Called with a ProgressUpdate after every transferred file.
+        dedup (bool, optional): When uploading, copy content already in the bucket server-side instead of uploading it again. Defaults to True.
+        compress (list, optional): When uploading, patterns of the files to store compressed. Defaults to none.
+        codec (str, optional): 'gzip' or 'zstd'. Defaults to zstd if the zstandard package is installed, else gzip.
+        delta (bool, optional): When uploading, send only the changed parts of large files. Defaults to True.
+
+    Returns:
+        TransferResult: The outcome of the sync (nothing transferred for a dry run), or None if it was canceled or failed.
+    """
+    check_s3_location(s3_bucket, s3_prefix, interactive)
+
+    workers = max(1, workers)
+    stats = stats or TransferStats('sync')
+    compression = Compression(compress, codec, log) if compress else None
+    throttle = Throttle(workers * MAX_CONCURRENCY, max_bandwidth, max_requests)
+
+    try:
+        log(f"Syncing with S3 ({direction}):")
+        log(f"Bucket: {s3_bucket}")
+        log(f"Prefix: {s3_prefix}")
+        log(f"Directory: {directory}")
+
+        s3 = stats.attach(s3_client or get_s3_client(workers, MAX_CONCURRENCY))
+        throttle.attach(s3)
+        state = open_state_store(state_backend, state_dir)
+        index = catalog = plan = None
+        try:
+            with stats.phase('list'):
+                index = get_remote_index(s3, s3_bucket, s3_prefix, index_ttl, workers, exclude_list, state_dir)
+                # Files packed into bundles are restored from them, so a download compares with their members too.
+                catalog = load_bundle_catalog(s3, index, s3_prefix, exclude_list, workers) if direction == 'download' else None
+            # Scanning the directory and comparing it with the listing, hashing where needed.
+            with stats.phase('plan'):
+                plan = build_sync_plan(directory, s3_prefix, exclude_list, direction, index, state, checksum, catalog)
+            # Tuned for the files that are actually transferred, not for the whole tree.
+            settings = plan.settings = tune_transfer((item.size for item in plan.transfers()), workers, transfer_overrides)
+            stats.finish(0, 0, plan.unchanged_files)
+            log(plan.summary(delete))
+            log(f"Transfer settings: {settings.describe()}")
+
+            if verbose or dry_run:
+                for item in plan.transfers():
+                    log(f"  {direction}: {describe(item)}")
+                if delete:
+                    for item in plan.extraneous:
+                        log(f"  delete: {describe(item)}")
+            if dry_run:
+                log("Dry run: no changes made.")
+                return stats.result()
+            if not plan.transfer_count() and not (delete and plan.extraneous):
+                log("Already in sync.")
+                return stats.result()
+
+            confirm = input("Proceed with sync? (yes/no): ").lower() if interactive else 'yes'
+            if confirm != 'yes':
+                log("Sync operation canceled.")
+                return
+
+            tracker = Progress(plan.transfer_count(), "Uploaded" if direction == 'upload' else "Downloaded", progress, on_progress)
+            tuner = TransferTuner(settings)
+
+            deduplicator = Deduplicator(s3, s3_bucket, s3_prefix, state, index, settings) if dedup and direction == 'upload' else None
+            if direction == 'upload':
+                def hash_stage(entry):
+                    local_checksum, local_etag, parts = hash_file(entry, state.get(entry.relative_path), settings, delta)
+                    return entry, local_checksum, local_etag, parts
+
+                def transfer_stage(item):
+                    entry, local_checksum, local_etag, parts = item
+                    s3_key = os.path.join(s3_prefix, entry.relative_path)
+                    if verbose:
+                        log(f"\nUploading {entry.path} to S3 bucket {s3_bucket} with key {s3_key}")
+                    file_codec = compression.codec_for(entry.relative_path) if compression else None
+                    try:
+                        copied = deduplicator and retry_throttled(deduplicator.copy, entry, s3_key, local_checksum, local_etag, file_codec)
+                        reuse = None if copied or file_codec else plan_reuse(state.get(entry.relative_path), parts, entry.size)
+                        remote_etag = copied or retry_throttled(upload.upload_file_to_s3, s3, entry.path, s3_bucket, s3_key,
+                                                                entry.size, settings, log, file_codec, parts, reuse, state_dir)
+                    except Exception:
+                        tuner.observe(entry.size, error=True)
+                        raise
+                    if not copied:
+                        tuner.observe(entry.size)
+                    state.put(entry.relative_path, upload.build_record(entry, local_checksum, remote_etag or local_etag, file_codec, parts))
+                    index.put(s3_key, entry.size, remote_etag or local_etag)
+                    tracker.advance(entry.size)
+
+                stages = [(stats.timed('checksum', hash_stage), os.cpu_count() or 1), (stats.timed('transfer', transfer_stage), workers)]
+            else:
+                def transfer_stage(remote):
+                    relative_path = os.path.relpath(remote.key, s3_prefix)
+                    local_path = os.path.join(directory, relative_path)
+                    if verbose:
+                        log(f"\nDownloading {remote.key} from S3 bucket {s3_bucket} to {local_path}")
+                    try:
+                        retry_throttled(download.download_file_from_s3, s3, s3_bucket, remote.key, local_path, remote.size, remote.etag, settings, log)
+                    except Exception:
+                        tuner.observe(remote.size, error=True)
+                        raise
+                    tuner.observe(remote.size)
+                    state.put(relative_path, download.build_record(os.stat(local_path), remote.etag, remote.last_modified, remote.key))
+                    tracker.advance(remote.size)
+
+                stages = [(stats.timed('transfer', transfer_stage), workers)]
+
+                def restore_stage(item):
+                    bundle, members = item
+                    done = set()
+
+                    def restored(member, local_path):
+                        done.add(member.relative_path)
+                        state.put(member.relative_path, dict(download.build_record(os.stat(local_path), member.checksum, bundle.last_modified,
+                                                                                   member.relative_path), bundle=member.bundle_key))
+                        if verbose:
+                            log(f"\nRestored {member.relative_path} from bundle {bundle.key}")
+                        tracker.advance(member.size)
+
+                    # A retry after throttling fetches only the members not restored yet.
+                    retry_throttled(lambda: restore_bundle_members(
+                        s3, s3_bucket, bundle, [member for member in members if member.relative_path not in done], directory, restored))
+
+            run_pipeline((item for item in plan.transfers() if not isinstance(item, BundleMember)), stages, queue_size=workers * 4)
+            if direction == 'download':
+                run_pipeline(((catalog.bundles[bundle_key], members) for bundle_key, members in plan.members_by_bundle()),
+                             [(stats.timed('transfer', restore_stage), workers)], queue_size=workers * 4)
+            if plan.transfer_count():
+                log("\nSync completed.")
+                log(tracker.summary())
+                if deduplicator and deduplicator.copied_files:
+                    log(deduplicator.describe())
+                if throttle.concurrency.decreases:
+                    log(throttle.describe())
+
+            deleted = 0
+            if delete and plan.extraneous:
+                if direction == 'upload':
+                    with stats.phase('delete'):
+                        deleted = delete_remote_objects(s3, s3_bucket, (remote.key for remote in plan.remote_only), log, index)
+                    for remote in plan.remote_only:
+                        state.delete(os.path.relpath(remote.key, s3_prefix))
+                else:
+                    for entry in plan.local_only:
+                        try:
+                            os.remove(entry.path)
+                            deleted += 1
+                        except OSError as e:
+                            log(f"\nError occurred while deleting {entry.path}: {e}")
+                        state.delete(entry.relative_path)
+                log(f"Deleted {deleted} file(s).")
+            stats.finish(tracker.transferred_files, tracker.transferred_bytes, plan.unchanged_files, deleted)
+            return stats.result()
+        except (BotoCoreError, ClientError, NoCredentialsError) as e:
+            if not interactive:
+                raise
+            log(f"Error occurred: {e}")
+        finally:
+            state.close()
+            if plan is not None:
+                plan.close()
+            if catalog is not None:
+                catalog.close()
+            if index is not None:
+                index.close()
+
+    except KeyboardInterrupt:
+        if not interactive:
+            raise
+        log("\nOperation interrupted by the user.")
+        sys.exit(0)
+    finally:
+        if s3_client is not None:
+            # A client passed in outlives the job: leave it without the job's hooks.
+            throttle.detach(s3_client)
+            stats.detach(s3_client)
@@ -0,0 +1,208 @@
+import time
+import random
+import threading
+
+from typing import Any, Callable, Optional
+
+from botocore.client import BaseClient
+from botocore.exceptions import (ClientError, ConnectionClosedError, ConnectTimeoutError, EndpointConnectionError,
+                                 ReadTimeoutError)
+from s3sync_util.commands.stats import THROTTLE_CODES
+
+# Botocore's standard retry mode: exponential backoff with full jitter, and
+# SlowDown/503 responses are retried like any other throttling error.
+RETRY_CONFIG = {'mode': 'standard', 'max_attempts': 10}
+# A file whose transfer still fails with throttling after the request retries
+# is retried as a whole this many times, after a jittered pause.
+FILE_ATTEMPTS = 3
+FILE_BACKOFF = 2.0  # seconds, doubled per attempt
+FILE_BACKOFF_CAP = 60.0
+TIMEOUT_ERRORS = (ReadTimeoutError, ConnectTimeoutError, ConnectionClosedError, EndpointConnectionError)
+
+
+def is_throttling(error:BaseException) -> bool:
+    """Whether an exception is S3 asking the client to slow down."""
+    if isinstance(error, ClientError):
+        code = error.response.get('Error', {}).get('Code')
+        status = error.response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+        return code in THROTTLE_CODES or status in (429, 503)
+    return isinstance(error, TIMEOUT_ERRORS)
+
+
+def backoff_delay(attempt:int, base:float=FILE_BACKOFF, cap:float=FILE_BACKOFF_CAP) -> float:
+    """Return a full-jitter exponential backoff delay for a retry attempt (0-based)."""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def retry_throttled(func:Callable[..., Any], *args, attempts:int=FILE_ATTEMPTS, **kwargs) -> Any:
+    """Call `func`, retrying it after a jittered pause while it fails with throttling or timeouts."""
+    for attempt in range(attempts):
+        try:
+            return func(*args, **kwargs)
+        except Exception as e:
+            if attempt == attempts - 1 or not is_throttling(e):
+                raise
+            time.sleep(backoff_delay(attempt))
+
+
+class TokenBucket:
+    """A token bucket shared by threads: `acquire(n)` blocks until n tokens are available.
+
+    The bucket may go into debt, so a request larger than the bucket (a whole
+    part, say) is let through at once and later callers wait for the debt to
+    be paid back; over time the rate never exceeds `rate` tokens per second.
+    """
+
+    def __init__(self, rate:float, capacity:Optional[float]=None):
+        """
+        Args:
+            rate (float): Tokens added per second.
+            capacity (float, optional): Most tokens the bucket holds, the size of a burst. Defaults to one second's worth.
+        """
+        self.rate = float(rate)
+        self.capacity = float(capacity or rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, amount:float=1) -> float:
+        """Take `amount` tokens, sleeping until they are available. Returns the time slept."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= amount
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+
+class AdaptiveConcurrency:
+    """Limits the S3 requests in flight across all workers, adapting the limit AIMD-style.
+
+    Each successful request raises the limit by 1/limit (one slot per round of
+    requests); a throttling response or a timeout halves it, at most once per
+    `cooldown` seconds so one burst of errors counts as one signal.
+    """
+
+    def __init__(self, maximum:int, minimum:int=1, cooldown:float=1.0):
+        self.maximum = max(1, maximum)
+        self.minimum = max(1, min(minimum, self.maximum))
+        self.cooldown = cooldown
+        self.limit = float(self.maximum)
+        self.decreases = 0
+        self._in_flight = 0
+        self._last_decrease = 0.0
+        self._condition = threading.Condition()
+
+    def acquire(self) -> None:
+        with self._condition:
+            while self._in_flight >= int(self.limit):
+                self._condition.wait()
+            self._in_flight += 1
+
+    def release(self, success:bool=True) -> None:
+        with self._condition:
+            self._in_flight -= 1
+            if success and self.limit < self.maximum:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self._condition.notify_all()
+
+    def decrease(self) -> None:
+        with self._condition:
+            now = time.monotonic()
+            if now - self._last_decrease < self.cooldown:
+                return
+            self._last_decrease = now
+            self.limit = max(self.minimum, self.limit / 2)
+            self.decreases += 1
+
+
+class Throttle:
+    """Bandwidth, request-rate and concurrency limits shared by every worker of a job.
+
+    The limits are enforced with botocore event hooks on the job's S3 client
+    (`attach`), so they cover the managed transfers, the multipart module and
+    the listings alike:
+
+    - request bodies are charged to the bandwidth bucket before each attempt
+      is sent, and response bodies when they arrive;
+    - every attempt, including retries, takes a token of the request-rate bucket;
+    - every call holds a slot of the adaptive concurrency limit while it runs.
+    """
+
+    def __init__(self, max_in_flight:int, max_bandwidth:Optional[int]=None, max_requests:Optional[float]=None):
+        """
+        Args:
+            max_in_flight (int): Most S3 requests in flight at once; the adaptive limit starts here.
+            max_bandwidth (int, optional): Bytes per second sent and received, together. Defaults to unlimited.
+            max_requests (float, optional): Requests per second. Defaults to unlimited.
+        """
+        self.concurrency = AdaptiveConcurrency(max_in_flight)
+        self.bandwidth = TokenBucket(max_bandwidth) if max_bandwidth else None
+        self.requests = TokenBucket(max_requests) if max_requests else None
+
+    def attach(self, s3:BaseClient) -> BaseClient:
+        """Register the throttling hooks on an S3 client and return it."""
+        events = s3.meta.events
+        events.register('before-call.s3', self._before_call, unique_id='s3sync-throttle-before-call')
+        events.register('before-send.s3', self._before_send, unique_id='s3sync-throttle-before-send')
+        events.register('needs-retry.s3', self._needs_retry, unique_id='s3sync-throttle-needs-retry')
+        events.register('after-call.s3', self._after_call, unique_id='s3sync-throttle-after-call')
+        events.register('after-call-error.s3', self._after_call_error, unique_id='s3sync-throttle-after-call-error')
+        return s3
+
+    def detach(self, s3:BaseClient) -> None:
+        """Remove the throttling hooks, so a shared client can be handed to the next job."""
+        events = s3.meta.events
+        for event, name in (('before-call.s3', 'before-call'), ('before-send.s3', 'before-send'), ('needs-retry.s3', 'needs-retry'),
+                            ('after-call.s3', 'after-call'), ('after-call-error.s3', 'after-call-error')):
+            events.unregister(event, unique_id=f's3sync-throttle-{name}')
+
+    def _before_call(self, context, **kwargs):
+        self.concurrency.acquire()
+        context['s3sync_slot'] = True
+
+    def _release(self, context, success):
+        if context.pop('s3sync_slot', False):
+            self.concurrency.release(success)
+
+    def _before_send(self, request, **kwargs):
+        if self.requests:
+            self.requests.acquire()
+        if self.bandwidth:
+            # Bodies sent aws-chunked (with a trailing checksum) carry their size in a separate header.
+            sent = int(request.headers.get('X-Amz-Decoded-Content-Length') or request.headers.get('Content-Length') or 0)
+            if sent:
+                self.bandwidth.acquire(sent)
+        return None
+
+    def _needs_retry(self, response=None, caught_exception=None, **kwargs):
+        if caught_exception is not None:
+            if isinstance(caught_exception, TIMEOUT_ERRORS):
+                self.concurrency.decrease()
+        elif response is not None:
+            http_response, parsed = response
+            code = (parsed or {}).get('Error', {}).get('Code')
+            if code in THROTTLE_CODES or http_response.status_code in (429, 503):
+                self.concurrency.decrease()
+        return None
+
+    def _after_call(self, http_response, model, context, **kwargs):
+        self._release(context, http_response.status_code < 300)
+        if self.bandwidth and model.has_streaming_output:
+            received = int(http_response.headers.get('content-length') or 0)
+            if received:
+                # Charged before the body is read, so the reader waits for its share.
+                self.bandwidth.acquire(received)
+
+    def _after_call_error(self, context, exception=None, **kwargs):
+        self._release(context, False)
+        if exception is not None and isinstance(exception, TIMEOUT_ERRORS):
+            self.concurrency.decrease()
+
+    def describe(self) -> str:
+        """Return a printable summary of how often the job was throttled."""
+        return (f"Throttled {self.concurrency.decreases} time(s); "
+                f"in-flight request limit {int(self.concurrency.limit)} of {self.concurrency.maximum}")
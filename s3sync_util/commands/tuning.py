@@ -0,0 +1,152 @@
+import time
+import threading
+
+from typing import Iterable, Optional
+
+from boto3.s3.transfer import TransferConfig
+from s3transfer.utils import ChunksizeAdjuster
+from s3sync_util.commands.size import format_size
+from s3sync_util.commands.common import multipart_part_size, LARGE_FILE_THRESHOLD
+
+MB = 1024 * 1024
+GB = 1024 * MB
+MAX_CONCURRENCY = 32
+
+
+class TransferSettings:
+    """Thresholds, part size and per-file concurrency used by one transfer job.
+
+    The thresholds and part size are fixed for the job, because they decide the
+    ETag an uploaded object gets. Only `max_concurrency` changes while the job
+    runs (see TransferTuner).
+    """
+
+    def __init__(self, multipart_threshold:int=8 * MB, multipart_chunksize:int=8 * MB, max_concurrency:int=10,
+                 large_file_threshold:int=LARGE_FILE_THRESHOLD):
+        """
+        Args:
+            multipart_threshold (int, optional): Files from this size on are sent in parts. Defaults to 8 MB.
+            multipart_chunksize (int, optional): Size of each part. Defaults to 8 MB.
+            max_concurrency (int, optional): Parts transferred concurrently per file. Defaults to 10.
+            large_file_threshold (int, optional): Files from this size on use the resumable multipart module. Defaults to 100 MB.
+        """
+        self.multipart_threshold = multipart_threshold
+        self.multipart_chunksize = multipart_chunksize
+        self.max_concurrency = max_concurrency
+        self.large_file_threshold = large_file_threshold
+
+    def transfer_config(self) -> TransferConfig:
+        """Return a boto3 TransferConfig for the current settings."""
+        return TransferConfig(multipart_threshold=self.multipart_threshold,
+                              max_concurrency=self.max_concurrency,
+                              multipart_chunksize=self.multipart_chunksize,
+                              use_threads=True)
+
+    def part_size(self, size:int) -> Optional[int]:
+        """Return the part size a file of the given size is uploaded with.
+
+        Args:
+            size (int): The size of the file in bytes.
+
+        Returns:
+            int: The part size in bytes, or None if the file is uploaded in a single request.
+        """
+        if size >= self.large_file_threshold:
+            return max(self.multipart_chunksize, multipart_part_size(size))
+        if size >= self.multipart_threshold:
+            return ChunksizeAdjuster().adjust_chunksize(self.multipart_chunksize, size)
+        return None
+
+    def describe(self) -> str:
+        return (f"multipart above {format_size(self.multipart_threshold)}, parts of {format_size(self.multipart_chunksize)}, "
+                f"{self.max_concurrency} part(s) in parallel per file, resumable multipart above {format_size(self.large_file_threshold)}")
+
+
+def tune_transfer(sizes:Iterable[int], workers:int=1, overrides:Optional[dict]=None) -> TransferSettings:
+    """Choose transfer settings from the file-size distribution of a job.
+
+    Small-file jobs keep whole files in single requests and rely on the worker
+    pool for parallelism. Jobs dominated by large files get bigger parts (fewer
+    requests) and more parallel parts per file, since few files are in flight
+    at a time.
+
+    Args:
+        sizes (Iterable[int]): The size of every file in the job.
+        workers (int, optional): Number of files transferred concurrently. Defaults to 1.
+        overrides (dict, optional): Settings given in the configuration or on the command line
+            (multipart_threshold, multipart_chunksize, max_concurrency); they win over the tuned values.
+
+    Returns:
+        TransferSettings: The settings for the job.
+    """
+    total_bytes = 0
+    large_files = 0
+    large_bytes = 0
+    largest = 0
+    for size in sizes:
+        total_bytes += size
+        largest = max(largest, size)
+        if size >= 64 * MB:
+            large_files += 1
+            large_bytes += size
+
+    chunksize = 16 * MB if large_bytes > total_bytes / 2 and largest >= GB else 8 * MB
+    if large_files == 0:
+        # Nothing is big enough to profit from parallel parts: one request per file.
+        concurrency = 2
+    elif large_files < max(1, workers):
+        concurrency = min(MAX_CONCURRENCY, max(10, 64 // max(1, workers)))
+    else:
+        concurrency = max(2, 32 // max(1, workers))
+
+    settings = TransferSettings(multipart_threshold=chunksize, multipart_chunksize=chunksize,
+                                max_concurrency=concurrency, large_file_threshold=max(64 * MB, 8 * chunksize))
+    for name, value in (overrides or {}).items():
+        if value is not None:
+            setattr(settings, name, value)
+    return settings
+
+
+class TransferTuner:
+    """Adjusts the per-file concurrency of a running job from its measured throughput and errors.
+
+    Every `window` finished transfers the throughput of the window is compared
+    with the best one seen so far. Concurrency climbs by one while throughput
+    keeps improving, steps back when it drops, and is halved when more than
+    5% of the transfers in the window failed.
+    """
+
+    def __init__(self, settings:TransferSettings, window:int=20, maximum:int=MAX_CONCURRENCY):
+        self.settings = settings
+        self.window = window
+        self.maximum = max(maximum, settings.max_concurrency)
+        self._lock = threading.Lock()
+        self._best_throughput = 0.0
+        self._reset_window()
+
+    def _reset_window(self):
+        self._window_start = time.monotonic()
+        self._window_bytes = 0
+        self._window_transfers = 0
+        self._window_errors = 0
+
+    def observe(self, nbytes:int, error:bool=False) -> None:
+        """Record a finished (or failed) transfer and retune once the window is full."""
+        with self._lock:
+            self._window_transfers += 1
+            self._window_bytes += 0 if error else nbytes
+            self._window_errors += int(error)
+            if self._window_transfers < self.window:
+                return
+            elapsed = max(time.monotonic() - self._window_start, 1e-9)
+            throughput = self._window_bytes / elapsed
+            concurrency = self.settings.max_concurrency
+            if self._window_errors / self._window_transfers > 0.05:
+                concurrency = max(1, concurrency // 2)
+            elif throughput > self._best_throughput * 1.05:
+                self._best_throughput = throughput
+                concurrency = min(self.maximum, concurrency + 1)
+            elif throughput < self._best_throughput * 0.9:
+                concurrency = max(1, concurrency - 1)
+            self.settings.max_concurrency = concurrency
+            self._reset_window()
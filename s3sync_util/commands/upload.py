@@ -1,17 +1,122 @@
 import sys
 import os
-import boto3
-import time
 from datetime import datetime
+from typing import Callable, Optional
 
-from botocore.exceptions import BotoCoreError, NoCredentialsError
+from botocore.client import BaseClient
+from botocore.exceptions import BotoCoreError, ClientError, NoCredentialsError
 from s3sync_util.commands.multipart import multipart_upload_to_s3
+from s3sync_util.commands.bundle import Bundler, BUNDLE_SIZE, BUNDLE_THRESHOLD, bundle_prefix, delete_superseded_bundles
+from s3sync_util.commands.dedup import STALE_SOURCE_CODES, Deduplicator
+from s3sync_util.commands.delta import PartHashes, PartReuse, hash_file, plan_reuse
+from s3sync_util.commands.compression import Compression, upload_compressed
+from s3sync_util.commands.manifest import ManifestEntry, build_manifest
 from s3sync_util.commands.size import get_total_upload_size, format_size
-from s3sync_util.commands.common import get_total_upload_objects, format_time, config
-from s3sync_util.commands.state_management import load_state, save_state, calculate_checksum
+from s3sync_util.commands.pipeline import Progress, ProgressUpdate, run_pipeline
+from s3sync_util.commands.remote_index import RemoteIndex, RemoteObject, get_remote_index
+from s3sync_util.commands.shard import Shard, parse_shard, write_summary
+from s3sync_util.commands.common import check_s3_location, get_total_upload_objects, get_s3_client
+from s3sync_util.commands.hashing import etag_matches, transfer_part_size
+from s3sync_util.commands.state_store import open_state_store
+from s3sync_util.commands.state_management import signature_matches
+from s3sync_util.commands.stats import TransferResult, TransferStats
+from s3sync_util.commands.throttle import Throttle, retry_throttled
+from s3sync_util.commands.tuning import TransferSettings, TransferTuner, tune_transfer
 
 
-def upload_to_s3(directory:str, s3_bucket:str, s3_prefix:str, exclude_list:list, dry_run:bool=False, progress:bool=False, verbose:bool=False) -> None:
+def build_record(entry:ManifestEntry, checksum:str, etag:str, codec:Optional[str]=None, parts:Optional[PartHashes]=None) -> dict:
+    """Build the state record of an uploaded file.
+
+    Args:
+        entry (ManifestEntry): The manifest entry of the uploaded file.
+        checksum (str): The MD5 checksum of the file.
+        etag (str): The ETag of the uploaded object.
+        codec (str, optional): The codec the object is stored compressed with.
+        parts (PartHashes, optional): The part hashes of a large file, for delta uploads (see delta.py).
+
+    Returns:
+        dict: The record stored under the file's relative path.
+    """
+    record = {'size': entry.size, 'mtime_ns': entry.mtime_ns, 'inode': entry.inode, 'checksum': checksum, 'etag': etag,
+              'last_modified': datetime.utcfromtimestamp(entry.mtime_ns / 1e9).isoformat(),
+              'extension': os.path.splitext(entry.relative_path)[1]}
+    if codec:
+        record['codec'] = codec
+    elif parts:
+        record['part_size'] = parts.part_size
+        record['parts'] = parts.digests
+    return record
+
+
+def is_recorded_upload(record:dict, remote:Optional[RemoteObject], index:RemoteIndex) -> bool:
+    """Check that the object a state record was written for is in the listing of the prefix uploaded to.
+
+    Records are keyed by relative path only, and the same state file serves
+    uploads to any bucket or prefix, so a record alone does not show that a
+    file is already uploaded where it is going now.
+
+    Args:
+        record (dict): The state record of the file.
+        remote (RemoteObject, optional): The object at the file's key, if any.
+        index (RemoteIndex): The listing of the prefix.
+
+    Returns:
+        bool: True if the recorded object, or the bundle holding the file, is listed.
+    """
+    if record.get('bundle'):
+        return index.get(record['bundle']) is not None
+    return remote is not None and remote.etag == record.get('etag')
+
+def upload_file_to_s3(s3:BaseClient, local_path:str, s3_bucket:str, s3_key:str, file_size:int,
+                      settings:Optional[TransferSettings]=None, log:Callable[[str], None]=print,
+                      codec:Optional[str]=None, parts:Optional[PartHashes]=None, reuse:Optional[PartReuse]=None,
+                      state_dir:Optional[str]=None) -> Optional[str]:
+    """Upload a single file, switching to multipart upload for large files.
+
+    A large file with `reuse` is uploaded as a delta: its unchanged parts are
+    copied server-side from the object at the key, and only the others are
+    sent. If that object was replaced since, the whole file is sent.
+
+    Args:
+        s3 (BaseClient): The S3 client to upload with.
+        local_path (str): The path to the local file.
+        s3_bucket (str): The name of the S3 bucket.
+        s3_key (str): The key of the uploaded object.
+        file_size (int): The size of the file in bytes.
+        settings (TransferSettings, optional): The settings of the transfer job. Defaults to the default settings.
+        log (Callable, optional): Where messages are written. Defaults to print.
+        codec (str, optional): Compress the file with this codec while uploading it (see compression.py).
+        parts (PartHashes, optional): The part hashes of a large file, whose part size the upload then uses.
+        reuse (PartReuse, optional): The parts of a large file to copy from the object at the key (see delta.plan_reuse).
+        state_dir (str, optional): Where the record of a resumable multipart upload is kept. Defaults to the working directory.
+
+    Returns:
+        str: The ETag of the object for compressed and multipart uploads; otherwise None.
+    """
+    settings = settings or TransferSettings()
+    if codec:
+        return upload_compressed(s3, local_path, s3_bucket, s3_key, codec, settings.multipart_chunksize, settings.max_concurrency)
+    if file_size >= settings.large_file_threshold:
+        file = os.path.basename(local_path)
+        part_size = parts.part_size if parts else settings.part_size(file_size)
+        if reuse:
+            log(f"\n{file} changed in {reuse.part_count - len(reuse.part_numbers)} of {reuse.part_count} part(s), "
+                f"copying the other {len(reuse.part_numbers)} from the uploaded object.")
+            try:
+                return multipart_upload_to_s3(local_path, s3, s3_bucket, s3_key, settings.max_concurrency, part_size,
+                                              reuse.part_numbers, reuse.source_etag, state_dir)
+            except ClientError as e:
+                if e.response.get('Error', {}).get('Code') not in STALE_SOURCE_CODES:
+                    raise
+                log(f"\n{s3_key} was replaced since {file} was uploaded, uploading all of it.")
+        else:
+            log(f"\n{file}'s size is over {format_size(settings.large_file_threshold)}, using multipart upload for better transfer efficiency.")
+        return multipart_upload_to_s3(local_path, s3, s3_bucket, s3_key, settings.max_concurrency, part_size, state_dir=state_dir)
+    else:
+        s3.upload_file(local_path, s3_bucket, s3_key, Config=settings.transfer_config())
+    return None
+
+def upload_to_s3(directory:str, s3_bucket:str, s3_prefix:str, exclude_list:list, dry_run:bool=False, progress:bool=False, verbose:bool=False, workers:int=1, checksum:bool=False, state_backend:str='sqlite', index_ttl:float=0, transfer_overrides:Optional[dict]=None, bundle:bool=False, bundle_threshold:int=BUNDLE_THRESHOLD, bundle_size:int=BUNDLE_SIZE, stats:Optional[TransferStats]=None, max_bandwidth:Optional[int]=None, max_requests:Optional[float]=None, s3_client:Optional[BaseClient]=None, state_dir:Optional[str]=None, interactive:bool=True, log:Callable[[str], None]=print, on_progress:Optional[Callable[[ProgressUpdate], None]]=None, dedup:bool=True, compress:Optional[list]=None, codec:Optional[str]=None, shard:Optional[Shard]=None, delta:bool=True) -> Optional[TransferResult]:
     """Upload file(s) from a directory to an S3 bucket.
 
     Args:
@@ -21,96 +126,205 @@ def upload_to_s3(directory:str, s3_bucket:str, s3_prefix:str, exclude_list:list,
         exclude_list (list): List of items to exclude from upload.
         dry_run (bool, optional): Simulate the upload process without actual upload. Defaults to False.
         verbose (bool, optional): Increase verbosity of the upload process. Defaults to False.
+        workers (int, optional): Number of concurrent upload workers. Defaults to 1.
+        checksum (bool, optional): Hash every file instead of trusting unchanged size, mtime and inode. Defaults to False.
+        state_backend (str, optional): Where sync state is kept, 'sqlite' or 'json'. Defaults to 'sqlite'.
+        index_ttl (float, optional): Reuse a cached listing of the prefix younger than this many seconds. Defaults to 0.
+        transfer_overrides (dict, optional): Transfer settings that replace the tuned ones (see tuning.tune_transfer).
+        bundle (bool, optional): Pack files smaller than `bundle_threshold` into bundle objects (see bundle.Bundler). Defaults to False.
+        bundle_threshold (int, optional): Files below this size are bundled. Defaults to 16 KB.
+        bundle_size (int, optional): Target size of each bundle. Defaults to 64 MB.
+        stats (TransferStats, optional): Collects the phase timings and S3 request metrics of the job.
+        max_bandwidth (int, optional): Bytes per second shared by all workers. Defaults to unlimited.
+        max_requests (float, optional): S3 requests per second shared by all workers. Defaults to unlimited.
+        s3_client (BaseClient, optional): A client to reuse instead of creating one for the job.
+        state_dir (str, optional): Where the sync state is kept. Defaults to the working directory.
+        interactive (bool, optional): Ask for confirmation and report errors instead of raising them. Defaults to True.
+        log (Callable, optional): Where messages are written. Defaults to print.
+        on_progress (Callable, optional): Called with a ProgressUpdate after every uploaded or skipped file.
+        dedup (bool, optional): Copy content already in the bucket server-side instead of uploading it again. Defaults to True.
+        compress (list, optional): Patterns of the files to store compressed. Defaults to none.
+        codec (str, optional): 'gzip' or 'zstd'. Defaults to zstd if the zstandard package is installed, else gzip.
+        shard (Shard, optional): Upload only this shard's files (see shard.Shard), e.g. '2/8'. Defaults to every file.
+        delta (bool, optional): Send only the changed parts of large files, copying the others server-side. Defaults to True.
+
+    Returns:
+        TransferResult: The outcome of the upload, or None if it was canceled or failed.
     """
     # if not s3_bucket or not s3_prefix:
     #     print("Error: Both --s3-bucket [S3_BUCKET] and --s3-prefix [S3_PREFIX] are required.")
     #     sys.exit(1)
 
-    if not s3_bucket or not s3_prefix:
-        if not s3_bucket and not s3_prefix:
-            print("Error: Both --s3-bucket [S3_BUCKET] and --s3-prefix [S3_PREFIX] are required.")
-        elif not s3_bucket:
-            print("Error: --s3-bucket [S3_BUCKET] is required.")
-        else:
-            print("Error: --s3-prefix [S3_PREFIX] is required.")
-        sys.exit(1)
+    check_s3_location(s3_bucket, s3_prefix, interactive)
+
+    workers = max(1, workers)
+    stats = stats or TransferStats('upload')
+    compression = Compression(compress, codec, log) if compress else None
+    shard = parse_shard(shard)
+    manifest = index = None
 
     try:
-        print("Uploading to S3:")
-        print(f"Bucket: {s3_bucket}")
-        print(f"Uploading To: {s3_prefix}")
+        log("Uploading to S3:")
+        log(f"Bucket: {s3_bucket}")
+        log(f"Uploading To: {s3_prefix}")
 
-        total_objects = get_total_upload_objects(directory, exclude_list)
-        upload_size = get_total_upload_size(directory, exclude_list)
-        print(f"Total Objects: {total_objects}")
-        print(f"Total upload size: {format_size(upload_size)}")
+        # One scan feeds the totals, the dry-run and the upload itself.
+        with stats.phase('scan'):
+            manifest = build_manifest(directory, exclude_list, shard.owns if shard else None)
+        if shard:
+            log(f"Shard {shard}: {len(manifest)} of {manifest.scanned} file(s)")
+        total_objects = get_total_upload_objects(directory, exclude_list, manifest)
+        upload_size = get_total_upload_size(directory, exclude_list, manifest)
+        log(f"Total Objects: {total_objects}")
+        log(f"Total upload size: {format_size(upload_size)}")
+        settings = tune_transfer((entry.size for entry in manifest), workers, transfer_overrides)
+        log(f"Transfer settings: {settings.describe()}")
 
-        confirm = input("Proceed with upload? (yes/no): ").lower()
+        confirm = input("Proceed with upload? (yes/no): ").lower() if interactive else 'yes'
         if confirm == 'yes':
-            state = load_state()
-
-            uploaded_files = 0
-            total_files = total_objects
-            skipped_files = 0
-            start_time = time.time()
+            state = open_state_store(state_backend, state_dir, shard)
+            tracker = Progress(total_objects, "Uploaded", progress, on_progress)
+            tuner = TransferTuner(settings)
+            s3 = stats.attach(s3_client or get_s3_client(workers, tuner.maximum))
+            throttle = Throttle(workers * tuner.maximum, max_bandwidth, max_requests)
+            throttle.attach(s3)
 
             try:
-                s3 = boto3.client('s3')
-                for root, dirs, files in os.walk(directory):
-                    dirs[:] = [d for d in dirs if d not in exclude_list]
-                    for file in files:
-                        if file not in exclude_list:
-                            local_path = os.path.join(root, file)
-                            relative_path = os.path.relpath(local_path, directory)
-                            s3_key = os.path.join(s3_prefix, relative_path)
-                            local_checksum = calculate_checksum(local_path)
-                            file_size = os.path.getsize(local_path)
-                            last_modified = os.path.getmtime(local_path)
-                            # if local_path in state and local_checksum == state[local_path]['hash']:
-                            if local_checksum in state:
-                            # if state.get(local_path, {}).get('hash') == local_checksum:
-                                if verbose:
-                                    print(f"Skipping {file} as it's already uploaded and unchanged.")
-                                skipped_files += 1
-                                continue
-                            uploaded_files += 1
-                            if uploaded_files > skipped_files:
-                                progress_percentage = (uploaded_files / (total_files - skipped_files)) * 100
-                                remaining_files = total_files - uploaded_files
-                                time_elapsed = time.time() - start_time
-                                files_per_second = uploaded_files / time_elapsed
-                                time_remaining = remaining_files / files_per_second
-                                progress_line = f"Progress: {progress_percentage:.2f}% | Uploaded: {uploaded_files}/{total_files} | Remaining: {format_time(time_remaining)}"
-                            else:
-                                progress_percentage = 0
-                                time_remaining = -1
-                                progress_line = f"Progress: {progress_percentage:.2f}% | Uploaded: {uploaded_files}/{total_files} | Remaining: N/A"
-                            if progress:
-                                sys.stdout.write("\r" + progress_line)
-                                sys.stdout.flush()
-
-                            if dry_run:
-                                print(f"\nSimulating: Would upload {file} to S3 bucket {s3_bucket} as {s3_key}")
-                            else:
-                                # print(f"Uploading {file} to S3 bucket {s3_bucket}")
-                                if verbose:
-                                    print(f"\nUploading {local_path} to S3 bucket {s3_bucket} with key {s3_key}")
-                                if file_size >= 100_000_000: # 100 MB
-                                    print(f"\n{file}'s size is over 100 MB, using multipart upload for better transfer efficiency.")
-                                    multipart_upload_to_s3(local_path, s3, s3_bucket, s3_key)
-                                else:
-                                    s3.upload_file(local_path, s3_bucket, s3_key, Config=config)
-                                last_modified_formated = datetime.utcfromtimestamp(last_modified).isoformat()
-                                state[local_checksum] = {'file': local_path, 'size': file_size, 'last_modified': last_modified_formated, 'extension': os.path.splitext(file)[1]}
-                                if verbose:
-                                    print(f"\nUploaded {file} as {s3_key}")
-                save_state(state)
-                print("\nUpload completed.")
-            except (BotoCoreError, NoCredentialsError) as e:
-                print(f"Error occurred: {e}")
+                # Objects already in the bucket, compared by ETag so files uploaded
+                # elsewhere (or before the state file existed) are not sent again.
+                with stats.phase('list'):
+                    index = get_remote_index(s3, s3_bucket, s3_prefix, index_ttl, workers, exclude_list, state_dir)
+
+                def bundled(entry, local_checksum, bundle_key):
+                    state.put(entry.relative_path, dict(build_record(entry, local_checksum, local_checksum), bundle=bundle_key))
+                    tracker.advance(entry.size)
+
+                bundler = Bundler(s3, s3_bucket, s3_prefix, bundle_size, settings, bundled, log, state_dir, index) if bundle else None
+                deduplicator = Deduplicator(s3, s3_bucket, s3_prefix, state, index, settings) if dedup else None
+                # Bundles that held files sent again by this job, and so may no longer hold any current file.
+                superseded = set()
+
+                def checksum_stage(entry):
+                    record = state.get(entry.relative_path)
+                    remote = index.get(os.path.join(s3_prefix, entry.relative_path))
+                    if record and not is_recorded_upload(record, remote, index):
+                        record = None  # written for an object that is not in this prefix
+                    # Fast path: a file whose size, mtime and inode match its record is not read at all.
+                    unchanged = not checksum and signature_matches(record, entry.size, entry.mtime_ns, entry.inode)
+                    local_checksum = local_etag = parts = None
+                    if not unchanged:
+                        local_checksum, local_etag, parts = hash_file(entry, record, settings, delta)
+                        # Content is unchanged when the file was only touched, or when a
+                        # record from a checksum-keyed state file refers to this path.
+                        touched = bool(record and record.get('checksum') == local_checksum)
+                        unchanged = touched or bool(state.pop_legacy(local_checksum, entry.path))
+                        etag = record['etag'] if touched else local_etag
+                        if not unchanged and remote and remote.size == entry.size:
+                            part_size = parts.part_size if parts else transfer_part_size(entry.size, settings)
+                            unchanged = etag_matches(entry.path, entry.size, remote.etag,
+                                                     {None: local_checksum, part_size: local_etag}, settings)
+                            etag = remote.etag
+                        if unchanged:
+                            # A touched file keeps its object, and so the codec it is stored with and its bundle.
+                            new_record = build_record(entry, local_checksum, etag, record.get('codec') if touched else None, parts)
+                            if touched and record.get('bundle'):
+                                new_record['bundle'] = record['bundle']
+                            state.put(entry.relative_path, new_record)
+                    if unchanged:
+                        if verbose:
+                            log(f"Skipping {os.path.basename(entry.path)} as it's already uploaded and unchanged.")
+                        tracker.skip()
+                        return None
+                    return entry, local_checksum, local_etag, parts
+
+                def upload_stage(item):
+                    entry, local_checksum, local_etag, parts = item
+                    local_path = entry.path
+                    file = os.path.basename(local_path)
+                    s3_key = os.path.join(s3_prefix, entry.relative_path)
+                    file_size = entry.size
+                    previous = None if dry_run else state.get(entry.relative_path)
+                    # Only bundles of this prefix: the state may also describe uploads to others.
+                    if (previous and previous.get('bundle', '').startswith(bundle_prefix(s3_prefix))
+                            and is_recorded_upload(previous, None, index)):
+                        superseded.add(previous['bundle'])
+
+                    if bundler and file_size < bundle_threshold:
+                        if dry_run:
+                            log(f"\nSimulating: Would bundle {file} as {entry.relative_path}")
+                            tracker.advance(file_size)
+                        else:
+                            bundler.add(entry)
+                        return
+                    if dry_run:
+                        log(f"\nSimulating: Would upload {file} to S3 bucket {s3_bucket} as {s3_key}")
+                    else:
+                        if verbose:
+                            log(f"\nUploading {local_path} to S3 bucket {s3_bucket} with key {s3_key}")
+                        file_codec = compression.codec_for(entry.relative_path) if compression else None
+                        try:
+                            copied = deduplicator and retry_throttled(deduplicator.copy, entry, s3_key, local_checksum, local_etag, file_codec)
+                            reuse = None if copied or file_codec else plan_reuse(state.get(entry.relative_path), parts, file_size)
+                            remote_etag = copied or retry_throttled(upload_file_to_s3, s3, local_path, s3_bucket, s3_key, file_size,
+                                                                    settings, log, file_codec, parts, reuse, state_dir)
+                        except Exception:
+                            tuner.observe(file_size, error=True)
+                            raise
+                        if not copied:
+                            # Server-side copies say nothing about the link, so only uploads tune it.
+                            tuner.observe(file_size)
+                        state.put(entry.relative_path, build_record(entry, local_checksum, remote_etag or local_etag, file_codec, parts))
+                        # Keeps a cached index current, so the next run within its TTL skips the file.
+                        index.put(s3_key, file_size, remote_etag or local_etag)
+                        if verbose:
+                            log(f"\nUploaded {file} as {s3_key}")
+                    tracker.advance(file_size)
+
+                # Checksumming and uploading each get their own pool, connected by
+                # bounded queues for back-pressure. Hashing uses every core.
+                run_pipeline(manifest, [(stats.timed('checksum', checksum_stage), os.cpu_count() or 1),
+                                        (stats.timed('transfer', upload_stage), workers)],
+                             queue_size=workers * 4)
+                if bundler:
+                    with stats.phase('transfer'):
+                        bundler.flush()
+                deleted_bundles = 0
+                if superseded:
+                    with stats.phase('delete'):
+                        deleted_bundles = delete_superseded_bundles(s3, s3_bucket, superseded, state, index, log)
+                stats.finish(tracker.transferred_files, tracker.transferred_bytes, tracker.skipped_files)
+                if shard and not dry_run:
+                    write_summary(stats.to_dict(), shard, state_dir)
+                log("\nUpload completed.")
+                log(tracker.summary())
+                if bundler and bundler.bundles_uploaded:
+                    log(f"Packed small files into {bundler.bundles_uploaded} bundle(s).")
+                if deleted_bundles:
+                    log(f"Deleted {deleted_bundles} bundle(s) whose files were all packed or uploaded again.")
+                if deduplicator and deduplicator.copied_files:
+                    log(deduplicator.describe())
+                if throttle.concurrency.decreases:
+                    log(throttle.describe())
+                return stats.result()
+            except (BotoCoreError, ClientError, NoCredentialsError) as e:
+                if not interactive:
+                    raise
+                log(f"Error occurred: {e}")
+            finally:
+                state.close()
+                throttle.detach(s3)
+                stats.detach(s3)
         else:
-            print("Upload operation canceled.")
+            log("Upload operation canceled.")
 
     except KeyboardInterrupt:
-        print("\nOperation interrupted by the user.")
+        if not interactive:
+            raise
+        log("\nOperation interrupted by the user.")
         sys.exit(0)
+    finally:
+        # The listing database and the spooled manifest, released even when the job fails.
+        if index is not None:
+            index.close()
+        if manifest is not None:
+            manifest.close()
@@ -0,0 +1,416 @@
+import os
+import sys
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+
+from typing import Callable, Dict, Optional, Set
+
+from botocore.client import BaseClient
+from botocore.exceptions import BotoCoreError, ClientError, NoCredentialsError
+from s3sync_util.commands import upload
+from s3sync_util.commands.bundle import BUNDLE_SIZE, BUNDLE_THRESHOLD
+from s3sync_util.commands.common import check_s3_location, get_s3_client
+from s3sync_util.commands.dedup import Deduplicator
+from s3sync_util.commands.delta import hash_file, plan_reuse
+from s3sync_util.commands.compression import Compression
+from s3sync_util.commands.exclude import compile_excludes, to_posix
+from s3sync_util.commands.manifest import ManifestEntry, scan_directory
+from s3sync_util.commands.pipeline import Progress, run_pipeline
+from s3sync_util.commands.shard import Shard, parse_shard
+from s3sync_util.commands.size import format_size
+from s3sync_util.commands.state_management import signature_matches
+from s3sync_util.commands.state_store import StateStore, open_state_store
+from s3sync_util.commands.throttle import Throttle, retry_throttled
+from s3sync_util.commands.tuning import MAX_CONCURRENCY, TransferTuner, tune_transfer
+
+DEBOUNCE = 1.0  # seconds without new events before a batch is uploaded
+MAX_DELAY = 10.0  # seconds a batch waits at most while events keep arriving
+POLL_INTERVAL = 2.0  # seconds between scans of the polling watcher
+
+# inotify(7) event masks.
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+# Files are picked up once written and closed, or renamed into place; new
+# directories are watched as soon as they are created.
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW
+EVENT_HEADER = struct.Struct('iIII')
+
+
+class InotifyWatcher:
+    """Reports the files created or modified under a directory, using Linux inotify.
+
+    Every directory that is not excluded gets a watch, and directories created
+    or moved in later are watched (and scanned) as they appear, so the cost of
+    watching is proportional to the changes, not to the size of the tree. If
+    the kernel event queue overflows, the whole tree is reported once; the
+    sync state then skips unchanged files without reading them.
+    """
+
+    def __init__(self, directory:str, exclude_list:list):
+        """
+        Args:
+            directory (str): The directory to watch.
+            exclude_list (list): Exclude patterns (see exclude.ExcludeMatcher).
+
+        Raises:
+            OSError: If inotify is not available or the watch limit is reached.
+        """
+        self.directory = directory
+        self.exclude_list = exclude_list
+        self.excludes = compile_excludes(exclude_list)
+        self._root_length = len(os.path.join(directory, ''))
+        self._paths: Dict[int, str] = {}
+        libc_name = ctypes.util.find_library('c')
+        if not sys.platform.startswith('linux') or not libc_name:
+            raise OSError(errno.ENOSYS, "inotify is only available on Linux")
+        self._libc = ctypes.CDLL(libc_name, use_errno=True)
+        self._fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        try:
+            self._watch_tree(directory)
+        except OSError:
+            os.close(self._fd)
+            raise
+
+    def close(self) -> None:
+        os.close(self._fd)
+
+    def _relative(self, path:str) -> str:
+        return path[self._root_length:]
+
+    def _add_watch(self, path:str) -> None:
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            if error in (errno.ENOENT, errno.ENOTDIR):
+                return  # removed again before it could be watched
+            raise OSError(error, f"{os.strerror(error)}: {path}")
+        # A directory moved within the tree keeps its watch; only its path changes.
+        self._paths[wd] = path
+
+    def _watch_tree(self, top:str) -> None:
+        pending = [top]
+        while pending:
+            current = pending.pop()
+            self._add_watch(current)
+            try:
+                with os.scandir(current) as entries:
+                    for entry in entries:
+                        if (entry.is_dir(follow_symlinks=False)
+                                and not self.excludes.matches(to_posix(self._relative(entry.path)), is_dir=True)):
+                            pending.append(entry.path)
+            except OSError:
+                continue
+
+    def wait(self, timeout:Optional[float]=None) -> Set[str]:
+        """Wait up to `timeout` seconds (forever if None) for changes.
+
+        Returns:
+            Set[str]: The relative paths of the files created or modified; empty if the wait timed out.
+        """
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return set()
+        changes = set()
+        while True:
+            try:
+                data = os.read(self._fd, 64 * 1024)
+            except BlockingIOError:
+                return changes
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+                name = os.fsdecode(data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip(b'\0'))
+                offset += EVENT_HEADER.size + length
+                self._handle(wd, mask, name, changes)
+
+    def _handle(self, wd:int, mask:int, name:str, changes:Set[str]) -> None:
+        if mask & IN_Q_OVERFLOW:
+            # Events were lost: report every file and re-watch every directory.
+            self._watch_tree(self.directory)
+            changes.update(entry.relative_path for entry in scan_directory(self.directory, self.exclude_list))
+            return
+        if mask & (IN_IGNORED | IN_DELETE_SELF):
+            self._paths.pop(wd, None)
+            return
+        parent = self._paths.get(wd)
+        if parent is None or not name:
+            return
+        path = os.path.join(parent, name)
+        relative_path = self._relative(path)
+        if mask & IN_ISDIR:
+            if mask & (IN_CREATE | IN_MOVED_TO) and not self.excludes.matches(to_posix(relative_path), is_dir=True):
+                # Files may land in a new directory before its watch exists.
+                self._watch_tree(path)
+                changes.update(entry.relative_path for entry in scan_directory(self.directory, self.exclude_list, path))
+        elif not self.excludes.matches(to_posix(relative_path)):
+            changes.add(relative_path)
+
+
+class PollingWatcher:
+    """Reports the files created or modified under a directory by rescanning it.
+
+    Used where inotify is unavailable. Each scan stats every file but reads
+    none; a file is reported when its size, mtime or inode changed.
+    """
+
+    def __init__(self, directory:str, exclude_list:list, interval:float=POLL_INTERVAL):
+        """
+        Args:
+            directory (str): The directory to watch.
+            exclude_list (list): Exclude patterns (see exclude.ExcludeMatcher).
+            interval (float, optional): Seconds between scans. Defaults to POLL_INTERVAL.
+        """
+        self.directory = directory
+        self.exclude_list = exclude_list
+        self.interval = interval
+        self._signatures = self._scan()
+        self._scanned_at = time.monotonic()
+
+    def close(self) -> None:
+        pass
+
+    def _scan(self) -> Dict[str, tuple]:
+        return {entry.relative_path: (entry.size, entry.mtime_ns, entry.inode)
+                for entry in scan_directory(self.directory, self.exclude_list)}
+
+    def wait(self, timeout:Optional[float]=None) -> Set[str]:
+        """Wait up to `timeout` seconds (forever if None) for changes.
+
+        Returns:
+            Set[str]: The relative paths of the files created or modified; empty if the wait timed out.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            next_scan = self._scanned_at + self.interval
+            if deadline is not None and next_scan > deadline:
+                time.sleep(max(0.0, deadline - time.monotonic()))
+                return set()
+            time.sleep(max(0.0, next_scan - time.monotonic()))
+            signatures = self._scan()
+            self._scanned_at = time.monotonic()
+            changes = {path for path, signature in signatures.items() if self._signatures.get(path) != signature}
+            self._signatures = signatures
+            if changes:
+                return changes
+
+
+def open_watcher(directory:str, exclude_list:list, poll_interval:float=POLL_INTERVAL, log:Callable[[str], None]=print):
+    """Return an InotifyWatcher for a directory, or a PollingWatcher where inotify cannot be used."""
+    try:
+        return InotifyWatcher(directory, exclude_list)
+    except (OSError, AttributeError) as e:
+        log(f"Warning: inotify is unavailable ({e}), polling every {poll_interval:g}s instead.")
+        return PollingWatcher(directory, exclude_list, poll_interval)
+
+
+def collect_changes(watcher, debounce:float=DEBOUNCE, max_delay:float=MAX_DELAY) -> Set[str]:
+    """Wait for changes and coalesce a burst of them into one batch.
+
+    The batch is closed once no new change arrived for `debounce` seconds, or
+    `max_delay` seconds after its first change, whichever comes first.
+    """
+    changes = watcher.wait(None)
+    deadline = time.monotonic() + max_delay
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return changes
+        more = watcher.wait(min(debounce, remaining))
+        if not more:
+            return changes
+        changes |= more
+
+
+def upload_changes(s3:BaseClient, state:StateStore, directory:str, s3_bucket:str, s3_prefix:str, relative_paths:Set[str],
+                   workers:int=1, transfer_overrides:Optional[dict]=None, verbose:bool=False,
+                   log:Callable[[str], None]=print, dedup:bool=True, compression:Optional[Compression]=None,
+                   delta:bool=True) -> Progress:
+    """Upload a batch of changed files and record them in the sync state.
+
+    Only the given files are stat'ed, hashed and uploaded: nothing is listed
+    or scanned. Files whose size, mtime and inode match their state record,
+    or whose content is unchanged, are skipped.
+
+    Args:
+        s3 (BaseClient): The S3 client to upload with.
+        state (StateStore): The sync state of the directory.
+        directory (str): The watched directory.
+        s3_bucket (str): The name of the S3 bucket.
+        s3_prefix (str): The prefix to use for S3 object keys.
+        relative_paths (Set[str]): The changed files, relative to the directory.
+        workers (int, optional): Number of concurrent upload workers. Defaults to 1.
+        transfer_overrides (dict, optional): Transfer settings that replace the tuned ones (see tuning.tune_transfer).
+        verbose (bool, optional): Log every uploaded file. Defaults to False.
+        log (Callable, optional): Where messages are written. Defaults to print.
+        dedup (bool, optional): Copy content already uploaded from other paths server-side. Defaults to True.
+        compression (Compression, optional): Which files to store compressed. Defaults to none.
+        delta (bool, optional): Send only the changed parts of large files. Defaults to True.
+
+    Returns:
+        Progress: The counters of the batch.
+    """
+    entries = []
+    for relative_path in sorted(relative_paths):
+        path = os.path.join(directory, relative_path)
+        try:
+            stat = os.stat(path, follow_symlinks=False)
+        except OSError:
+            continue  # removed or renamed away since the event
+        if os.path.isfile(path) and not os.path.islink(path):
+            entries.append(ManifestEntry(path, relative_path, stat.st_size, stat.st_mtime_ns, stat.st_ino))
+
+    tracker = Progress(len(entries), "Uploaded")
+    settings = tune_transfer((entry.size for entry in entries), workers, transfer_overrides)
+    tuner = TransferTuner(settings)
+    deduplicator = Deduplicator(s3, s3_bucket, s3_prefix, state, settings=settings) if dedup else None
+
+    def vanished(entry, error):
+        # Removed or renamed since its event; if it comes back, that raises an event of its own.
+        log(f"Error occurred while uploading {entry.path}: {error}")
+
+    def checksum_stage(entry):
+        record = state.get(entry.relative_path)
+        if signature_matches(record, entry.size, entry.mtime_ns, entry.inode):
+            tracker.skip()
+            return None
+        try:
+            local_checksum, local_etag, parts = hash_file(entry, record, settings, delta)
+        except OSError as e:
+            vanished(entry, e)
+            return None
+        if record and record.get('checksum') == local_checksum:
+            # Rewritten with the same content.
+            state.put(entry.relative_path, upload.build_record(entry, local_checksum, local_etag, record.get('codec'), parts))
+            tracker.skip()
+            return None
+        return entry, local_checksum, local_etag, parts
+
+    def upload_stage(item):
+        entry, local_checksum, local_etag, parts = item
+        s3_key = os.path.join(s3_prefix, entry.relative_path)
+        if verbose:
+            log(f"Uploading {entry.path} to S3 bucket {s3_bucket} with key {s3_key}")
+        codec = compression.codec_for(entry.relative_path) if compression else None
+        try:
+            copied = deduplicator and retry_throttled(deduplicator.copy, entry, s3_key, local_checksum, local_etag, codec)
+            reuse = None if copied or codec else plan_reuse(state.get(entry.relative_path), parts, entry.size)
+            remote_etag = copied or retry_throttled(upload.upload_file_to_s3, s3, entry.path, s3_bucket, s3_key, entry.size,
+                                                    settings, log, codec, parts, reuse)
+        except OSError as e:
+            vanished(entry, e)
+            return
+        except Exception:
+            tuner.observe(entry.size, error=True)
+            raise
+        if not copied:
+            tuner.observe(entry.size)
+        state.put(entry.relative_path, upload.build_record(entry, local_checksum, remote_etag or local_etag, codec, parts))
+        tracker.advance(entry.size)
+
+    run_pipeline(entries, [(checksum_stage, os.cpu_count() or 1), (upload_stage, workers)], queue_size=workers * 4)
+    state.commit()
+    return tracker
+
+
+def watch_directory(directory:str, s3_bucket:str, s3_prefix:str, exclude_list:list, verbose:bool=False, workers:int=1,
+                    checksum:bool=False, state_backend:str='sqlite', index_ttl:float=0, transfer_overrides:Optional[dict]=None,
+                    bundle:bool=False, bundle_threshold:int=BUNDLE_THRESHOLD, bundle_size:int=BUNDLE_SIZE,
+                    max_bandwidth:Optional[int]=None, max_requests:Optional[float]=None, debounce:float=DEBOUNCE,
+                    poll_interval:float=POLL_INTERVAL, log:Callable[[str], None]=print, dedup:bool=True,
+                    compress:Optional[list]=None, codec:Optional[str]=None, shard:Optional[Shard]=None, delta:bool=True,
+                    progress:bool=False) -> None:
+    """Upload a directory, then keep uploading the files created or modified in it until interrupted.
+
+    The watcher is started before the initial upload, so files changed while
+    it runs are picked up by the first batch. The upload settings are those
+    of upload.upload_to_s3; the initial upload runs without asking for
+    confirmation, and files changed later are uploaded individually, without
+    bundling.
+
+    Args:
+        directory (str): The directory to watch.
+        s3_bucket (str): The name of the S3 bucket.
+        s3_prefix (str): The prefix to use for S3 object keys.
+        exclude_list (list): List of items to exclude from upload.
+        verbose (bool, optional): Log every uploaded file. Defaults to False.
+        workers (int, optional): Number of concurrent upload workers. Defaults to 1.
+        checksum (bool, optional): Verify every file by checksum in the initial upload. Defaults to False.
+        state_backend (str, optional): Where sync state is kept, 'sqlite' or 'json'. Defaults to 'sqlite'.
+        index_ttl (float, optional): Reuse a cached listing of the prefix younger than this many seconds. Defaults to 0.
+        transfer_overrides (dict, optional): Transfer settings that replace the tuned ones (see tuning.tune_transfer).
+        bundle (bool, optional): Pack small files into bundles in the initial upload. Defaults to False.
+        bundle_threshold (int, optional): Files below this size are bundled. Defaults to BUNDLE_THRESHOLD.
+        bundle_size (int, optional): Target size of each bundle. Defaults to BUNDLE_SIZE.
+        max_bandwidth (int, optional): Bytes per second shared by all workers. Defaults to unlimited.
+        max_requests (float, optional): S3 requests per second shared by all workers. Defaults to unlimited.
+        debounce (float, optional): Seconds without new changes before a batch is uploaded. Defaults to DEBOUNCE.
+        poll_interval (float, optional): Seconds between scans where inotify is unavailable. Defaults to POLL_INTERVAL.
+        log (Callable, optional): Where messages are written. Defaults to print.
+        dedup (bool, optional): Copy content already in the bucket server-side instead of uploading it again. Defaults to True.
+        compress (list, optional): Patterns of the files to store compressed. Defaults to none.
+        codec (str, optional): 'gzip' or 'zstd'. Defaults to zstd if the zstandard package is installed, else gzip.
+        shard (Shard, optional): Upload only this shard's files (see shard.Shard), e.g. '2/8'. Defaults to every file.
+        delta (bool, optional): Send only the changed parts of large files. Defaults to True.
+        progress (bool, optional): Display progress statistics during the initial upload. Defaults to False.
+    """
+    check_s3_location(s3_bucket, s3_prefix)
+    shard = parse_shard(shard)
+    workers = max(1, workers)
+    compression = Compression(compress, codec, log) if compress else None
+    watcher = open_watcher(directory, exclude_list, poll_interval, log)
+    s3 = get_s3_client(workers, MAX_CONCURRENCY)
+    try:
+        upload.upload_to_s3(directory, s3_bucket, s3_prefix, exclude_list, verbose=verbose, workers=workers, checksum=checksum,
+                            state_backend=state_backend, index_ttl=index_ttl, transfer_overrides=transfer_overrides,
+                            bundle=bundle, bundle_threshold=bundle_threshold, bundle_size=bundle_size,
+                            max_bandwidth=max_bandwidth, max_requests=max_requests, s3_client=s3, interactive=False, log=log,
+                            dedup=dedup, compress=compress, codec=compression.codec if compression else None, shard=shard,
+                            delta=delta, progress=progress)
+    except (BotoCoreError, ClientError, NoCredentialsError) as e:
+        log(f"Error occurred: {e}")
+        watcher.close()
+        return
+    except KeyboardInterrupt:
+        watcher.close()
+        log("\nOperation interrupted by the user.")
+        return
+
+    throttle = Throttle(workers * MAX_CONCURRENCY, max_bandwidth, max_requests)
+    throttle.attach(s3)
+    state = open_state_store(state_backend, shard=shard)
+    log(f"\nWatching {directory} for changes (Ctrl+C to stop).")
+    pending: Set[str] = set()
+    try:
+        while True:
+            pending |= {path for path in collect_changes(watcher, debounce) if shard is None or shard.owns(path)}
+            started = time.monotonic()
+            try:
+                tracker = upload_changes(s3, state, directory, s3_bucket, s3_prefix, pending, workers, transfer_overrides,
+                                         verbose, log, dedup, compression, delta)
+            except (BotoCoreError, ClientError, NoCredentialsError) as e:
+                # The batch is retried together with the next changes.
+                log(f"Error occurred: {e}")
+                continue
+            pending = set()
+            if tracker.transferred_files:
+                log(f"Uploaded {tracker.transferred_files} changed file(s), {format_size(tracker.transferred_bytes)}, "
+                    f"in {time.monotonic() - started:.1f}s.")
+    except KeyboardInterrupt:
+        log("\nStopped watching.")
+    finally:
+        state.close()
+        watcher.close()
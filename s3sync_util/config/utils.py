@@ -1,6 +1,15 @@
 import os
 from configparser import ConfigParser
 
+# Files of s3sync itself, never transferred. This includes the temporary files of
+# interrupted transfers: uploading them is wasted, and deleting them (--delete) defeats resuming.
+# `/.state.*` covers every state backend, shard (.state.2-of-8.db) and checkpoint file with its -wal/-shm/.tmp companions.
+# The configuration, state and cache are kept in the top directory only, so their patterns are
+# anchored there and same-named files deeper down are transferred. Temporary files are written
+# beside the file being transferred, in any directory.
+DEFAULT_EXCLUDES = ['/.config.ini', '.git', '/.state.*', '/.s3sync-cache', '/.s3sync-summary*', '*.s3sync-tmp',
+                    '*.s3sync-download', '*.s3sync-download.json']
+
 def load_configuration():
     """Load configuration from a .config.ini file.
 
@@ -12,7 +21,7 @@ def load_configuration():
     config.read(config_file_path)
     return config
 
-def load_s3_config():
+def load_s3_config(warn:bool=True):
     try:
         config = load_configuration()
         s3_bucket = config.get('S3_CONFIG', 'S3_BUCKET_NAME')
@@ -22,15 +31,70 @@ def load_s3_config():
         s3_prefix = config.get('S3_CONFIG', 'S3_PREFIX')
         ignored_items = [item.strip() for item in config.get('S3_CONFIG', 'EXCLUDE', fallback='').split(',')]
     except Exception as e:
-        print(f"Warning: {e}\nNo valid configuration found. Use 's3sync config init' or provide flags.\nDefaults applied.\n")
+        if warn:
+            print(f"Warning: {e}\nNo valid configuration found. Use 's3sync config init' or provide flags.\nDefaults applied.\n")
         # s3_bucket, s3_prefix_type, s3_prefix_category, project_name, ignored_items = '', '', '', '', []
         s3_bucket, s3_prefix, ignored_items = '', '', []        
 
     # s3_prefix = f"{s3_prefix_type}/{s3_prefix_category}/{project_name}" if s3_bucket else ""
-    exclude_list = ignored_items + ['.config.ini', '.git', '.state.json']
+    exclude_list = ignored_items + DEFAULT_EXCLUDES
 
     return s3_bucket, s3_prefix, exclude_list
 
+SIZE_UNITS = {'': 1, 'B': 1, 'KB': 1024, 'MB': 1024 ** 2, 'GB': 1024 ** 3, 'KIB': 1024, 'MIB': 1024 ** 2, 'GIB': 1024 ** 3}
+
+def parse_size(value:str) -> int:
+    """Parse a size such as '8MB', '16 MiB' or '8388608' into bytes.
+
+    Args:
+        value (str): The size, optionally followed by a unit (B, KB, MB, GB; powers of 1024).
+
+    Returns:
+        int: The size in bytes.
+    """
+    text = value.strip().upper()
+    number = text.rstrip('KMGIB ')
+    unit = text[len(number):].strip()
+    if unit not in SIZE_UNITS or not number:
+        raise ValueError(f"invalid size '{value}'")
+    return int(float(number) * SIZE_UNITS[unit])
+
+def load_transfer_config():
+    """Load the transfer settings of the [TRANSFER] section of .config.ini.
+
+    Missing settings are None, which leaves them to be tuned for each job.
+
+    Returns:
+        dict: multipart_threshold, multipart_chunksize (in bytes) and max_concurrency.
+    """
+    settings = {'multipart_threshold': None, 'multipart_chunksize': None, 'max_concurrency': None}
+    try:
+        config = load_configuration()
+        if config.has_section('TRANSFER'):
+            for name in ('multipart_threshold', 'multipart_chunksize'):
+                value = config.get('TRANSFER', name.upper(), fallback='auto')
+                settings[name] = None if value.lower() == 'auto' else parse_size(value)
+            value = config.get('TRANSFER', 'MAX_CONCURRENCY', fallback='auto')
+            settings['max_concurrency'] = None if value.lower() == 'auto' else int(value)
+    except Exception as e:
+        print(f"Warning: invalid [TRANSFER] configuration: {e}\nTransfer settings will be tuned automatically.\n")
+        settings = dict.fromkeys(settings)
+    return settings
+
+def load_compression_config():
+    """Load the [COMPRESSION] section of .config.ini.
+
+    Returns:
+        tuple: The patterns of the files to store compressed (comma-separated PATTERNS), and the CODEC or None.
+    """
+    try:
+        config = load_configuration()
+        patterns = [item.strip() for item in config.get('COMPRESSION', 'PATTERNS', fallback='').split(',') if item.strip()]
+        return patterns, config.get('COMPRESSION', 'CODEC', fallback=None)
+    except Exception as e:
+        print(f"Warning: invalid [COMPRESSION] configuration: {e}\nFiles will be uploaded uncompressed.\n")
+        return [], None
+
 def init_config_interactive():
     """Interactively creates the .config.ini file based on user input."""
     try:
@@ -2,10 +2,126 @@ import argparse
 import os
 import sys
 
+from typing import Tuple
+
 from s3sync_util.config import utils
 from s3sync_util.__version__ import __version__
-from s3sync_util.commands import upload, download
 
+# The command modules (and boto3 through them) are imported by the handlers
+# below, only for the subcommand that runs, so --version, --help and
+# `config init` start without loading boto3 or reading .config.ini.
+STATE_BACKENDS = ('sqlite', 'json')
+SYNC_DIRECTIONS = ('upload', 'download')
+CODECS = ('gzip', 'zstd')
+
+
+def add_transfer_arguments(parser:argparse.ArgumentParser) -> None:
+    """Add the flags that override the automatically tuned transfer settings."""
+    parser.add_argument("--multipart-threshold", type=utils.parse_size, help="Transfer files from this size on in parts, e.g. 8MB (default: tuned per job)", default=None)
+    parser.add_argument("--multipart-chunksize", type=utils.parse_size, help="Size of each part, e.g. 16MB (default: tuned per job)", default=None)
+    parser.add_argument("--max-concurrency", type=int, help="Parts transferred concurrently per file (default: tuned per job)", default=None)
+    parser.add_argument("--max-bandwidth", type=utils.parse_size, help="Bytes per second sent and received by all workers together, e.g. 50MB (default: unlimited)", default=None)
+    parser.add_argument("--max-requests", type=float, help="S3 requests per second made by all workers together (default: unlimited)", default=None)
+
+def transfer_overrides(args:argparse.Namespace) -> dict:
+    """Merge the transfer flags over the [TRANSFER] settings of .config.ini."""
+    return {name: getattr(args, name) if getattr(args, name) is not None else value
+            for name, value in utils.load_transfer_config().items()}
+
+def add_compression_arguments(parser:argparse.ArgumentParser) -> None:
+    """Add the flags that choose which files are stored compressed."""
+    parser.add_argument("--compress", nargs='*', help="Store files matching these patterns compressed, e.g. '*.log' '*.csv' (default: [COMPRESSION] PATTERNS)", default=None)
+    parser.add_argument("--codec", choices=CODECS, help="Compression codec (default: zstd if the zstandard package is installed, else gzip)", default=None)
+
+def compression_settings(args:argparse.Namespace) -> dict:
+    """Merge the compression flags over the [COMPRESSION] section of .config.ini."""
+    patterns, codec = utils.load_compression_config()
+    return {'compress': patterns if args.compress is None else args.compress, 'codec': args.codec or codec}
+
+def shard_argument(value:str):
+    """Parse --shard I/N."""
+    from s3sync_util.commands.shard import parse_shard
+    try:
+        return parse_shard(value)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+def add_stats_arguments(parser:argparse.ArgumentParser) -> None:
+    """Add the flags that report the metrics of a transfer job."""
+    parser.add_argument("--stats", help="Print a JSON summary of phase timings and S3 requests when done", action="store_true")
+    parser.add_argument("--metrics-file", help="Write the metrics in Prometheus text format to this file (node_exporter textfile collector)", default=None)
+
+def transfer_stats(args:argparse.Namespace):
+    """Create the metrics collector of a job when --stats or --metrics-file asks for one."""
+    if not (args.stats or args.metrics_file):
+        return None
+    from s3sync_util.commands.stats import TransferStats
+    args.transfer_stats = TransferStats(args.subcommand)
+    return args.transfer_stats
+
+def s3_config(args:argparse.Namespace) -> Tuple[str, str, list]:
+    """Resolve the bucket, prefix and exclude list of a command: flags first, then .config.ini."""
+    s3_bucket, s3_prefix, exclude_list = utils.load_s3_config(warn=not (args.s3_bucket and args.s3_prefix))
+    return args.s3_bucket or s3_bucket, args.s3_prefix or s3_prefix, (getattr(args, 'exclude', None) or []) + exclude_list
+
+def run_upload(args:argparse.Namespace) -> None:
+    """Run `s3sync upload`."""
+    from s3sync_util.commands import upload, bundle
+    s3_bucket, s3_prefix, exclude_list = s3_config(args)
+    if args.watch:
+        from s3sync_util.commands import watch
+        watch.watch_directory(
+            args.directory, s3_bucket, s3_prefix, exclude_list, args.verbose, args.workers, args.checksum, args.state_backend,
+            args.index_ttl, transfer_overrides(args), args.bundle,
+            bundle.BUNDLE_THRESHOLD if args.bundle_threshold is None else args.bundle_threshold,
+            bundle.BUNDLE_SIZE if args.bundle_size is None else args.bundle_size, args.max_bandwidth, args.max_requests,
+            args.debounce, dedup=not args.no_dedup, shard=args.shard, delta=not args.no_delta, progress=args.progress,
+            **compression_settings(args)
+        )
+        return
+    upload.upload_to_s3(
+        args.directory, s3_bucket, s3_prefix, exclude_list, args.dry_run, args.progress, args.verbose, args.workers, args.checksum,
+        args.state_backend, args.index_ttl, transfer_overrides(args), args.bundle,
+        bundle.BUNDLE_THRESHOLD if args.bundle_threshold is None else args.bundle_threshold,
+        bundle.BUNDLE_SIZE if args.bundle_size is None else args.bundle_size, transfer_stats(args), args.max_bandwidth, args.max_requests,
+        dedup=not args.no_dedup, shard=args.shard, delta=not args.no_delta, **compression_settings(args)
+    )
+
+def run_download(args:argparse.Namespace) -> None:
+    """Run `s3sync download`."""
+    from s3sync_util.commands import download
+    s3_bucket, s3_prefix, exclude_list = s3_config(args)
+    download.download_from_s3(
+        s3_bucket, s3_prefix, args.directory, exclude_list, args.dry_run, args.progress, args.verbose, args.workers,
+        args.state_backend, args.index_ttl, transfer_overrides(args), transfer_stats(args), args.max_bandwidth, args.max_requests,
+        shard=args.shard
+    )
+
+def run_sync(args:argparse.Namespace) -> None:
+    """Run `s3sync sync`."""
+    from s3sync_util.commands import sync
+    s3_bucket, s3_prefix, exclude_list = s3_config(args)
+    sync.sync_with_s3(
+        args.directory, s3_bucket, s3_prefix, exclude_list, args.direction, args.delete, args.dry_run, args.progress,
+        args.verbose, args.workers, args.checksum, args.state_backend, args.index_ttl, transfer_overrides(args),
+        transfer_stats(args), args.max_bandwidth, args.max_requests, dedup=not args.no_dedup, delta=not args.no_delta,
+        **compression_settings(args)
+    )
+
+def run_cleanup(args:argparse.Namespace) -> None:
+    """Run `s3sync cleanup`."""
+    from s3sync_util.commands import cleanup
+    s3_bucket, s3_prefix, _ = s3_config(args)
+    cleanup.cleanup_multipart_uploads(s3_bucket, s3_prefix, args.older_than, args.dry_run, args.verbose)
+
+def run_state(args:argparse.Namespace) -> None:
+    """Run `s3sync state`."""
+    if args.action == 'merge':
+        from s3sync_util.commands import shard
+        shard.merge_shards(args.files, args.state_backend)
+        return
+    from s3sync_util.commands import state_store
+    state_store.import_state(args.file)
 
 def cli():
     """Main entry point for the S3Sync utility."""
@@ -23,7 +139,6 @@ def cli():
     config_parser.set_defaults(func=utils.init_config_interactive)
 
     directory = os.getcwd()
-    s3_bucket, s3_prefix, exclude_list = utils.load_s3_config()
 
     upload_parser = subparsers.add_parser(
         'upload',
@@ -32,15 +147,28 @@ def cli():
     )
 
     upload_parser.add_argument("--directory", help="Local directory to upload", default=directory)
-    upload_parser.add_argument("--s3-bucket", help="S3 bucket to upload to", default=s3_bucket)
-    upload_parser.add_argument("--s3-prefix", help="Prefix to use for S3 object keys", default=s3_prefix)
-    upload_parser.add_argument("--exclude", nargs='*', help="Exclude files or directories from upload", default=[])
+    upload_parser.add_argument("--s3-bucket", help="S3 bucket to upload to", default=None)
+    upload_parser.add_argument("--s3-prefix", help="Prefix to use for S3 object keys", default=None)
+    upload_parser.add_argument("--exclude", nargs='*', help="Exclude patterns for files or directories (gitignore syntax: globs, /anchored, dir/, !negation)", default=[])
     upload_parser.add_argument("--dry-run", help="Simulate the upload process", action="store_true")
     upload_parser.add_argument("--progress", help="Display progress statistics.", action="store_true")
     upload_parser.add_argument("--verbose", help="Verbosity of the upload process", action="store_true")
-    upload_parser.set_defaults(func=lambda args: upload.upload_to_s3(
-        args.directory, args.s3_bucket, args.s3_prefix, args.exclude + exclude_list, args.dry_run, args.progress, args.verbose
-    ))
+    upload_parser.add_argument("--workers", type=int, help="Number of files to checksum and upload concurrently", default=1)
+    upload_parser.add_argument("--checksum", help="Verify every file by checksum instead of trusting unchanged size and mtime", action="store_true")
+    upload_parser.add_argument("--no-dedup", help="Upload every file instead of copying content already in the bucket server-side", action="store_true")
+    upload_parser.add_argument("--no-delta", help="Upload changed large files whole instead of copying their unchanged parts server-side", action="store_true")
+    upload_parser.add_argument("--state-backend", choices=STATE_BACKENDS, help="Where sync state is kept", default='sqlite')
+    upload_parser.add_argument("--index-ttl", type=float, help="Reuse a cached listing of the S3 prefix younger than this many seconds", default=0)
+    upload_parser.add_argument("--bundle", help="Pack small files into bundle objects with a range-addressable index", action="store_true")
+    upload_parser.add_argument("--bundle-threshold", type=utils.parse_size, help="Files below this size are bundled (default: 16KB)", default=None)
+    upload_parser.add_argument("--bundle-size", type=utils.parse_size, help="Target size of each bundle (default: 64MB)", default=None)
+    upload_parser.add_argument("--watch", help="After uploading, keep uploading files as they are created or modified (until Ctrl+C)", action="store_true")
+    upload_parser.add_argument("--debounce", type=float, help="With --watch, seconds without new changes before a batch is uploaded (default: 1)", default=1.0)
+    upload_parser.add_argument("--shard", type=shard_argument, help="Upload only shard I of N, e.g. 2/8, so N hosts can split one upload (files are assigned by a hash of their path)", default=None)
+    add_transfer_arguments(upload_parser)
+    add_compression_arguments(upload_parser)
+    add_stats_arguments(upload_parser)
+    upload_parser.set_defaults(func=run_upload)
 
     download_parser = subparsers.add_parser(
         'download',
@@ -48,18 +176,79 @@ def cli():
         description='Effortlessly retrieve directories and files from Amazon S3 to your local environment. Whether you\'re restoring backups or accessing shared resources, this command simplifies the retrieval process. Customize download preferences such as overwriting rules and filtering to ensure you have the right files where you need them.'
     )
 
-    download_parser.add_argument("--s3-bucket", help="S3 bucket to download from", default=s3_bucket)
-    download_parser.add_argument("--s3-prefix", help="Prefix to use for S3 object keys", default=s3_prefix)
+    download_parser.add_argument("--s3-bucket", help="S3 bucket to download from", default=None)
+    download_parser.add_argument("--s3-prefix", help="Prefix to use for S3 object keys", default=None)
     download_parser.add_argument("--directory", help="Local directory to save downloaded files", default=directory)
-    download_parser.add_argument("--exclude", nargs='*', help="Exclude files or directories from download", default=[])
+    download_parser.add_argument("--exclude", nargs='*', help="Exclude patterns for files or directories (gitignore syntax: globs, /anchored, dir/, !negation)", default=[])
     download_parser.add_argument("--dry-run", help="Simulate the download process", action="store_true")
     download_parser.add_argument("--progress", help="Display progress statistics.", action="store_true")
     download_parser.add_argument("--verbose", help="Verbosity of the download process", action="store_true")
-    download_parser.set_defaults(func=lambda args: download.download_from_s3(
-        args.s3_bucket, args.s3_prefix, args.directory, args.exclude + exclude_list, args.dry_run, args.progress, args.verbose
-    ))
+    download_parser.add_argument("--workers", type=int, help="Number of files to download concurrently", default=1)
+    download_parser.add_argument("--state-backend", choices=STATE_BACKENDS, help="Where sync state is kept", default='sqlite')
+    download_parser.add_argument("--index-ttl", type=float, help="Reuse a cached listing of the S3 prefix younger than this many seconds", default=0)
+    download_parser.add_argument("--shard", type=shard_argument, help="Download only shard I of N, e.g. 2/8, so N hosts can split one download (objects are assigned by a hash of their key)", default=None)
+    add_transfer_arguments(download_parser)
+    add_stats_arguments(download_parser)
+    download_parser.set_defaults(func=run_download)
+
+    sync_parser = subparsers.add_parser(
+        'sync',
+        help='Mirror a directory and an S3 prefix',
+        description='Compare a local directory with an S3 prefix, print a plan of new, changed, unchanged, local-only and remote-only files with the bytes and requests involved, and then execute it in parallel. Use --delete to remove files that exist only at the destination.'
+    )
+
+    sync_parser.add_argument("--directory", help="Local directory to sync", default=directory)
+    sync_parser.add_argument("--s3-bucket", help="S3 bucket to sync with", default=None)
+    sync_parser.add_argument("--s3-prefix", help="Prefix to use for S3 object keys", default=None)
+    sync_parser.add_argument("--direction", choices=SYNC_DIRECTIONS, help="upload mirrors the directory to S3, download mirrors S3 to the directory", default='upload')
+    sync_parser.add_argument("--delete", help="Delete files that exist only at the destination", action="store_true")
+    sync_parser.add_argument("--exclude", nargs='*', help="Exclude patterns for files or directories (gitignore syntax: globs, /anchored, dir/, !negation)", default=[])
+    sync_parser.add_argument("--dry-run", help="Print the sync plan without executing it", action="store_true")
+    sync_parser.add_argument("--progress", help="Display progress statistics.", action="store_true")
+    sync_parser.add_argument("--verbose", help="Verbosity of the sync process", action="store_true")
+    sync_parser.add_argument("--workers", type=int, help="Number of files to transfer concurrently", default=1)
+    sync_parser.add_argument("--checksum", help="Verify every file by checksum instead of trusting unchanged size and mtime", action="store_true")
+    sync_parser.add_argument("--no-dedup", help="Upload every file instead of copying content already in the bucket server-side", action="store_true")
+    sync_parser.add_argument("--no-delta", help="Upload changed large files whole instead of copying their unchanged parts server-side", action="store_true")
+    sync_parser.add_argument("--state-backend", choices=STATE_BACKENDS, help="Where sync state is kept", default='sqlite')
+    sync_parser.add_argument("--index-ttl", type=float, help="Reuse a cached listing of the S3 prefix younger than this many seconds", default=0)
+    add_transfer_arguments(sync_parser)
+    add_compression_arguments(sync_parser)
+    add_stats_arguments(sync_parser)
+    sync_parser.set_defaults(func=run_sync)
+
+    cleanup_parser = subparsers.add_parser(
+        'cleanup',
+        help='Abort stale multipart uploads',
+        description='Find multipart uploads under the prefix that were never completed, and abort them so their stored parts stop being billed.'
+    )
+
+    cleanup_parser.add_argument("--s3-bucket", help="S3 bucket to clean up", default=None)
+    cleanup_parser.add_argument("--s3-prefix", help="Prefix to look for uploads under", default=None)
+    cleanup_parser.add_argument("--older-than", type=float, help="Only abort uploads initiated more than this many hours ago", default=24)
+    cleanup_parser.add_argument("--dry-run", help="List the stale uploads without aborting them", action="store_true")
+    cleanup_parser.add_argument("--verbose", help="List every stale upload", action="store_true")
+    cleanup_parser.set_defaults(func=run_cleanup)
+
+    state_parser = subparsers.add_parser(
+        'state',
+        help='Manage the sync state',
+        description='Maintain the local record of synced files. The state is kept in .state.db and committed periodically during transfers, so an interrupted upload or download resumes where it stopped.'
+    )
+
+    state_parser.add_argument("action", choices=['import', 'merge'], help="import: load a .state.json file into .state.db; merge: combine the state and summaries of --shard jobs")
+    state_parser.add_argument("--file", help="JSON state file to import (defaults to .state.json)", default=None)
+    state_parser.add_argument("--files", nargs='*', help="Shard state files to merge (defaults to the .state.I-of-N files in the working directory)", default=None)
+    state_parser.add_argument("--state-backend", choices=STATE_BACKENDS, help="Backend of the merged state", default='sqlite')
+    state_parser.set_defaults(func=run_state)
 
     args = parser.parse_args()
+    if args.subcommand == 'upload' and args.watch:
+        # A watch runs until interrupted, uploading for real, so it has no end to report or simulate.
+        unsupported = [flag for flag, given in (('--dry-run', args.dry_run), ('--stats', args.stats),
+                                                ('--metrics-file', args.metrics_file)) if given]
+        if unsupported:
+            upload_parser.error(f"{', '.join(unsupported)} cannot be combined with --watch")
 
     if args.subcommand == 'config':
         if hasattr(args, 'func'):
@@ -67,6 +256,9 @@ def cli():
     elif hasattr(args, 'func'):
         try:
             args.func(args)
+            if getattr(args, 'transfer_stats', None):
+                from s3sync_util.commands.stats import report_stats
+                report_stats(args.transfer_stats, args.stats, args.metrics_file)
         except Exception as e:
             print(f"An error occurred: {e}")
             sys.exit(1)
@@ -0,0 +1,43 @@
+import os
+
+import boto3
+import pytest
+
+from moto import mock_aws
+
+BUCKET = 's3sync-test'
+
+
+@pytest.fixture
+def s3(tmp_path, monkeypatch):
+    """An S3 client of moto's in-process mock with an empty bucket, run from a scratch working directory."""
+    for name, value in (('AWS_ACCESS_KEY_ID', 'test'), ('AWS_SECRET_ACCESS_KEY', 'test'), ('AWS_DEFAULT_REGION', 'us-east-1')):
+        monkeypatch.setenv(name, value)
+    monkeypatch.delenv('AWS_ENDPOINT_URL', raising=False)
+    monkeypatch.chdir(tmp_path)
+    with mock_aws():
+        client = boto3.client('s3')
+        client.create_bucket(Bucket=BUCKET)
+        yield client
+
+
+def make_tree(root, files:dict) -> str:
+    """Write `files` ({relative path: bytes or str}) under `root` and return it."""
+    for relative_path, content in files.items():
+        path = os.path.join(root, relative_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(content.encode() if isinstance(content, str) else content)
+    return str(root)
+
+
+def list_keys(s3, prefix:str) -> list:
+    """Return every key under a prefix, sorted."""
+    keys = []
+    for page in s3.get_paginator('list_objects_v2').paginate(Bucket=BUCKET, Prefix=prefix):
+        keys.extend(obj['Key'] for obj in page.get('Contents', []))
+    return sorted(keys)
+
+
+def quiet(*args) -> None:
+    """A `log` that drops every message."""
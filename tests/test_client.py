@@ -0,0 +1,27 @@
+import os
+
+from s3sync_util.client import SyncClient
+from tests.conftest import BUCKET, list_keys, make_tree
+
+MB = 1024 * 1024
+
+
+def test_jobs_write_their_cache_under_their_state_directory(s3, tmp_path, monkeypatch):
+    source = make_tree(tmp_path / 'src', {'small.txt': 'small', 'big.bin': 'x' * (6 * MB)})
+    target = tmp_path / 'dst'
+    cwd = tmp_path / 'cwd'
+    cwd.mkdir()
+    monkeypatch.chdir(cwd)
+    state_root = str(tmp_path / 'state')
+
+    # Bundled small files, and a multipart upload of the large one.
+    with SyncClient(workers=2, state_root=state_root, transfer_overrides={'large_file_threshold': 5 * MB}) as client:
+        client.upload(source, BUCKET, 'pre', bundle=True)
+        client.download(BUCKET, 'pre', str(target))
+        client.sync(source, BUCKET, 'pre')
+
+    assert os.listdir(cwd) == []
+    assert any(key.startswith('pre/.s3sync-bundles/') for key in list_keys(s3, 'pre/'))
+    assert os.path.getsize(target / 'big.bin') == 6 * MB
+    state_dir = client.state_dir(BUCKET, 'pre', source)
+    assert os.listdir(os.path.join(state_dir, '.s3sync-cache'))
@@ -0,0 +1,71 @@
+import os
+import gzip
+
+import pytest
+
+from s3sync_util.commands.compression import CODEC_METADATA, SIZE_METADATA, save_object, upload_compressed, zstandard
+from s3sync_util.commands.download import download_file_from_s3, download_from_s3
+from s3sync_util.commands.hashing import MB
+from s3sync_util.commands.upload import upload_to_s3
+from tests.conftest import BUCKET, make_tree, quiet
+
+CODECS = ['gzip', pytest.param('zstd', marks=pytest.mark.skipif(zstandard is None, reason='zstandard is not installed'))]
+
+
+def decompress(data:bytes, codec:str) -> bytes:
+    return gzip.decompress(data) if codec == 'gzip' else zstandard.ZstdDecompressor().decompressobj().decompress(data)
+
+
+@pytest.mark.parametrize('codec', CODECS)
+@pytest.mark.parametrize('content', [
+    b'compressible text\n' * 10000,
+    # Incompressible, and larger than a part: sent as a multipart upload.
+    os.urandom(12 * MB),
+], ids=['single', 'multipart'])
+def test_compressed_upload_round_trip(s3, tmp_path, codec, content):
+    path = os.path.join(make_tree(tmp_path, {'data.log': content}), 'data.log')
+    etag = upload_compressed(s3, path, BUCKET, 'data.log', codec, part_size=5 * MB)
+
+    head = s3.head_object(Bucket=BUCKET, Key='data.log')
+    assert head['ETag'].strip('"') == etag
+    assert head['ContentEncoding'] == codec
+    assert head['Metadata'] == {CODEC_METADATA: codec, SIZE_METADATA: str(len(content))}
+    # What is stored is the compressed stream of the file.
+    stored = s3.get_object(Bucket=BUCKET, Key='data.log')['Body'].read()
+    assert decompress(stored, codec) == content
+
+    restored = str(tmp_path / 'restored.log')
+    save_object(s3.get_object(Bucket=BUCKET, Key='data.log'), restored)
+    with open(restored, 'rb') as f:
+        assert f.read() == content
+    assert not os.path.exists(f"{restored}.s3sync-tmp")
+
+
+@pytest.mark.parametrize('size', [1000, 12 * MB], ids=['get', 'head'])
+def test_download_picks_the_codec_from_the_object_metadata(s3, tmp_path, size):
+    content = os.urandom(size)
+    compressed = gzip.compress(content)
+    s3.put_object(Bucket=BUCKET, Key='tagged', Body=compressed, ContentEncoding='gzip', Metadata={CODEC_METADATA: 'gzip'})
+    # Compressed data s3sync did not store: only the metadata decides, not the name or Content-Encoding.
+    s3.put_object(Bucket=BUCKET, Key='untagged.gz', Body=compressed, ContentEncoding='gzip')
+
+    for key, expected in (('tagged', content), ('untagged.gz', compressed)):
+        path = str(tmp_path / key)
+        download_file_from_s3(s3, BUCKET, key, path, len(compressed), log=quiet)
+        with open(path, 'rb') as f:
+            assert f.read() == expected
+
+
+def test_compressed_files_are_restored_by_a_download(s3, tmp_path):
+    files = {'app.log': 'log line\n' * 5000, 'data.bin': os.urandom(2000)}
+    source = make_tree(tmp_path / 'src', files)
+    upload_to_s3(source, BUCKET, 'pre', [], compress=['*.log'], codec='gzip', interactive=False, log=quiet)
+    assert s3.head_object(Bucket=BUCKET, Key='pre/app.log')['Metadata'][CODEC_METADATA] == 'gzip'
+    assert CODEC_METADATA not in s3.head_object(Bucket=BUCKET, Key='pre/data.bin')['Metadata']
+
+    target = tmp_path / 'dst'
+    (tmp_path / 'down').mkdir()
+    download_from_s3(BUCKET, 'pre', str(target), [], state_dir=str(tmp_path / 'down'), interactive=False, log=quiet)
+    for name, content in files.items():
+        with open(target / name, 'rb') as f:
+            assert f.read() == (content.encode() if isinstance(content, str) else content)
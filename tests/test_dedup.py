@@ -0,0 +1,67 @@
+import os
+
+from s3sync_util.commands.upload import upload_to_s3
+from tests.conftest import BUCKET, list_keys, make_tree
+
+CONTENT = 'the same content ' * 100
+
+
+class Calls:
+    """Records the keys of the PutObject and CopyObject calls of a client."""
+
+    def __init__(self, s3):
+        self.s3 = s3
+        self.puts = []
+        self.copies = []
+        s3.meta.events.register('provide-client-params.s3.PutObject', self.on_put)
+        s3.meta.events.register('provide-client-params.s3.CopyObject', self.on_copy)
+
+    def on_put(self, params, **kwargs):
+        self.puts.append(params['Key'])
+
+    def on_copy(self, params, **kwargs):
+        self.copies.append(params['Key'])
+
+
+def upload(s3, source):
+    messages = []
+    result = upload_to_s3(source, BUCKET, 'pre', [], workers=1, s3_client=s3, interactive=False, log=messages.append)
+    return result, messages
+
+
+def read(s3, key:str) -> str:
+    return s3.get_object(Bucket=BUCKET, Key=key)['Body'].read().decode()
+
+
+def test_identical_file_is_copied_instead_of_uploaded(s3, tmp_path):
+    source = make_tree(tmp_path / 'src', {'a/data.txt': CONTENT, 'b/data.txt': CONTENT, 'c.txt': 'other'})
+    calls = Calls(s3)
+    result, messages = upload(s3, source)
+
+    assert result.files_transferred == 3
+    # Whichever of the identical files comes second is copied from the first.
+    assert len(calls.puts) == 2 and 'pre/c.txt' in calls.puts
+    assert len(calls.copies) == 1
+    assert sorted(calls.puts + calls.copies) == ['pre/a/data.txt', 'pre/b/data.txt', 'pre/c.txt']
+    assert read(s3, 'pre/a/data.txt') == read(s3, 'pre/b/data.txt') == CONTENT
+    assert any(message.startswith('Deduplicated 1 file(s)') for message in messages)
+
+
+def test_copy_from_a_deleted_source_falls_back_to_an_upload(s3, tmp_path):
+    source = make_tree(tmp_path / 'src', {'first.txt': CONTENT})
+    upload(s3, source)
+    # The state still records the object, but it is gone from the bucket.
+    s3.delete_object(Bucket=BUCKET, Key='pre/first.txt')
+    os.remove(os.path.join(source, 'first.txt'))
+
+    make_tree(source, {'second.txt': CONTENT})
+    calls = Calls(s3)
+    result, messages = upload(s3, source)
+
+    assert result.files_transferred == 1
+    # The conditional copy from the recorded object fails, and the file is uploaded instead.
+    assert calls.copies == ['pre/second.txt']
+    assert calls.puts == ['pre/second.txt']
+    assert read(s3, 'pre/second.txt') == CONTENT
+    assert list_keys(s3, 'pre/') == ['pre/second.txt']
+    assert not any(message.startswith('Deduplicated') for message in messages)
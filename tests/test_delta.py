@@ -0,0 +1,53 @@
+import os
+
+from s3sync_util.commands.hashing import MB, digest_file_parts
+from s3sync_util.commands.upload import upload_to_s3
+from tests.conftest import BUCKET, make_tree, quiet
+
+PART_SIZE = 5 * MB
+# Files from 10 MB on go through the resumable multipart module, and so are uploaded as deltas.
+OVERRIDES = {'large_file_threshold': 10 * MB, 'multipart_chunksize': PART_SIZE}
+
+
+class PartCalls:
+    """Records the numbers of the parts a client sends and copies."""
+
+    def __init__(self, s3):
+        self.sent = []
+        self.copied = []
+        s3.meta.events.register('provide-client-params.s3.UploadPart', self.on_send)
+        s3.meta.events.register('provide-client-params.s3.UploadPartCopy', self.on_copy)
+
+    def on_send(self, params, **kwargs):
+        self.sent.append(params['PartNumber'])
+
+    def on_copy(self, params, **kwargs):
+        self.copied.append(params['PartNumber'])
+
+
+def upload(s3, source, **options):
+    return upload_to_s3(source, BUCKET, 'pre', [], transfer_overrides=OVERRIDES, s3_client=s3, interactive=False, log=quiet,
+                        **options)
+
+
+def test_changed_part_is_the_only_one_uploaded(s3, tmp_path):
+    content = bytearray(os.urandom(4 * PART_SIZE + 100))
+    source = make_tree(tmp_path / 'src', {'big.bin': bytes(content)})
+    path = os.path.join(source, 'big.bin')
+    upload(s3, source)
+
+    # Overwrite a few bytes in the middle of the third part.
+    content[2 * PART_SIZE + 1000:2 * PART_SIZE + 1010] = b'0123456789'
+    with open(path, 'r+b') as f:
+        f.seek(2 * PART_SIZE + 1000)
+        f.write(b'0123456789')
+    calls = PartCalls(s3)
+    assert upload(s3, source).files_transferred == 1
+
+    assert sorted(calls.sent) == [3]
+    assert sorted(calls.copied) == [1, 2, 4, 5]
+    assert s3.get_object(Bucket=BUCKET, Key='pre/big.bin')['Body'].read() == content
+    # The object has the ETag of a full upload with the same part size.
+    etag = s3.head_object(Bucket=BUCKET, Key='pre/big.bin')['ETag'].strip('"')
+    assert etag == digest_file_parts(path, PART_SIZE)[1]
+
@@ -0,0 +1,87 @@
+import pytest
+
+from s3sync_util.commands.exclude import compile_excludes
+from s3sync_util.config.utils import DEFAULT_EXCLUDES
+
+
+@pytest.mark.parametrize('path, excluded', [
+    ('.state.db', True),
+    ('.state.2-of-8.db-wal', True),
+    ('.s3sync-summary.json', True),
+    ('.s3sync-cache/uploads/x.json', True),
+    ('.config.ini', True),
+    ('.git/HEAD', True),
+    ('sub/.git/HEAD', True),
+    ('sub/big.bin.s3sync-download', True),
+    ('sub/big.bin.s3sync-download.json', True),
+    ('sub/a.txt.s3sync-tmp', True),
+    # Files of the user that merely share a name with s3sync's own, below the top directory.
+    ('data/.state.yaml', False),
+    ('data/.s3sync-summary.txt', False),
+    ('data/.s3sync-cache/notes.txt', False),
+    ('app/.config.ini', False),
+])
+def test_default_excludes(path, excluded):
+    assert compile_excludes(DEFAULT_EXCLUDES).is_excluded(path) is excluded
+
+
+@pytest.mark.parametrize('patterns, path, is_dir, excluded', [
+    # A name without a slash matches at any depth, and only whole names.
+    (['.git'], '.git', True, True),
+    (['.git'], 'a/b/.git', True, True),
+    (['.git'], 'a/.git/config', False, True),
+    (['.git'], 'foo.github.io', True, False),
+    (['.git'], 'foo.github.io/index.html', False, False),
+    (['.git'], 'a/.gitignore', False, False),
+    # A slash anchors the pattern to the root.
+    (['/build'], 'build/out.o', False, True),
+    (['/build'], 'src/build/out.o', False, False),
+    (['build'], 'src/build/out.o', False, True),
+    (['docs/*.tmp'], 'docs/a.tmp', False, True),
+    (['docs/*.tmp'], 'docs/sub/a.tmp', False, False),
+    (['docs/*.tmp'], 'src/docs/a.tmp', False, False),
+    (['docs/**/*.tmp'], 'docs/sub/deeper/a.tmp', False, True),
+    (['docs/**/*.tmp'], 'docs/a.tmp', False, True),
+    # A trailing slash matches directories only.
+    (['cache/'], 'cache', True, True),
+    (['cache/'], 'cache', False, False),
+    (['cache/'], 'a/cache/file', False, True),
+    (['cache/'], 'a/cache', False, False),
+    # Globs do not cross '/'.
+    (['*.log'], 'a/b/c.log', False, True),
+    (['a/*'], 'a/b/c.txt', False, True),
+    (['a?c'], 'abc', False, True),
+    (['a?c'], 'a/c', False, False),
+    (['[ab].txt'], 'b.txt', False, True),
+    (['[!ab].txt'], 'b.txt', False, False),
+    # Negation: the last matching pattern wins...
+    (['*.log', '!keep.log'], 'keep.log', False, False),
+    (['*.log', '!keep.log'], 'a/keep.log', False, False),
+    (['*.log', '!keep.log'], 'drop.log', False, True),
+    (['!keep.log', '*.log'], 'keep.log', False, True),
+    # ...but nothing is re-included from an excluded directory.
+    (['logs/', '!logs/keep.log'], 'logs/keep.log', False, True),
+    (['logs/*', '!logs/keep.log'], 'logs/keep.log', False, False),
+    # Comments and blank patterns are ignored.
+    (['# *.txt', ''], 'a.txt', False, False),
+])
+def test_is_excluded(patterns, path, is_dir, excluded):
+    assert compile_excludes(patterns).is_excluded(path, is_dir) is excluded
+
+
+@pytest.mark.parametrize('patterns, key, excluded', [
+    # Keys ending with '/' are the common prefixes of a delimited listing: directories to prune.
+    (['node_modules'], 'pre/app/node_modules/', True),
+    (['node_modules'], 'pre/app/node_modules/x/y.js', True),
+    (['node_modules'], 'pre/app/src/', False),
+    (['cache/'], 'pre/cache/', True),
+    (['cache/'], 'pre/cache', False),
+    (['/build'], 'pre/build/', True),
+    (['/build'], 'pre/src/build/', False),
+    (['*.tmp'], 'pre/a/b.tmp', True),
+    # The prefix itself is not part of the path patterns are matched against.
+    (['pre'], 'pre/a.txt', False),
+    (['.git'], 'pre/foo.github.io/', False),
+])
+def test_excludes_key(patterns, key, excluded):
+    assert compile_excludes(patterns).excludes_key(key, 'pre') is excluded
@@ -0,0 +1,61 @@
+import os
+
+import pytest
+
+from s3sync_util.commands.hashing import MB, candidate_part_sizes, digest_file_parts, etag_matches
+from tests.conftest import BUCKET
+
+
+def write_file(path, size:int) -> str:
+    # Varied bytes, so that every part has a digest of its own.
+    with open(path, 'wb') as f:
+        f.write(os.urandom(size))
+    return str(path)
+
+
+def upload_in_parts(s3, key:str, path:str, part_size:int) -> str:
+    """Upload a file with the S3 multipart API, the way another client would, and return the ETag S3 gives it."""
+    upload_id = s3.create_multipart_upload(Bucket=BUCKET, Key=key)['UploadId']
+    parts = []
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(part_size)
+            if not data:
+                break
+            response = s3.upload_part(Bucket=BUCKET, Key=key, UploadId=upload_id, PartNumber=len(parts) + 1, Body=data)
+            parts.append({'PartNumber': len(parts) + 1, 'ETag': response['ETag']})
+    s3.complete_multipart_upload(Bucket=BUCKET, Key=key, UploadId=upload_id, MultipartUpload={'Parts': parts})
+    return s3.head_object(Bucket=BUCKET, Key=key)['ETag'].strip('"')
+
+
+def test_multipart_etag_matches_the_one_s3_computes(s3, tmp_path):
+    path = write_file(tmp_path / 'data.bin', 12 * MB + 1234)
+    etag = upload_in_parts(s3, 'data.bin', path, 5 * MB)
+
+    checksum, local_etag, parts = digest_file_parts(path, 5 * MB)
+    assert local_etag == etag
+    assert etag.endswith('-3') and len(parts) == 3
+    # Without a part size, the ETag is that of a single-request upload: the MD5.
+    assert digest_file_parts(path) == (checksum, checksum, [])
+
+
+@pytest.mark.parametrize('part_size', [
+    6 * MB,  # not a default anywhere: found by dividing the size by the number of parts
+    5 * MB,  # one of the common part sizes of other clients
+])
+def test_etag_matches_guesses_the_part_size_of_another_client(s3, tmp_path, part_size):
+    path = write_file(tmp_path / 'data.bin', 3 * part_size - 100)
+    etag = upload_in_parts(s3, 'data.bin', path, part_size)
+
+    assert etag_matches(path, os.path.getsize(path), f'"{etag}"')
+
+    # A file of the same size with other content does not match.
+    other = write_file(tmp_path / 'other.bin', 3 * part_size - 100)
+    assert not etag_matches(other, os.path.getsize(other), etag)
+
+
+def test_candidate_part_sizes_only_yields_sizes_giving_the_part_count():
+    # This tool's own part size first, then the whole-MB size giving the part count.
+    assert list(candidate_part_sizes(18 * MB - 100, 3)) == [8 * MB, 6 * MB]
+    assert list(candidate_part_sizes(20 * MB, 3)) == [8 * MB, 7 * MB]
+    assert list(candidate_part_sizes(20 * MB, 4)) == [5 * MB]
@@ -0,0 +1,134 @@
+import io
+import os
+import sys
+import json
+import hashlib
+import resource
+import subprocess
+
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from tests.conftest import BUCKET, quiet
+
+PREFIX = 'memory'
+# How many times more files the larger job has.
+FACTOR = 8
+# Files per bundle in the download job.
+BUNDLE_FILES = 1000
+# Extra peak RSS the larger job may need: the bounded caches (the SQLite page
+# caches, the manifest spool) fill up as the job grows.
+SLACK_MB = 16
+
+
+def file_path(i:int) -> str:
+    """Return the path of the i-th file; each is in a directory of its own, for the exclude matcher."""
+    return f"d{i:08d}/f.bin"
+
+
+def peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS.
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+class StandIn:
+    """Answers the S3 calls of a job from a botocore hook, generating every response and storing nothing.
+
+    The prefix holds `count` objects and, for downloads and syncs, the same files again
+    in newer bundles of BUNDLE_FILES members each. Listing pages are generated
+    from their continuation token, so S3 itself costs the memory of one page.
+    """
+
+    def __init__(self, count:int, bundles:bool):
+        self.count = count
+        self.bundle_count = -(-count // BUNDLE_FILES) if bundles else 0
+        self.last_modified = datetime.now(timezone.utc) - timedelta(days=1)
+
+    def key(self, i:int) -> str:
+        if i < self.count:
+            return f"{PREFIX}/{file_path(i)}"
+        bundle, suffix = divmod(i - self.count, 2)
+        return f"{PREFIX}/.s3sync-bundles/{bundle:020d}.tar" + ('.index.json' if suffix else '')
+
+    def answer(self, model, params, **kwargs):
+        from botocore.awsrequest import AWSResponse
+        response = AWSResponse('https://stand-in/', 200, {}, None)
+        metadata = {'HTTPStatusCode': 200, 'HTTPHeaders': {}}
+        if model.name == 'GetObject':
+            bundle = int(params['url_path'].rsplit('/', 1)[1].split('.')[0])
+            first = bundle * BUNDLE_FILES
+            members = [[file_path(i), 512 * (i - first + 1), 0, hashlib.md5(b'').hexdigest(), 0]
+                       for i in range(first, min(self.count, first + BUNDLE_FILES))]
+            body = json.dumps({'members': members}).encode()
+            return response, {'Body': io.BytesIO(body), 'ContentLength': len(body), 'ResponseMetadata': metadata}
+        assert model.name == 'ListObjectsV2', model.name
+        query = params['query_string']
+        total = self.count + 2 * self.bundle_count
+        start = int(query.get('continuation-token') or 0)
+        # Everything is returned to the first listing; the listings of sub-prefixes are empty.
+        end = min(total, start + 1000) if query.get('prefix', '').rstrip('/') == PREFIX else start
+        contents = []
+        for i in range(start, end):
+            newer = i >= self.count
+            contents.append({'Key': self.key(i), 'Size': 0 if i < self.count else 1024,
+                             'LastModified': self.last_modified + timedelta(hours=newer),
+                             'ETag': f'"{hashlib.md5(b"").hexdigest()}"', 'StorageClass': 'STANDARD'})
+        parsed = {'Contents': contents, 'KeyCount': len(contents), 'IsTruncated': end < total, 'ResponseMetadata': metadata}
+        if end < total:
+            parsed['NextContinuationToken'] = str(end)
+        return response, parsed
+
+
+def run_job(operation:str, count:int, work_dir:str) -> None:
+    """Run a dry-run upload, download or download sync of `count` files and print the peak RSS of the process."""
+    import boto3
+    from s3sync_util.commands.upload import upload_to_s3
+    from s3sync_util.commands.download import download_from_s3
+    from s3sync_util.commands.sync import sync_with_s3
+
+    source = os.path.join(work_dir, 'source')
+    for i in range(count if operation == 'upload' else 0):
+        path = os.path.join(source, file_path(i))
+        os.makedirs(os.path.dirname(path))
+        open(path, 'wb').close()
+    boto3.setup_default_session()
+    boto3.DEFAULT_SESSION.events.register('before-call.s3', StandIn(count, operation != 'upload').answer)
+    os.chdir(work_dir)
+    options = dict(dry_run=True, workers=4, state_dir=work_dir, interactive=False, log=quiet)
+    if operation == 'upload':
+        result = upload_to_s3(source, BUCKET, PREFIX, ['*.tmp'], **options)
+        assert result.files_skipped == count
+    elif operation == 'download':
+        result = download_from_s3(BUCKET, PREFIX, os.path.join(work_dir, 'target'), ['*.tmp'], **options)
+        assert result.files_transferred == count
+    else:
+        target = os.path.join(work_dir, 'target')
+        os.makedirs(target)
+        summary = []
+        options['log'] = lambda message: summary.append(message) if message.startswith('Sync plan') else None
+        sync_with_s3(target, BUCKET, PREFIX, ['*.tmp'], direction='download', delete=True, **options)
+        # Every file is new, restored from the bundles that supersede the plain objects.
+        assert f"New:         {count} file(s)" in summary[0], summary[0]
+    print(peak_rss_mb())
+
+
+def job_peak_rss(operation:str, count:int, work_dir) -> float:
+    # Each job gets a process of its own, since peak RSS only ever grows within one.
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PYTHONPATH=root, AWS_ACCESS_KEY_ID='testing', AWS_SECRET_ACCESS_KEY='testing',
+               AWS_DEFAULT_REGION='us-east-1')
+    env.pop('AWS_ENDPOINT_URL', None)
+    os.makedirs(work_dir)
+    child = subprocess.run([sys.executable, '-c', f"from tests.test_memory import run_job; run_job({operation!r}, {count}, {str(work_dir)!r})"],
+                           env=env, capture_output=True, text=True, check=True)
+    return float(child.stdout.strip().splitlines()[-1])
+
+
+# Files of the smaller job: fewer for uploads, whose files are written to disk first.
+@pytest.mark.parametrize('operation, files', [('upload', 5000), ('download', 20000), ('sync', 20000)])
+def test_peak_memory_does_not_grow_with_the_number_of_files(operation, files, tmp_path):
+    small = job_peak_rss(operation, files, tmp_path / 'small')
+    large = job_peak_rss(operation, files * FACTOR, tmp_path / 'large')
+    assert large - small < SLACK_MB, f"{FACTOR}x the files needs {large - small:.1f} MB more peak RSS"
@@ -0,0 +1,158 @@
+import os
+
+import pytest
+
+from botocore.exceptions import EndpointConnectionError
+from s3sync_util.commands.hashing import MB
+from s3sync_util.commands.multipart import UPLOADS_DIR, list_multipart_uploads, multipart_download_from_s3, multipart_upload_to_s3
+from tests.conftest import BUCKET
+
+PART_SIZE = 5 * MB
+
+
+class Recorder:
+    """An S3 client that counts the parts sent through it, and loses its connection after `fail_after` of them."""
+
+    def __init__(self, s3, fail_after=None):
+        self.s3 = s3
+        self.fail_after = fail_after
+        self.sent = []
+
+    def upload_part(self, **kwargs):
+        if self.fail_after is not None and len(self.sent) >= self.fail_after:
+            raise EndpointConnectionError(endpoint_url='https://s3.amazonaws.com')
+        self.sent.append(kwargs['PartNumber'])
+        return self.s3.upload_part(**kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.s3, name)
+
+
+def write_file(path, size:int) -> str:
+    with open(path, 'wb') as f:
+        f.write(os.urandom(size))
+    return str(path)
+
+
+def read_object(s3, key:str) -> bytes:
+    return s3.get_object(Bucket=BUCKET, Key=key)['Body'].read()
+
+
+def upload(s3, path, state_dir):
+    return multipart_upload_to_s3(path, s3, BUCKET, 'big.bin', workers=1, part_size=PART_SIZE, state_dir=str(state_dir))
+
+
+def interrupt_upload(s3, path, state_dir, parts:int) -> None:
+    with pytest.raises(EndpointConnectionError):
+        upload(Recorder(s3, fail_after=parts), path, state_dir)
+    # The UploadId is kept for the next run.
+    assert len(os.listdir(state_dir / UPLOADS_DIR)) == 1
+    assert len(list(list_multipart_uploads(s3, BUCKET, 'big.bin'))) == 1
+
+
+def test_interrupted_upload_resumes_with_the_missing_parts(s3, tmp_path):
+    path = write_file(tmp_path / 'big.bin', 4 * PART_SIZE + 100)
+    interrupt_upload(s3, path, tmp_path, parts=2)
+
+    resumed = Recorder(s3)
+    etag = upload(resumed, path, tmp_path)
+    assert resumed.sent == [3, 4, 5]
+    with open(path, 'rb') as f:
+        assert read_object(s3, 'big.bin') == f.read()
+    assert etag == s3.head_object(Bucket=BUCKET, Key='big.bin')['ETag'].strip('"')
+    # Done uploads leave neither a record nor parts behind.
+    assert os.listdir(tmp_path / UPLOADS_DIR) == []
+    assert list(list_multipart_uploads(s3, BUCKET, 'big.bin')) == []
+
+
+def test_changed_file_starts_the_upload_over(s3, tmp_path):
+    path = write_file(tmp_path / 'big.bin', 4 * PART_SIZE + 100)
+    interrupt_upload(s3, path, tmp_path, parts=2)
+
+    # Same size, new content and mtime: the parts already sent belong to the old file.
+    write_file(path, 4 * PART_SIZE + 100)
+    os.utime(path, ns=(0, 10 ** 9))
+    restarted = Recorder(s3)
+    upload(restarted, path, tmp_path)
+    assert restarted.sent == [1, 2, 3, 4, 5]
+    with open(path, 'rb') as f:
+        assert read_object(s3, 'big.bin') == f.read()
+    # The abandoned upload was aborted rather than left to accumulate storage.
+    assert list(list_multipart_uploads(s3, BUCKET, 'big.bin')) == []
+
+
+class RangeRecorder:
+    """Counts the ranged GETs of a client, and loses its connection after `fail_after` of them."""
+
+    def __init__(self, s3, fail_after=None):
+        self.fail_after = fail_after
+        self.ranges = []
+        s3.meta.events.register('provide-client-params.s3.GetObject', self.on_get)
+
+    def on_get(self, params, **kwargs):
+        if self.fail_after is not None and len(self.ranges) >= self.fail_after:
+            raise EndpointConnectionError(endpoint_url='https://s3.amazonaws.com')
+        self.ranges.append(int(params['Range'].split('=')[1].split('-')[0]) // PART_SIZE + 1)
+
+    def detach(self, s3):
+        s3.meta.events.unregister('provide-client-params.s3.GetObject', self.on_get)
+
+
+def put_object(s3, size:int):
+    data = os.urandom(size)
+    etag = s3.put_object(Bucket=BUCKET, Key='big.bin', Body=data)['ETag']
+    return data, etag
+
+
+def download(s3, path, data, etag, fail_after=None):
+    recorder = RangeRecorder(s3, fail_after)
+    try:
+        multipart_download_from_s3(str(path), s3, BUCKET, 'big.bin', len(data), etag, workers=1, part_size=PART_SIZE)
+    finally:
+        recorder.detach(s3)
+    return recorder.ranges
+
+
+def interrupt_download(s3, path, data, etag, parts:int) -> None:
+    with pytest.raises(EndpointConnectionError):
+        download(s3, path, data, etag, fail_after=parts)
+    assert os.path.exists(f"{path}.s3sync-download") and os.path.exists(f"{path}.s3sync-download.json")
+    assert not os.path.exists(path)
+
+
+def test_interrupted_download_resumes_with_the_missing_parts(s3, tmp_path):
+    data, etag = put_object(s3, 4 * PART_SIZE + 100)
+    path = tmp_path / 'big.bin'
+    interrupt_download(s3, path, data, etag, parts=2)
+
+    assert download(s3, path, data, etag) == [3, 4, 5]
+    assert path.read_bytes() == data
+    assert sorted(os.listdir(tmp_path)) == ['big.bin']
+
+
+def test_download_of_a_replaced_object_starts_over(s3, tmp_path):
+    data, etag = put_object(s3, 4 * PART_SIZE + 100)
+    path = tmp_path / 'big.bin'
+    interrupt_download(s3, path, data, etag, parts=2)
+
+    # The parts on disk are of the old object, whose ETag the progress file records.
+    data, etag = put_object(s3, 4 * PART_SIZE + 100)
+    assert download(s3, path, data, etag) == [1, 2, 3, 4, 5]
+    assert path.read_bytes() == data
+
+
+def test_corrupted_part_is_rejected(s3, tmp_path):
+    data, etag = put_object(s3, 4 * PART_SIZE + 100)
+    path = tmp_path / 'big.bin'
+    interrupt_download(s3, path, data, etag, parts=2)
+
+    # Damage a part that the progress file records as written.
+    with open(f"{path}.s3sync-download", 'r+b') as f:
+        f.seek(PART_SIZE + 10)
+        f.write(b'corrupted')
+    with pytest.raises(IOError, match='does not match its ETag'):
+        download(s3, path, data, etag)
+    # Nothing is moved into place, and the next run downloads every part again.
+    assert os.listdir(tmp_path) == []
+    assert download(s3, path, data, etag) == [1, 2, 3, 4, 5]
+    assert path.read_bytes() == data
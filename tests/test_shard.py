@@ -0,0 +1,17 @@
+import os
+
+from s3sync_util.commands.upload import upload_to_s3
+from s3sync_util.config.utils import DEFAULT_EXCLUDES
+from tests.conftest import BUCKET, list_keys, make_tree, quiet
+
+
+def test_sharded_upload_from_synced_directory_skips_its_own_files(s3, tmp_path, monkeypatch):
+    # The default --directory is the working directory, where the shard state and summaries are written.
+    source = make_tree(tmp_path / 'src', {f"d{i}/f{i}.txt": f"file {i}" for i in range(20)})
+    monkeypatch.chdir(source)
+    for shard in ('1/2', '2/2', '1/2'):
+        upload_to_s3(source, BUCKET, 'pre', list(DEFAULT_EXCLUDES), workers=2, shard=shard, interactive=False, log=quiet)
+
+    assert any(name.startswith('.state.1-of-2.db') for name in os.listdir(source))
+    assert os.path.exists(os.path.join(source, '.s3sync-summary.2-of-2.json'))
+    assert list_keys(s3, 'pre/') == sorted(f"pre/d{i}/f{i}.txt" for i in range(20))
@@ -0,0 +1,52 @@
+import os
+
+from s3sync_util.commands.sync import sync_with_s3
+from s3sync_util.commands.upload import upload_to_s3
+from tests.conftest import BUCKET, list_keys, make_tree, quiet
+
+
+def read(path):
+    with open(path) as f:
+        return f.read()
+
+
+def test_download_sync_restores_bundled_files(s3, tmp_path):
+    files = {f"f{i}.txt": f"small file {i}" for i in range(10)}
+    files['big.txt'] = 'x' * (32 * 1024)
+    source = make_tree(tmp_path / 'src', files)
+    (tmp_path / 'up').mkdir()
+    upload_to_s3(source, BUCKET, 'pre', [], bundle=True, state_dir=str(tmp_path / 'up'), interactive=False, log=quiet)
+
+    # A changed file, an identical file the destination has no record of, and a local-only file.
+    target = make_tree(tmp_path / 'dst', {'f3.txt': 'stale', 'f5.txt': 'small file 5', 'extra.txt': 'extra'})
+    state_dir = str(tmp_path / 'down')
+    os.mkdir(state_dir)
+    result = sync_with_s3(target, BUCKET, 'pre', [], direction='download', delete=True, state_dir=state_dir,
+                          interactive=False, log=quiet)
+
+    assert sorted(os.listdir(target)) == sorted(files)
+    for name, content in files.items():
+        assert read(os.path.join(target, name)) == content
+    assert result.files_transferred == 10
+    assert result.files_skipped == 1
+    assert result.files_deleted == 1
+
+    again = sync_with_s3(target, BUCKET, 'pre', [], direction='download', delete=True, state_dir=state_dir,
+                         interactive=False, log=quiet)
+    assert again.files_transferred == 0
+    assert again.files_skipped == 11
+    assert again.files_deleted == 0
+
+
+def test_cached_index_follows_uploads_and_deletes(s3, tmp_path):
+    source = make_tree(tmp_path / 'src', {'a.txt': 'a', 'b.txt': 'b'})
+    options = dict(direction='upload', delete=True, index_ttl=3600, interactive=False, log=quiet)
+    assert sync_with_s3(source, BUCKET, 'pre', [], **options).files_transferred == 2
+    assert sync_with_s3(source, BUCKET, 'pre', [], **options).files_transferred == 0
+
+    os.remove(os.path.join(source, 'b.txt'))
+    assert sync_with_s3(source, BUCKET, 'pre', [], **options).files_deleted == 1
+    # The cached index no longer lists the deleted object, so the restored file is uploaded again.
+    make_tree(source, {'b.txt': 'b'})
+    assert sync_with_s3(source, BUCKET, 'pre', [], **options).files_transferred == 1
+    assert list_keys(s3, 'pre/') == ['pre/a.txt', 'pre/b.txt']
@@ -0,0 +1,149 @@
+import threading
+
+import pytest
+
+from botocore.awsrequest import AWSResponse
+from s3sync_util.commands import throttle
+from s3sync_util.commands.throttle import AdaptiveConcurrency, Throttle, TokenBucket
+from tests.conftest import BUCKET
+
+
+class FakeClock:
+    """Stands in for the time module of throttle.py: sleeping moves the clock forward at once."""
+
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = []
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def sleep(self, seconds:float) -> None:
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(throttle, 'time', fake)
+    return fake
+
+
+def test_token_bucket_lets_a_burst_through_and_then_limits_the_rate(clock):
+    bucket = TokenBucket(rate=10, capacity=10)
+    assert bucket.acquire(10) == 0
+    assert bucket.acquire(5) == pytest.approx(0.5)
+    # Idle time refills the bucket, but no further than its capacity.
+    clock.now += 60
+    assert bucket.acquire(10) == 0
+    assert bucket.acquire(1) == pytest.approx(0.1)
+
+
+def test_token_bucket_lets_large_requests_through_in_debt(clock):
+    bucket = TokenBucket(rate=10, capacity=10)
+    # Larger than the bucket: sent at once, and paid back by waiting.
+    assert bucket.acquire(30) == pytest.approx(2.0)
+    assert bucket.acquire(10) == pytest.approx(1.0)
+
+
+def test_token_bucket_holds_its_rate_over_time(clock):
+    bucket = TokenBucket(rate=100)
+    start = clock.now
+    for _ in range(100):
+        bucket.acquire(7)
+    # 700 tokens at 100 per second, the first 100 of them from the full bucket.
+    assert clock.now - start == pytest.approx(6.0)
+
+
+def test_concurrency_halves_on_throttling_once_per_cooldown(clock):
+    concurrency = AdaptiveConcurrency(16, cooldown=1.0)
+    concurrency.decrease()
+    assert concurrency.limit == 8
+    # A burst of errors is one signal.
+    clock.now += 0.5
+    concurrency.decrease()
+    assert concurrency.limit == 8
+    clock.now += 1.0
+    concurrency.decrease()
+    assert concurrency.limit == 4
+    assert concurrency.decreases == 2
+    for _ in range(10):
+        clock.now += 1.0
+        concurrency.decrease()
+    assert concurrency.limit == concurrency.minimum == 1
+
+
+def test_concurrency_grows_by_one_per_round_of_successes(clock):
+    concurrency = AdaptiveConcurrency(16)
+    concurrency.decrease()
+    # Eight successful requests at a limit of 8 are one round: one more slot.
+    for _ in range(8):
+        concurrency.acquire()
+        concurrency.release(success=True)
+    assert 8.9 < concurrency.limit < 9
+    # Failures do not add slots, and the limit never passes the maximum.
+    concurrency.acquire()
+    concurrency.release(success=False)
+    assert 8.9 < concurrency.limit < 9
+    for _ in range(1000):
+        concurrency.acquire()
+        concurrency.release()
+    assert concurrency.limit == 16
+
+
+def test_concurrency_blocks_requests_over_the_limit():
+    concurrency = AdaptiveConcurrency(1)
+    concurrency.acquire()
+    entered = threading.Event()
+
+    def second():
+        concurrency.acquire()
+        entered.set()
+        concurrency.release()
+
+    thread = threading.Thread(target=second)
+    thread.start()
+    assert not entered.wait(0.2)
+    concurrency.release()
+    assert entered.wait(5)
+    thread.join()
+
+
+class RawBody:
+    """The raw body of a canned HTTP response."""
+
+    def __init__(self, data:bytes):
+        self.data = data
+
+    def stream(self, **kwargs):
+        yield self.data
+
+
+def test_slow_down_response_halves_the_concurrency_of_the_client(s3):
+    answered = []
+
+    def slow_down(request, **kwargs):
+        # The first attempt is answered with a throttling response before it reaches S3.
+        if answered:
+            return None
+        answered.append(request.url)
+        body = b'<Error><Code>SlowDown</Code><Message>Please reduce your request rate.</Message></Error>'
+        return AWSResponse(request.url, 503, {}, RawBody(body))
+
+    limits = Throttle(max_in_flight=8)
+    limits.attach(s3)
+    s3.meta.events.register_first('before-send.s3.PutObject', slow_down)
+    try:
+        # The client's retry succeeds, against moto.
+        s3.put_object(Bucket=BUCKET, Key='a.txt', Body=b'a')
+    finally:
+        s3.meta.events.unregister('before-send.s3.PutObject', slow_down)
+        limits.detach(s3)
+    assert answered
+    assert s3.get_object(Bucket=BUCKET, Key='a.txt')['Body'].read() == b'a'
+    throttled = limits.concurrency
+    assert throttled.decreases == 1
+    assert 4 <= throttled.limit < 5
+    # The slot of the call was given back.
+    assert throttled._in_flight == 0
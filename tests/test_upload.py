@@ -0,0 +1,84 @@
+import os
+
+from s3sync_util.commands.download import download_from_s3
+from s3sync_util.commands.upload import upload_to_s3
+from tests.conftest import BUCKET, list_keys, make_tree, quiet
+
+FILES = {'a.txt': 'a' * 100, 'b.log': 'b' * 100, 'big.txt': 'x' * (32 * 1024)}
+
+
+def upload(source, prefix, **options):
+    return upload_to_s3(source, BUCKET, prefix, [], interactive=False, log=quiet, compress=['*.log'], **options)
+
+
+def test_upload_to_another_prefix_does_not_trust_the_state_of_the_first(s3, tmp_path):
+    source = make_tree(tmp_path / 'src', FILES)
+    upload(source, 'one')
+    # Touched files keep their records, including the ETag of the compressed object.
+    os.utime(os.path.join(source, 'b.log'), ns=(0, 0))
+    assert upload(source, 'one').files_transferred == 0
+    assert upload(source, 'one').files_transferred == 0
+
+    # The same state file, and so the same records, serve the upload to a second prefix.
+    assert upload(source, 'two').files_transferred == 3
+    assert list_keys(s3, 'two/') == ['two/a.txt', 'two/b.log', 'two/big.txt']
+    assert upload(source, 'one').files_transferred == 0
+    assert upload(source, 'two').files_transferred == 0
+
+
+def test_bundled_upload_to_another_prefix_does_not_trust_the_state_of_the_first(s3, tmp_path):
+    source = make_tree(tmp_path / 'src', FILES)
+    upload(source, 'one', bundle=True)
+    assert upload(source, 'one', bundle=True).files_transferred == 0
+
+    assert upload(source, 'two', bundle=True).files_transferred == 3
+    keys = list_keys(s3, 'two/')
+    assert 'two/big.txt' in keys
+    assert any(key.startswith('two/.s3sync-bundles/') for key in keys)
+    assert upload(source, 'two', bundle=True).files_transferred == 0
+
+
+def test_bundled_upload_with_a_cached_index_skips_unchanged_files(s3, tmp_path):
+    source = make_tree(tmp_path / 'src', FILES)
+    assert upload(source, 'one', bundle=True, index_ttl=3600).files_transferred == 3
+    # The bundle written by the first run is in the cached index the second one reads.
+    result = upload(source, 'one', bundle=True, index_ttl=3600)
+    assert result.files_transferred == 0
+    assert result.files_skipped == 3
+
+
+def test_upload_with_a_cached_index_skips_unchanged_files(s3, tmp_path):
+    source = make_tree(tmp_path / 'src', FILES)
+    assert upload(source, 'one', index_ttl=3600).files_transferred == 3
+    # Both later runs reuse the listing cached by the first, which has since been given its uploads.
+    for _ in range(2):
+        result = upload(source, 'one', index_ttl=3600)
+        assert result.files_transferred == 0
+        assert result.files_skipped == 3
+
+
+def test_bundles_are_deleted_once_all_their_files_are_packed_again(s3, tmp_path):
+    source = make_tree(tmp_path / 'src', {'a.txt': 'a', 'b.txt': 'b'})
+    upload(source, 'one', bundle=True)
+    first = [key for key in list_keys(s3, 'one/.s3sync-bundles/') if key.endswith('.tar')]
+
+    # One file packed again: the first bundle still holds the current b.txt.
+    make_tree(source, {'a.txt': 'a, changed'})
+    assert upload(source, 'one', bundle=True).files_transferred == 1
+    bundles = [key for key in list_keys(s3, 'one/.s3sync-bundles/') if key.endswith('.tar')]
+    assert len(bundles) == 2 and first[0] in bundles
+
+    # Both files packed again: the first bundle is superseded, and goes with its index.
+    make_tree(source, {'b.txt': 'b, changed'})
+    assert upload(source, 'one', bundle=True).files_transferred == 1
+    keys = list_keys(s3, 'one/.s3sync-bundles/')
+    assert first[0] not in keys and first[0] + '.index.json' not in keys
+    assert len(keys) == 4
+    target = tmp_path / 'dst'
+    (tmp_path / 'down').mkdir()
+    download_from_s3(BUCKET, 'one', str(target), [], state_dir=str(tmp_path / 'down'), interactive=False, log=quiet)
+    assert (target / 'a.txt').read_text() == 'a, changed' and (target / 'b.txt').read_text() == 'b, changed'
+
+    # The same files uploaded to another prefix leave the bundles of the first alone.
+    assert upload(source, 'two', bundle=True).files_transferred == 2
+    assert list_keys(s3, 'one/.s3sync-bundles/') == keys
@@ -0,0 +1,41 @@
+import os
+import sys
+
+import pytest
+
+from s3sync_util import main
+from s3sync_util.commands import upload, watch
+from s3sync_util.commands.state_store import open_state_store
+from tests.conftest import BUCKET, list_keys, make_tree
+
+
+@pytest.mark.parametrize('flags', [['--dry-run'], ['--stats'], ['--metrics-file', 'metrics.prom']])
+def test_watch_rejects_flags_it_cannot_honour(flags, monkeypatch, capsys):
+    monkeypatch.setattr(sys, 'argv', ['s3sync', 'upload', '--s3-bucket', 'bkt', '--s3-prefix', 'pre', '--watch'] + flags)
+    with pytest.raises(SystemExit) as exit_info:
+        main.cli()
+    assert exit_info.value.code == 2
+    assert f"{flags[0]} cannot be combined with --watch" in capsys.readouterr().err
+
+
+@pytest.mark.parametrize('stage', ['checksum', 'transfer'])
+def test_upload_changes_skips_a_file_removed_after_its_event(stage, s3, tmp_path, monkeypatch):
+    source = make_tree(tmp_path / 'src', {'keep.txt': 'kept', 'gone.txt': 'removed before it is uploaded'})
+    gone = os.path.join(source, 'gone.txt')
+    module, name = (watch, 'hash_file') if stage == 'checksum' else (upload, 'upload_file_to_s3')
+    original = getattr(module, name)
+
+    def remove_then_call(*args, **kwargs):
+        if os.path.exists(gone):
+            os.remove(gone)
+        return original(*args, **kwargs)
+
+    monkeypatch.setattr(module, name, remove_then_call)
+    logged = []
+    with open_state_store('sqlite', str(tmp_path)) as state:
+        tracker = watch.upload_changes(s3, state, source, BUCKET, 'pre', {'gone.txt', 'keep.txt'}, log=logged.append, dedup=False)
+        assert state.get('gone.txt') is None
+        assert state.get('keep.txt') is not None
+    assert tracker.transferred_files == 1
+    assert list_keys(s3, 'pre/') == ['pre/keep.txt']
+    assert any('gone.txt' in message for message in logged)